@@ -3,11 +3,25 @@
 import locust
 import logging
 import sys
-import time
 import yaml
 
 import qe_client_lib.dbapi_clients as client_lib
 
+from impala_loadtest.asyncquery import submit_query
+from impala_loadtest.common import result_size, timer
+from impala_loadtest.events import metric_success
+from impala_loadtest.export import MetricsExporter
+from impala_loadtest.health import GeneratorHealth, backpressure
+from impala_loadtest.histogram import LatencyRecorder
+from impala_loadtest.loadprofile import LoadProfile
+from impala_loadtest.openloop import (OpenLoopScheduler, current_rate,
+                                      report_start_lag)
+from impala_loadtest.pool import get_session_pool
+from impala_loadtest.profiles import ProfileCollector
+from impala_loadtest.replay import TraceReplayer, read_trace
+from impala_loadtest.timeseries import TimeSeriesSampler
+from impala_loadtest.validation import DEFAULT_BATCH_SIZE, ResultDigest
+
 logging.basicConfig()
 logger = logging.getLogger(name='impala_loadtest')
 
@@ -20,8 +34,25 @@ TestConfig = {}
 class DbApiLocustClient(object):
   """
   A proxy class for a DBAPI client that can emit Locust success/failure events.
+
+  If detailed_timing is True, logged_query() also breaks each query down into
+  separate execute, first row and fetch timings. See logged_query(). It can
+  be enabled for all clients with 'detailed_timing: True' in the config file.
+
+  If profile_collector is set, the runtime profiles of a sample of the queries
+  run with logged_query() or validated_query() are fetched in the background,
+  and their server-side phases recorded. See impala_loadtest.profiles. It's
+  set for all clients by a query_profiles section in the config file.
   """
 
+  detailed_timing = False
+
+  # The SessionPool the underlying client was checked out from, if any
+  pool = None
+
+  # The ProfileCollector that samples queries' runtime profiles, if any
+  profile_collector = None
+
   def hatch(self, host, client_type="ImpylaClient", **client_kwargs):
     """
     Args:
@@ -31,19 +62,89 @@ class DbApiLocustClient(object):
     """
     ClientType = getattr(client_lib, client_type)
     self._dbapi_client = ClientType(host, **client_kwargs)
+    self._settings = (host, client_type, client_kwargs)
+    self.detailed_timing = TestConfig.get('detailed_timing', False)
+
+  def hatch_from_pool(self, pool):
+    """
+    Check the underlying client out of a SessionPool, instead of connecting.
+
+    Args:
+      pool: an impala_loadtest.pool.SessionPool, e.g., from get_session_pool()
+    """
+    self.pool = pool
+    self._dbapi_client = pool.acquire()
+    self._settings = (pool.host, pool.client_type, pool.client_kwargs)
+    self.detailed_timing = TestConfig.get('detailed_timing', False)
+
+  def release(self):
+    """Return the underlying session to the pool it came from."""
+    self.pool.release(self._dbapi_client)
+    self._dbapi_client = None
+
+  def reconnect(self, target_db=None):
+    """
+    Replace the current session with a new one.
+
+    If the client came from a SessionPool, the current session goes back to
+    the pool, and a warm one is checked out in its place. Otherwise, the
+    client disconnects and reconnects, and the time taken is logged as a
+    connect/handshake stat, the same as a pool's cold handshakes.
+
+    Args:
+      target_db: database to select after reconnecting (not needed for pooled
+        sessions, which already have the pool's target database selected)
+    """
+    if self.pool is not None:
+      self.pool.release(self._dbapi_client)
+      self._dbapi_client = self.pool.acquire()
+      return
+
+    start_time = timer()
+    try:
+      self._dbapi_client.disconnect()
+      self._dbapi_client.connect()
+      if target_db is not None:
+        self._dbapi_client.query('use {target_db}'.format(target_db=target_db))
+    except Exception as e:
+      locust.events.request_failure.fire(
+        request_type="connect", name="handshake",
+        response_time=int((timer() - start_time) * 1000),
+        response_length=len(str(e)), exception=e
+      )
+      raise
+
+    locust.events.request_success.fire(
+      request_type="connect", name="handshake",
+      response_time=int((timer() - start_time) * 1000), response_length=0
+    )
 
-  def logged_query(self, query_str, query_name=None, return_response=False):
+  def logged_query(self, query_str, query_name=None, return_response=False,
+                   detailed_timing=None):
     """
     A wrapper around the native .query() method of the underlying DBAPI client.
 
     This will log locust success or failure events for each underlying query.
 
+    With detailed timing, the query is run directly on the client's cursor,
+    and in addition to the usual "query" entry, three more timings are
+    recorded under the same name, with request types "execute" (time for
+    execute() to return), "first_row" (time from submitting the query until
+    the first row is fetched) and "fetch" (time from execute() returning until
+    all rows are fetched). They're fired on impala_loadtest.events'
+    metric_success, rather than as locust requests, so that only the query
+    counts towards locust's totals. The query_timing event is also fired with
+    the unrounded timings, the row count, and the size of the fetched rows in
+    bytes.
+
     Args:
       query_str: the query to execute
       query_name: a string used to identify the query in the reported results
         (including the Locust UI, console output, and csv files).
       return_response: Boolean to determine whether DB results should be
         returned to the caller
+      detailed_timing: Boolean to override the client's detailed_timing
+        attribute for this query
 
     Returns:
       response from the query if return_response==True
@@ -51,29 +152,210 @@ class DbApiLocustClient(object):
     if query_name is None:
       query_name = query_str
 
-    start_time = time.time()
+    if detailed_timing is None:
+      detailed_timing = self.detailed_timing
+
+    # Held back here, before timing starts, if the generator is saturated
+    backpressure()
+
+    if detailed_timing:
+      response = self._timed_query(query_str, query_name)
+      if return_response:
+        return response
+      return
+
+    start_time = timer()
     try:
       response = self._dbapi_client.query(query_str)
     except Exception as e:
       # Note that this will report a failure to Locust, but will not
       # halt the test
-      total_time = int((time.time() - start_time) * 1000)
+      elapsed = timer() - start_time
       locust.events.request_failure.fire(
         request_type="query", name=query_name,
-        response_time=total_time, response_length=len(str(e)),
-        exception=e
+        response_time=int(elapsed * 1000), response_length=len(str(e)),
+        exception=e, response_time_seconds=elapsed
       )
       raise
 
-    total_time = int((time.time() - start_time) * 1000)
+    elapsed = timer() - start_time
     locust.events.request_success.fire(
       request_type="query", name=query_name,
-      response_time=total_time, response_length=sys.getsizeof(response)
+      response_time=int(elapsed * 1000), response_length=sys.getsizeof(response),
+      response_time_seconds=elapsed
     )
+    self._collect_profile(query_name)
 
     if return_response:
       return response
 
+  def _collect_profile(self, query_name):
+    """
+    Queue the profile of the query that just completed to be fetched, if it's
+    sampled. The profile is fetched in the background, off the measured path.
+    """
+    collector = self.profile_collector
+    if collector is None or not collector.sample():
+      return
+    collector.submit(self._settings, query_name,
+                     getattr(self._dbapi_client, '_cursor', None))
+
+  def _timed_query(self, query_str, query_name):
+    """
+    Run a query on the underlying cursor, timing each phase separately.
+    """
+    cursor = self._dbapi_client._cursor
+
+    start_time = timer()
+    try:
+      cursor.execute(query_str)
+      execute_time = timer()
+
+      response = cursor.fetchmany(DEFAULT_BATCH_SIZE) or []
+      first_row_time = timer()
+
+      while True:
+        rows = cursor.fetchmany(DEFAULT_BATCH_SIZE)
+        if not rows:
+          break
+        response.extend(rows)
+    except Exception as e:
+      elapsed = timer() - start_time
+      locust.events.request_failure.fire(
+        request_type="query", name=query_name,
+        response_time=int(elapsed * 1000), response_length=len(str(e)),
+        exception=e, response_time_seconds=elapsed
+      )
+      raise
+    end_time = timer()
+
+    timings = {
+      'execute': execute_time - start_time,
+      'first_row': first_row_time - start_time,
+      'fetch': end_time - execute_time,
+      'query': end_time - start_time,
+    }
+    num_bytes = result_size(response)
+
+    locust.events.request_success.fire(
+      request_type="query", name=query_name,
+      response_time=int(timings['query'] * 1000), response_length=num_bytes,
+      response_time_seconds=timings['query']
+    )
+    for request_type in ('execute', 'first_row', 'fetch'):
+      metric_success.fire(
+        request_type=request_type, name=query_name,
+        response_time=int(timings[request_type] * 1000),
+        response_length=num_bytes,
+        response_time_seconds=timings[request_type]
+      )
+
+    query_timing.fire(name=query_name, rows=len(response),
+                      num_bytes=num_bytes, **timings)
+    self._collect_profile(query_name)
+    return response
+
+  def submit(self, query_str, query_name=None):
+    """
+    Start running a query, and return without waiting for it to finish.
+
+    The query runs on a cursor of its own, on the client's existing session,
+    so several queries can be in flight at once from one client. The returned
+    handle is used to poll the query's state, fetch its results, or cancel it,
+    and logs a locust event, timed from submission, when the query's results
+    are fetched or it's cancelled. See impala_loadtest.asyncquery.QueryHandle.
+
+    Args:
+      query_str: the query to execute
+      query_name: a string used to identify the query in the reported results
+
+    Returns:
+      a QueryHandle
+    """
+    if query_name is None:
+      query_name = query_str
+    backpressure()
+    return submit_query(self._dbapi_client, query_str, query_name)
+
+  def validated_query(self, query_str, expected_digest, query_name=None,
+                      ordered=True, batch_size=DEFAULT_BATCH_SIZE, full=True):
+    """
+    Run a query, and validate its results against a precomputed digest.
+
+    Rows are fetched from the cursor in batches of batch_size, and folded into
+    a ResultDigest, so client memory stays constant regardless of the size of
+    the result set. Time spent hashing rows is excluded from the reported
+    response time.
+
+    A locust success event is logged if the digest matches, and a failure
+    event (followed by an AssertionError) if it doesn't.
+
+    Args:
+      query_str: the query to execute
+      expected_digest: a dict as returned by ResultDigest.to_dict(), e.g.,
+        from impala_loadtest.validation.ExpectedDigests
+      query_name: a string used to identify the query in the reported results
+      ordered: Boolean to determine whether row order must also match, e.g.,
+        from the query's ResultComparator (rows must be in order by default)
+      batch_size: number of rows to fetch from the cursor at a time
+      full: if False, the rows are only counted, not hashed, and only the
+        row count is checked, which costs the client far less CPU
+
+    Returns:
+      the ResultDigest of the actual results, or None if not full
+    """
+    if query_name is None:
+      query_name = query_str
+
+    backpressure()
+    cursor = self._dbapi_client._cursor
+    digest = ResultDigest() if full else None
+    row_count = 0
+    hashing_time = 0
+
+    start_time = timer()
+    try:
+      cursor.execute(query_str)
+      while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+          break
+        row_count += len(rows)
+        if full:
+          hash_start_time = timer()
+          digest.update(rows)
+          hashing_time += timer() - hash_start_time
+
+      if row_count != expected_digest['row_count']:
+        mismatch = "expected {0} rows, got {1}".format(expected_digest['row_count'],
+                                                       row_count)
+      elif full and not digest.matches(expected_digest, ordered=ordered):
+        if ordered and digest.matches(expected_digest, ordered=False):
+          mismatch = "the ordered digest differs: the rows match, but not their order"
+        else:
+          mismatch = "the {0} digest differs, though the row count ({1}) matches".format(
+            'ordered' if ordered else 'unordered', row_count)
+      else:
+        mismatch = None
+      assert mismatch is None, "Results mismatch for {0}: {1}".format(query_name, mismatch)
+    except Exception as e:
+      elapsed = timer() - start_time - hashing_time
+      locust.events.request_failure.fire(
+        request_type="query", name=query_name,
+        response_time=int(elapsed * 1000), response_length=len(str(e)),
+        exception=e, response_time_seconds=elapsed
+      )
+      raise
+
+    elapsed = timer() - start_time - hashing_time
+    locust.events.request_success.fire(
+      request_type="query", name=query_name,
+      response_time=int(elapsed * 1000), response_length=row_count,
+      response_time_seconds=elapsed
+    )
+    self._collect_profile(query_name)
+    return digest
+
   def __getattr__(self, name):
     """Proxy all other calls through to underlying DBAPI client"""
     return getattr(self._dbapi_client, name)
@@ -91,6 +373,130 @@ class DbApiLocust(locust.Locust):
     self.client = DbApiLocustClient()
 
 
+class OpenLoopTaskSet(locust.TaskSet):
+  """
+  Abstract TaskSet that issues queries at a target arrival rate (open loop).
+
+  Rather than running one query after another, each locust user schedules
+  arrivals at a fixed rate with an OpenLoopScheduler, and runs each query in
+  its own greenlet, on a session checked out of session_pool. Settings are
+  read from the 'open_loop' section of the config file:
+
+    target_qps: queries started per second, per locust user (unless changed
+      by a load_profile stage)
+    arrival: 'poisson' (default) or 'fixed'
+    max_concurrency: ceiling on in-flight queries per user (default 100)
+    seed: seed for the arrival schedule (optional)
+
+  Subclasses must set self.session_pool (e.g., in on_start, with
+  impala_loadtest.pool.get_session_pool(), with keep_idle=True so that
+  sessions are reused rather than reopened for each arrival), and implement
+  next_query(). Each arrival's start lag includes any wait for a session.
+  """
+
+  session_pool = None
+
+  def next_query(self):
+    """Return a (query_name, query_str) tuple for the next arrival."""
+    raise NotImplementedError()
+
+  @locust.task
+  def run_open_loop(self):
+    config = TestConfig['open_loop']
+    scheduler = OpenLoopScheduler(rate=current_rate(config['target_qps']),
+                                  distribution=config.get('arrival', 'poisson'),
+                                  max_concurrency=config.get('max_concurrency', 100),
+                                  seed=config.get('seed'))
+    scheduler.run(self._run_query)
+
+  def _run_query(self, scheduled_start):
+    query_name, query_str = self.next_query()
+    client = DbApiLocustClient()
+    client.hatch_from_pool(self.session_pool)
+    report_start_lag(scheduled_start)
+    try:
+      client.logged_query(query_str=query_str, query_name=query_name)
+    except Exception as e:
+      # The failure has already been reported to locust
+      logger.debug("{0} failed: {1}".format(query_name, e))
+    finally:
+      client.release()
+
+
+class ReplaySession(object):
+  """
+  A session in a replayed trace, with a connection of its own.
+
+  The session is connected to the database of its first query, and switches
+  databases whenever a later query in the trace was run in a different one.
+  Queries are run as the configured user; the user in the trace is only used
+  to group sessions and name stats.
+  """
+
+  def __init__(self, first_entry, **client_kwargs):
+    """
+    Args:
+      first_entry: the session's first TraceEntry
+      client_kwargs: a dictionary of parameters needed to make a connection,
+        including host and client_type
+    """
+    self.database = first_entry.database
+    self.client = DbApiLocustClient()
+    self.client.hatch_from_pool(get_session_pool(
+      target_db=self.database, spares=0, **client_kwargs))
+
+  def run(self, entry):
+    if entry.database is not None and entry.database != self.database:
+      self.client.query('use {target_db}'.format(target_db=entry.database))
+      self.database = entry.database
+    self.client.logged_query(query_str=entry.sql, query_name=entry.name)
+
+  def close(self):
+    self.client.release()
+
+
+class TraceReplayTaskSet(locust.TaskSet):
+  """
+  Abstract TaskSet that replays a captured query log, with its original timing.
+
+  A single locust user replays the whole log with a TraceReplayer, running
+  each of the log's sessions in its own greenlet and connection, so the test
+  should be run with one user (-c 1). Settings are read from the 'replay'
+  section of the config file:
+
+    trace_file: path of the query log (see impala_loadtest.replay.read_trace)
+    speedup: pace relative to the original, e.g., 2 or 10 (default 1)
+    max_gap: longest idle period to keep, in seconds after scaling (optional)
+    queue_size: queries a session may fall behind before reading pauses
+      (default 100)
+    idle_timeout: seconds before an idle session is closed (default 60)
+    repeat: whether to start over when the log ends (default False, which
+      stops the user instead)
+
+  Subclasses must set self.client_kwargs (e.g., in on_start) to the
+  parameters needed to make a connection, including host and client_type.
+  """
+
+  client_kwargs = None
+
+  @locust.task
+  def run_replay(self):
+    config = TestConfig['replay']
+    replayer = TraceReplayer(read_trace(config['trace_file']),
+                             open_session=self._open_session,
+                             speedup=config.get('speedup', 1.0),
+                             max_gap=config.get('max_gap'),
+                             queue_size=config.get('queue_size', 100),
+                             idle_timeout=config.get('idle_timeout', 60))
+    replayer.run()
+    logger.info("Finished replaying {0}".format(config['trace_file']))
+    if not config.get('repeat', False):
+      raise locust.exception.StopLocust()
+
+  def _open_session(self, first_entry):
+    return ReplaySession(first_entry, **self.client_kwargs)
+
+
 def setup_test_config(config_file=None, **kwargs):
   """
   Event handler to process the yaml config file.
@@ -104,10 +510,109 @@ def setup_test_config(config_file=None, **kwargs):
     TestConfig.update(yaml.safe_load(fh))
 
 
+def setup_latency_recorder(**kwargs):
+  """
+  Event handler to record high-resolution latency histograms.
+
+  If the config file sets latency_report to a file name, a LatencyRecorder is
+  attached to the request events, and a CSV of per-request percentiles is
+  written to that file when the test ends.
+  """
+  if TestConfig.get('latency_report'):
+    LatencyRecorder(TestConfig['latency_report']).install()
+
+
+def setup_timeseries_sampler(**kwargs):
+  """
+  Event handler to sample throughput and latency over time.
+
+  If the config file sets timeseries_file to a file name, a TimeSeriesSampler
+  appends a window of per-request stats to that file every
+  timeseries_interval seconds (30 by default) for as long as the test runs.
+  """
+  if TestConfig.get('timeseries_file'):
+    TimeSeriesSampler(TestConfig['timeseries_file'],
+                      interval=TestConfig.get('timeseries_interval', 30)).install()
+
+
+def setup_load_profile(**kwargs):
+  """
+  Event handler to step the load through stages, to find the saturation point.
+
+  If the config file has a load_profile section, a LoadProfile steps the
+  number of users (or the open loop arrival rate) through its stages once the
+  test starts, and reports throughput and latency for each stage. See
+  impala_loadtest.loadprofile.
+  """
+  if TestConfig.get('load_profile'):
+    LoadProfile(TestConfig['load_profile']).install()
+
+
+def setup_generator_health(**kwargs):
+  """
+  Event handler to watch for the load generator itself becoming the bottleneck.
+
+  If the config file has a generator_health section, a GeneratorHealth
+  monitor measures event loop lag, CPU use and harness vs. server time per
+  request, flags (or, with throttle: true, throttles) the process while it's
+  saturated, and adds a generator health section to the run output. See
+  impala_loadtest.health.
+  """
+  if TestConfig.get('generator_health'):
+    GeneratorHealth(TestConfig['generator_health']).install()
+
+
+def setup_query_profiles(**kwargs):
+  """
+  Event handler to break queries' latencies down into server-side phases.
+
+  If the config file has a query_profiles section, a ProfileCollector fetches
+  the runtime profiles of a sample of the queries run by DbApiLocustClients,
+  in the background, and records their planning, admission wait, rows
+  available, first row and last row times. See impala_loadtest.profiles.
+  """
+  if TestConfig.get('query_profiles'):
+    DbApiLocustClient.profile_collector = ProfileCollector(
+      TestConfig['query_profiles']).install()
+
+
+def setup_metrics_export(**kwargs):
+  """
+  Event handler to stream every request's stats out of the harness.
+
+  If the config file has a metrics_export section, a MetricsExporter buffers
+  each request reported to locust, and writes them out in batches, from a
+  background thread, to the section's sinks: compressed event logs, line
+  protocol files or a local socket. See impala_loadtest.export.
+  """
+  if TestConfig.get('metrics_export'):
+    MetricsExporter(TestConfig['metrics_export']).install()
+
+
 # 'test_setup' is the event hook that individual tests can fire() when first
 # starting up. Any arbitrary handler (callable) can be attached to an event
 # hook. Upon firing, handlers are run in the order in which they are added.
 #
-# By default, we'll start by attaching setup_test_config.
+# By default, we'll start by attaching setup_test_config, followed by any
+# handlers that depend on the config.
 test_setup = locust.events.EventHook()
 test_setup += setup_test_config
+test_setup += setup_latency_recorder
+test_setup += setup_timeseries_sampler
+test_setup += setup_load_profile
+test_setup += setup_generator_health
+test_setup += setup_query_profiles
+test_setup += setup_metrics_export
+
+# 'query_timing' is fired by DbApiLocustClient.logged_query() for each
+# successful query when detailed timing is enabled. Handlers are called with
+# the following keyword arguments:
+#
+#   name: the query name, as reported to Locust
+#   execute, first_row, fetch, query: durations in seconds (see logged_query)
+#   rows: number of rows fetched
+#   num_bytes: size of the fetched rows, as returned by common.result_size()
+query_timing = locust.events.EventHook()
+
+# impala_loadtest.profiles.query_profile is fired with each query profile
+# fetched when query_profiles is configured. See ProfileCollector.
@@ -0,0 +1,312 @@
+"""Asynchronous query execution, with handles to poll, fetch and cancel."""
+
+import gevent
+import locust
+import logging
+
+from gevent.threadpool import ThreadPool
+
+from impala_loadtest.common import result_size, timer
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.asyncquery')
+
+# States of a QueryHandle
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Maximum number of queries run in background threads at once, by clients
+# without a native async API. Queries beyond this wait for a free thread.
+MAX_BLOCKING_QUERIES = 100
+
+_threadpool = None
+
+
+def get_threadpool():
+  """Return the thread pool that runs blocking queries for this process."""
+  global _threadpool
+  if _threadpool is None:
+    _threadpool = ThreadPool(MAX_BLOCKING_QUERIES)
+  return _threadpool
+
+
+def open_cursor(client):
+  """
+  Return a new cursor on the same session (or connection) as a DBAPI client.
+
+  Each query handle needs a cursor of its own, so that several queries can be
+  in flight at once. Impyla cursors are created on the client's existing
+  HiveServer2 session, and other drivers' cursors on the client's existing
+  connection, so no new connection is made. If neither is available, the
+  client's own cursor is used, and only one query can be in flight at a time.
+
+  Since an Impyla cursor closes its session when it's closed, the handles of
+  queries run on these cursors only close their operations (see
+  ImpylaQueryHandle), and leave the client's session open.
+  """
+  cursor = client._cursor
+  if hasattr(cursor, 'execute_async') and hasattr(cursor, 'session'):
+    return type(cursor)(cursor.session)
+  connection = getattr(cursor, 'connection', None)
+  if connection is not None and hasattr(connection, 'cursor'):
+    return connection.cursor()
+  return cursor
+
+
+class QueryHandle(object):
+  """
+  A query submitted with DbApiLocustClient.submit().
+
+  The handle can be polled for the query's state, and the query's results
+  fetched or the query cancelled. One locust stat is logged for each handle,
+  when it's fetched or cancelled, timed from submission:
+
+    query / <name>: the query's results were fetched; the time includes
+      fetching all rows, the same as DbApiLocustClient.logged_query()
+    query / <name> (cancelled): the query was cancelled; the time is up until
+      the cancellation returned
+
+  Every handle should end with a call to either fetch() or cancel(), or its
+  query (and cursor) will be left open on the server.
+
+  This is an abstract class: the subclass used depends on whether the client's
+  cursor has a native async API (see ImpylaQueryHandle and
+  ThreadedQueryHandle).
+  """
+
+  def __init__(self, cursor, query_str, query_name, close_cursor=True):
+    """
+    Args:
+      cursor: a DBAPI cursor for this query, e.g., from open_cursor()
+      query_str: the query to execute
+      query_name: a string used to identify the query in the reported results
+      close_cursor: Boolean to determine whether the cursor is closed when the
+        query is fetched or cancelled (False for a client's own cursor)
+    """
+    self.cursor = cursor
+    self.close_cursor = close_cursor
+    self.query_str = query_str
+    self.query_name = query_name
+    self.state = RUNNING
+    self.error = None
+    self.start_time = timer()
+    self.end_time = None
+    self._start()
+
+  @property
+  def done(self):
+    return self.state != RUNNING
+
+  @property
+  def elapsed(self):
+    """Seconds from submission until the query ended, or until now."""
+    return (self.end_time or timer()) - self.start_time
+
+  def poll(self):
+    """Check on the query, without blocking on it, and return its state."""
+    if self.state == RUNNING:
+      self._poll()
+    return self.state
+
+  def wait(self, timeout=None, poll_interval=0.1):
+    """
+    Block until the query finishes or fails, or until timeout seconds pass.
+
+    Returns:
+      the query's state
+    """
+    deadline = None if timeout is None else timer() + timeout
+    while self.poll() == RUNNING:
+      if deadline is not None and timer() >= deadline:
+        break
+      gevent.sleep(poll_interval)
+    return self.state
+
+  def fetch(self):
+    """
+    Block until the query completes, and return all of its rows.
+
+    A locust success event is logged for the query, or a failure event if it
+    failed, in which case the error is raised.
+    """
+    try:
+      rows = self._fetch()
+    except Exception as e:
+      self._fail(e)
+      raise
+    finally:
+      self._close()
+
+    self.state = FINISHED
+    self.end_time = timer()
+    locust.events.request_success.fire(
+      request_type="query", name=self.query_name,
+      response_time=int(self.elapsed * 1000), response_length=result_size(rows),
+      response_time_seconds=self.elapsed
+    )
+    return rows
+
+  def cancel(self):
+    """
+    Cancel the query, and log the time from submission to cancellation.
+
+    Returns:
+      True if the query was still running when it was cancelled
+    """
+    was_running = self.poll() == RUNNING
+    name = '{0} (cancelled)'.format(self.query_name)
+    try:
+      self._cancel()
+    except Exception as e:
+      self._fail(e, name)
+      raise
+    finally:
+      self._close()
+
+    self.state = CANCELLED
+    self.end_time = timer()
+    locust.events.request_success.fire(
+      request_type="query", name=name,
+      response_time=int(self.elapsed * 1000), response_length=0,
+      response_time_seconds=self.elapsed
+    )
+    return was_running
+
+  def _fail(self, e, name=None):
+    self.state = FAILED
+    self.error = e
+    self.end_time = timer()
+    locust.events.request_failure.fire(
+      request_type="query", name=name or self.query_name,
+      response_time=int(self.elapsed * 1000), response_length=len(str(e)),
+      exception=e, response_time_seconds=self.elapsed
+    )
+
+  def _close(self):
+    if not self.close_cursor:
+      return
+    try:
+      self.cursor.close()
+    except Exception as e:
+      logger.debug("Error closing cursor: {0}".format(e))
+
+  def _start(self):
+    raise NotImplementedError()
+
+  def _poll(self):
+    raise NotImplementedError()
+
+  def _fetch(self):
+    raise NotImplementedError()
+
+  def _cancel(self):
+    raise NotImplementedError()
+
+
+class ImpylaQueryHandle(QueryHandle):
+  """
+  A handle for a query run with Impyla's native async API.
+
+  The query is submitted with execute_async(), and its state is polled with
+  a GetOperationStatus RPC, so no greenlet or thread is tied up while it runs.
+  """
+
+  def _start(self):
+    self.cursor.execute_async(self.query_str)
+
+  def _poll(self):
+    if not self.cursor.is_executing():
+      self.state = FAILED if self.cursor.execution_failed() else FINISHED
+
+  def _fetch(self):
+    return self.cursor.fetchall()
+
+  def _cancel(self):
+    self.cursor.cancel_operation()
+
+  def _close(self):
+    # Closing the cursor would close the client's session along with it, so
+    # only the query's operation is closed, and the cursor marked closed so
+    # that it doesn't close the session when it's garbage collected
+    if not self.close_cursor:
+      return
+    try:
+      self.cursor.close_operation()
+    except Exception as e:
+      logger.debug("Error closing operation: {0}".format(e))
+    self.cursor._closed = True
+
+
+class ThreadedQueryHandle(QueryHandle):
+  """
+  A handle for a query run by a driver without an async API (e.g., ODBC).
+
+  Drivers like pyodbc and JayDeBeApi block in native code, out of sight of
+  gevent, so the query is executed and fetched in a background thread, and
+  cancelled from this one with the driver's cancel call (SQLCancel for ODBC,
+  Statement.cancel for JDBC), which are safe to call from another thread.
+  """
+
+  def _start(self):
+    self._run_error = None
+    self._result = get_threadpool().spawn(self._run)
+
+  def _run(self):
+    # Errors (including from cancellation) are kept for _fetch() to raise,
+    # rather than raised in the thread, where gevent would print them
+    try:
+      self.cursor.execute(self.query_str)
+      return self.cursor.fetchall()
+    except Exception as e:
+      self._run_error = e
+
+  def _poll(self):
+    if self._result.ready():
+      self.state = FAILED if self._run_error is not None else FINISHED
+
+  def _fetch(self):
+    rows = self._result.get()
+    if self._run_error is not None:
+      raise self._run_error
+    return rows
+
+  def _cancel(self):
+    if self._result.ready():
+      return
+    cancel = getattr(self.cursor, 'cancel', None)
+    if cancel is None:
+      # JayDeBeApi cursors don't expose cancel(), but their JDBC statement does
+      statement = getattr(self.cursor, '_prep', None)
+      if statement is None:
+        raise NotImplementedError("Cursor {0} doesn't support cancellation".format(
+          type(self.cursor).__name__))
+      cancel = statement.cancel
+    cancel()
+    # Wait for the query's thread to see the cancellation, so the cursor isn't
+    # closed out from under it
+    self._result.wait()
+
+
+def submit_query(client, query_str, query_name):
+  """
+  Submit a query on a DBAPI client, and return a QueryHandle for it.
+
+  A failure to submit the query is logged as a locust failure and raised.
+  """
+  cursor = open_cursor(client)
+  handle_class = (ImpylaQueryHandle if hasattr(cursor, 'execute_async')
+                  else ThreadedQueryHandle)
+  start_time = timer()
+  try:
+    return handle_class(cursor, query_str, query_name,
+                        close_cursor=cursor is not client._cursor)
+  except Exception as e:
+    elapsed = timer() - start_time
+    locust.events.request_failure.fire(
+      request_type="query", name=query_name,
+      response_time=int(elapsed * 1000), response_length=len(str(e)),
+      exception=e, response_time_seconds=elapsed
+    )
+    raise
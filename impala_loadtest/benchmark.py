@@ -0,0 +1,678 @@
+"""
+Benchmarks of the load test harness itself, without a cluster.
+
+There are two suites. The hot_paths suite times the per-query work the
+harness does in-process, over the queries and saved results in workloads/
+and sample_load_tests/, one stage per code path:
+
+  parse_sql_file: parsing and formatting a query file
+  parse_queries_from_file: the same for a multi-query file, with replacements
+  load_yaml_results: loading a saved result set with DataTypeLoader
+  compare_results: the comparison in run_random_query_and_confirm_results,
+    i.e., ResultComparator.compare() under the test's comparison rules,
+    against a result set loaded from yaml
+  compare_compiled_results: the same, against a compiled result set
+  logged_query: DbApiLocustClient.logged_query(), with a client that returns
+    a saved result set at once, so only the timing and events are measured
+  logged_query_detailed: the same, with detailed timing, which fetches from
+    the client's cursor in batches and fires an event for each phase
+
+Each stage reports:
+
+  ops_per_sec: operations per second, in the fastest of several rounds
+  alloc_kb_per_op: peak memory allocated during one operation, on average
+    (with Python 3's tracemalloc)
+  objects_per_op: on Python 2, which has no tracemalloc, the objects tracked
+    by the garbage collector that one operation leaves alive (e.g., in its
+    result), on average, instead
+
+The sample_tests suite runs each sample test for a while against a local
+Impala stand-in (see impala_loadtest.standin), at each of a few user counts,
+with no wait time between tasks, after checking that a client can still run
+queries once it has fetched and cancelled submitted ones (see
+check_async_session()). For each run, the locust process's own CPU time and
+peak memory are taken from the operating system, and the request counts and
+latencies from locust's stats, giving:
+
+  qps: the most queries per second that one locust process could issue
+  cpu_us_per_request: client CPU time per query, in microseconds
+  max_rss_mb: peak resident memory of the locust process
+  client_overhead_ms: average query latency, less the stand-in's mean
+    latency, i.e., the latency added by the client side
+  memory_per_user_kb: extra memory per user, between the lowest and highest
+    user counts
+
+Only the "query" requests are counted, not other request types that the
+tests log (e.g., connect / handshake).
+
+Results can be saved as a baseline, and later runs compared against it, so
+that a change to the harness's hot path can't quietly shrink the load that a
+generator host is able to produce:
+
+  python -m impala_loadtest.benchmark --output baseline.json
+  python -m impala_loadtest.benchmark --baseline baseline.json
+
+Metrics in the baseline that a run doesn't measure (e.g., alloc_kb_per_op,
+when the baseline was saved on Python 3 and the run is on Python 2) are
+listed as skipped.
+
+The stand-in listens on the default HiveServer2 port, which is where the
+sample tests' clients connect to when the coordinator is 127.0.0.1.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import gc
+import glob
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from impala_loadtest import DbApiLocustClient
+from impala_loadtest.common import (LIB_DIR, ComparisonRules,
+                                    load_comparison_rules,
+                                    parse_queries_from_file, parse_sql_file,
+                                    timer)
+from impala_loadtest.results import (RESULTS_EXTENSION, CompiledResultSet,
+                                     compile_results_file, load_yaml_results)
+from impala_loadtest.standin import DEFAULT_PORT, parse_latency
+
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2 has no tracemalloc, so objects are counted instead
+  tracemalloc = None
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.benchmark')
+logger.setLevel(logging.INFO)
+
+REPO_DIR = os.path.dirname(LIB_DIR)
+SAMPLES_DIR = os.path.join(REPO_DIR, 'sample_load_tests')
+
+SUITES = ('hot_paths', 'sample_tests')
+
+# Data for the hot path stages, as glob patterns relative to the repo
+QUERY_FILES = [
+  'sample_load_tests/test_tpcds_load/TPCDS/queries/*.sql',
+  'sample_load_tests/test_tpch_load/TPCH/queries/*.sql',
+  'workloads/*/queries/*.sql',
+]
+MULTI_QUERY_FILES = [
+  'workloads/TPCDS-deterministic/*.sql',
+]
+RESULT_FILES = [
+  'sample_load_tests/test_tpcds_load/TPCDS/scale_factor_10_results/*.yaml',
+  'workloads/*/results/*.yaml',
+]
+
+# Comparison rules for the saved results, as (results directory, rules file)
+# pairs relative to the repo. Results elsewhere are compared exactly.
+COMPARISON_RULES = [
+  ('sample_load_tests/test_tpcds_load/TPCDS/scale_factor_10_results',
+   'sample_load_tests/test_tpcds_load/TPCDS/comparison_rules.yaml'),
+]
+
+# Substitutions for parse_queries_from_file, as a test might use them
+REPLACE_STRINGS = {'tpcds.': 'tpcds_10_decimal_parquet.', 'tpch.': 'tpch_parquet.'}
+
+# The sample tests to benchmark: locust file and config file, relative to
+# sample_load_tests/. The throughput and replay tests stop on their own,
+# after a fixed amount of work, so they aren't included.
+SAMPLE_TESTS = collections.OrderedDict([
+  ('tpcds_load', ('test_tpcds_load/test_tpcds_load.py',
+                  'test_tpcds_load/dc_tpcds_load_test.yaml')),
+  ('impala_stress', ('test_impala_stress/test_tpcds_stress.py',
+                     'test_impala_stress/dc_impala_stress_test.yaml')),
+  ('tpch_load', ('test_tpch_load/test_tpch_load.py',
+                 'test_tpch_load/dc_tpcds_load_test.yaml')),
+  ('dwx_basic', ('test_dwx_basic/test_dwx_load.py',
+                 'test_dwx_basic/dwx_basic_load_params.yaml')),
+])
+
+# Queries the stand-in should recognise, with their saved results if any
+CANNED_QUERIES = [
+  ('sample_load_tests/test_tpcds_load/TPCDS/queries',
+   'sample_load_tests/test_tpcds_load/TPCDS/scale_factor_10_results'),
+  ('sample_load_tests/test_tpch_load/TPCH/queries', None),
+  ('workloads/TPCDS/queries', None),
+]
+
+# Settings applied on top of each sample test's config file, so that it
+# connects to the stand-in and runs flat out
+CONFIG_OVERRIDES = {
+  'coordinator': '127.0.0.1',
+  'client_type': 'ImpylaClient',
+  'auth_type': None,
+  'ssl': False,
+  'thrift_transport': None,
+  'user': None,
+  'password': None,
+  'min_wait': 0,
+  'max_wait': 0,
+  'session_pool_spares': 0,
+  'latency_report': None,
+  'timeseries_file': None,
+  'load_profile': None,
+  'query_profiles': None,
+  'metrics_export': None,
+}
+
+# Whether a higher value of each metric is better, for comparing to a baseline
+METRICS = {
+  'ops_per_sec': True,
+  'alloc_kb_per_op': False,
+  'objects_per_op': False,
+  'qps': True,
+  'cpu_us_per_request': False,
+  'max_rss_mb': False,
+  'client_overhead_ms': False,
+  'memory_per_user_kb': False,
+}
+
+
+def _data_files(patterns):
+  files = []
+  for pattern in patterns:
+    files.extend(sorted(glob.glob(os.path.join(REPO_DIR, pattern))))
+  return files
+
+
+class _CannedCursor(object):
+  """Stands in for a DBAPI cursor, returning the same rows for any query."""
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.position = 0
+
+  def execute(self, query_str):
+    self.position = 0
+
+  def fetchmany(self, size):
+    rows = self.rows[self.position:self.position + size]
+    self.position += len(rows)
+    return rows
+
+
+class _CannedClient(object):
+  """Stands in for a DBAPI client, returning the same rows for any query."""
+
+  def __init__(self, rows):
+    self.rows = rows
+    self._cursor = _CannedCursor(rows)
+
+  def query(self, query_str):
+    return self.rows
+
+
+def _parse_sql_file_stage(work_dir):
+  return parse_sql_file, _data_files(QUERY_FILES)
+
+
+def _parse_queries_from_file_stage(work_dir):
+  return (lambda sql_file: parse_queries_from_file(sql_file, REPLACE_STRINGS),
+          _data_files(MULTI_QUERY_FILES))
+
+
+def _load_yaml_results_stage(work_dir):
+  return load_yaml_results, _data_files(RESULT_FILES)
+
+
+def _comparator(yaml_file):
+  """Return the ResultComparator for a saved result set, under its test's rules."""
+  rules = ComparisonRules()
+  for results_dir, rules_file in COMPARISON_RULES:
+    if os.path.dirname(yaml_file) == os.path.join(REPO_DIR, results_dir):
+      rules = load_comparison_rules(os.path.join(REPO_DIR, rules_file))
+  return rules.get(os.path.basename(yaml_file))
+
+
+def _compare(item):
+  comparator, expected, actual = item
+  return comparator.compare(expected, actual)
+
+
+def _compare_results_stage(work_dir):
+  # Loaded twice, so that equal values aren't also the same objects, which
+  # would let the comparison skip them
+  inputs = [(_comparator(yaml_file), load_yaml_results(yaml_file),
+             load_yaml_results(yaml_file))
+            for yaml_file in _data_files(RESULT_FILES)]
+  return _compare, inputs
+
+
+def _compare_compiled_results_stage(work_dir):
+  inputs = []
+  for yaml_file in _data_files(RESULT_FILES):
+    name = os.path.splitext(os.path.basename(yaml_file))[0]
+    compiled_file = compile_results_file(
+      yaml_file, os.path.join(work_dir, name + RESULTS_EXTENSION))
+    inputs.append((_comparator(yaml_file), CompiledResultSet(compiled_file),
+                   load_yaml_results(yaml_file)))
+  return _compare, inputs
+
+
+def _logged_query_stage(work_dir, detailed_timing=False):
+  # A typical result set, from the middle of the range of sizes
+  results = sorted((load_yaml_results(yaml_file) for yaml_file in
+                    _data_files(RESULT_FILES)), key=len)
+  client = DbApiLocustClient()
+  client._dbapi_client = _CannedClient(results[len(results) // 2])
+  query_files = _data_files(QUERY_FILES[:1])
+  return (lambda query_name: client.logged_query('select 1', query_name=query_name,
+                                                 detailed_timing=detailed_timing),
+          [os.path.basename(query_file) for query_file in query_files])
+
+
+def _logged_query_detailed_stage(work_dir):
+  return _logged_query_stage(work_dir, detailed_timing=True)
+
+
+# The hot path stages: each is set up with a scratch directory, and returns
+# an operation and the inputs to run it on, one operation per input
+HOT_PATHS = collections.OrderedDict([
+  ('parse_sql_file', _parse_sql_file_stage),
+  ('parse_queries_from_file', _parse_queries_from_file_stage),
+  ('load_yaml_results', _load_yaml_results_stage),
+  ('compare_results', _compare_results_stage),
+  ('compare_compiled_results', _compare_compiled_results_stage),
+  ('logged_query', _logged_query_stage),
+  ('logged_query_detailed', _logged_query_detailed_stage),
+])
+
+
+def time_operation(operation, inputs, rounds=5):
+  """
+  Return the operations per second of running operation on each of the
+  inputs, in the fastest of several rounds. The garbage collector is left
+  on, since its cost is part of the cost of allocating.
+  """
+  best = None
+  for _ in range(rounds):
+    start_time = timer()
+    for item in inputs:
+      operation(item)
+    elapsed = timer() - start_time
+    if best is None or elapsed < best:
+      best = elapsed
+  return len(inputs) / best if best else float('inf')
+
+
+def measure_allocations(operation, inputs):
+  """
+  Measure the memory allocated by running operation on each of the inputs.
+
+  Returns:
+    a (metric, value) tuple: alloc_kb_per_op, the average peak memory
+    allocated, in KB, or without tracemalloc, objects_per_op, the average
+    number of objects tracked by the garbage collector that were left alive
+  """
+  if tracemalloc is None:
+    total = 0
+    results = []
+    for item in inputs:
+      gc.collect()
+      before = len(gc.get_objects())
+      # Each result is kept until it's been counted, as a caller would keep it
+      results.append(operation(item))
+      gc.collect()
+      total += len(gc.get_objects()) - before
+      del results[:]
+    return 'objects_per_op', float(total) / len(inputs)
+
+  total = 0
+  for item in inputs:
+    tracemalloc.start()
+    try:
+      operation(item)
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+    total += peak
+  return 'alloc_kb_per_op', total / 1024.0 / len(inputs)
+
+
+def run_hot_paths(stage_names=None, rounds=5):
+  """
+  Run the hot path benchmarks, and return the results.
+
+  Returns:
+    a dict of benchmark names, e.g., 'hot_paths/parse_sql_file', to dicts of
+    metrics
+  """
+  results = collections.OrderedDict()
+  work_dir = tempfile.mkdtemp(prefix='impala_loadtest_benchmark_')
+  try:
+    for name in stage_names or HOT_PATHS:
+      operation, inputs = HOT_PATHS[name](work_dir)
+      if not inputs:
+        logger.warning("No data for the {0} benchmark; skipping it".format(name))
+        continue
+      logger.info("Benchmarking {0}, over {1} inputs".format(name, len(inputs)))
+      metrics = {
+        'ops': len(inputs),
+        'ops_per_sec': time_operation(operation, inputs, rounds),
+      }
+      metric, value = measure_allocations(operation, inputs)
+      metrics[metric] = value
+      results['hot_paths/{0}'.format(name)] = metrics
+  finally:
+    shutil.rmtree(work_dir)
+  return results
+
+
+class StandIn(object):
+  """Runs the Impala stand-in in a subprocess, for the duration of a with block."""
+
+  def __init__(self, latency='fixed:0', port=DEFAULT_PORT, startup_timeout=120):
+    self.latency = latency
+    self.port = port
+    self.startup_timeout = startup_timeout
+    self._process = None
+
+  def __enter__(self):
+    cmd = [sys.executable, '-m', 'impala_loadtest.standin',
+           '--port', str(self.port), '--latency', self.latency]
+    for queries_dir, results_dir in CANNED_QUERIES:
+      queries_dir = os.path.join(REPO_DIR, queries_dir)
+      if os.path.isdir(queries_dir):
+        spec = queries_dir
+        if results_dir is not None:
+          spec += ':' + os.path.join(REPO_DIR, results_dir)
+        cmd += ['--canned', spec]
+    self._process = subprocess.Popen(cmd)
+
+    # Loading uncompiled results can take a while, so wait for the port
+    deadline = time.time() + self.startup_timeout
+    while time.time() < deadline:
+      if self._process.poll() is not None:
+        raise RuntimeError("The Impala stand-in failed to start")
+      try:
+        socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+        return self
+      except socket.error:
+        time.sleep(0.5)
+    self.__exit__()
+    raise RuntimeError("The Impala stand-in didn't start listening in time")
+
+  def __exit__(self, *exc_info):
+    if self._process.poll() is None:
+      self._process.terminate()
+      self._process.wait()
+
+
+def _max_rss_mb(rusage):
+  # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+  if sys.platform == 'darwin':
+    return rusage.ru_maxrss / float(2 ** 20)
+  return rusage.ru_maxrss / 1024.0
+
+
+def _read_query_stats(stats_file):
+  """
+  Return the total requests (which, in locust's stats, include failures),
+  failures, requests per second and average latency in milliseconds of the
+  "query" requests in a locust stats csv file.
+  """
+  requests = failures = 0
+  qps = total_latency_ms = 0.0
+  with open(stats_file) as infile:
+    for row in csv.DictReader(infile):
+      if row['Type'] != 'query':
+        continue
+      count = int(row['# requests'])
+      requests += count
+      failures += int(row['# failures'])
+      qps += float(row['Requests/s'])
+      total_latency_ms += float(row['Average response time']) * count
+  avg_latency_ms = total_latency_ms / requests if requests else 0.0
+  return requests, failures, qps, avg_latency_ms
+
+
+def run_sample_test(test_name, users, duration, work_dir, mean_latency=0.0):
+  """
+  Run one sample test in its own locust process, and measure it.
+
+  Returns a dict of the metrics for the run (see the module docstring).
+  """
+  locustfile, config_file = [os.path.join(SAMPLES_DIR, path)
+                             for path in SAMPLE_TESTS[test_name]]
+  with open(config_file) as infile:
+    config = yaml.safe_load(infile)
+  config.update(CONFIG_OVERRIDES)
+  run_config = os.path.join(work_dir, '{0}_{1}.yaml'.format(test_name, users))
+  with open(run_config, 'w') as outfile:
+    yaml.safe_dump(config, outfile, default_flow_style=False)
+
+  csv_base = os.path.join(work_dir, '{0}_{1}'.format(test_name, users))
+  cmd = [sys.executable, '-m', 'locust', '-f', locustfile, '--no-web',
+         '-c', str(users), '-r', str(users), '--run-time', '{0}s'.format(duration),
+         '--csv', csv_base, '--only-summary']
+  env = dict(os.environ, CONFIG=run_config)
+  with open(csv_base + '.log', 'w') as log:
+    process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    # wait4() gives the resource usage of this process alone
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = status
+
+  requests, failures, qps, avg_latency_ms = _read_query_stats(csv_base + '_stats.csv')
+  if not requests:
+    raise RuntimeError("{0} made no queries; see {1}.log".format(test_name, csv_base))
+  return {
+    'users': users,
+    'requests': requests,
+    'failures': failures,
+    'qps': qps,
+    'cpu_us_per_request': (rusage.ru_utime + rusage.ru_stime) / requests * 1e6,
+    'max_rss_mb': _max_rss_mb(rusage),
+    'client_overhead_ms': avg_latency_ms - mean_latency * 1000,
+  }
+
+
+def check_async_session():
+  """
+  Check, against the stand-in, that a client can still run queries after a
+  query it submitted has been fetched, and after one has been cancelled,
+  i.e., that query handles leave the client's own session open.
+
+  Raises:
+    AssertionError if a query handle closed the client's session
+  """
+  client = DbApiLocustClient()
+  client.hatch(CONFIG_OVERRIDES['coordinator'], **dict(
+    (key, CONFIG_OVERRIDES[key]) for key in
+    ('client_type', 'auth_type', 'ssl', 'thrift_transport', 'user', 'password')))
+  try:
+    for end in ('fetch', 'cancel'):
+      handle = client.submit('select 1', query_name='check_async_session')
+      getattr(handle, end)()
+      try:
+        client.query('select 1')
+      except Exception as e:
+        raise AssertionError("The client's session didn't survive a query handle's "
+                             "{0}(): {1}".format(end, e))
+  finally:
+    try:
+      client.disconnect()
+    except Exception as e:
+      logger.debug("Error disconnecting: {0}".format(e))
+
+
+def run_sample_tests(test_names, user_counts, duration, latency='fixed:0',
+                     port=DEFAULT_PORT):
+  """
+  Run the sample test benchmarks against a stand-in, and return the results.
+
+  Returns:
+    a dict of benchmark names, e.g., 'sample_tests/tpcds_load/10u', to dicts
+    of metrics
+  """
+  mean_latency = parse_latency(latency).mean
+  user_counts = sorted(user_counts)
+  results = collections.OrderedDict()
+  work_dir = tempfile.mkdtemp(prefix='impala_loadtest_benchmark_')
+  try:
+    with StandIn(latency, port):
+      check_async_session()
+      for test_name in test_names:
+        runs = []
+        for users in user_counts:
+          logger.info("Benchmarking {0} with {1} users".format(test_name, users))
+          run = run_sample_test(test_name, users, duration, work_dir, mean_latency)
+          results['sample_tests/{0}/{1}u'.format(test_name, users)] = run
+          runs.append(run)
+        if len(runs) > 1:
+          extra_users = runs[-1]['users'] - runs[0]['users']
+          extra_kb = (runs[-1]['max_rss_mb'] - runs[0]['max_rss_mb']) * 1024
+          results['sample_tests/' + test_name] = {'memory_per_user_kb': extra_kb / extra_users}
+  except Exception:
+    logger.error("Benchmark logs and stats are in {0}".format(work_dir))
+    raise
+  shutil.rmtree(work_dir)
+  return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+  """
+  Return a description of each metric that is worse than its baseline value
+  by more than tolerance (a fraction of the baseline value).
+  """
+  regressions = []
+  for name, metrics in results.items():
+    for metric, value in metrics.items():
+      if metric not in METRICS or metric not in baseline.get(name, {}):
+        continue
+      expected = baseline[name][metric]
+      margin = abs(expected) * tolerance
+      worse = value < expected - margin if METRICS[metric] else value > expected + margin
+      if worse:
+        regressions.append("{0} {1}: {2:.4g} (baseline {3:.4g})".format(
+          name, metric, value, expected))
+  return regressions
+
+
+def skipped_metrics(results, baseline):
+  """
+  Return a description of each metric in the baseline that wasn't measured
+  for a benchmark that was run, e.g., alloc_kb_per_op on Python 2.
+  """
+  skipped = []
+  for name, metrics in results.items():
+    for metric in sorted(baseline.get(name, {})):
+      if metric in METRICS and metric not in metrics:
+        skipped.append("{0} {1}: not measured in this run".format(name, metric))
+  return skipped
+
+
+def format_results(results):
+  """Return the results as lines of a table, one benchmark per line."""
+  metrics = sorted(set(metric for values in results.values() for metric in values
+                       if metric in METRICS))
+  width = max(len(name) for name in results)
+  lines = [' '.join(['{0:<{1}}'.format('Benchmark', width)] +
+                    ['{0:>18}'.format(metric) for metric in metrics])]
+  for name, values in results.items():
+    cells = ['{0:>18}'.format('' if metric not in values else
+                              '{0:.2f}'.format(values[metric]))
+             for metric in metrics]
+    lines.append(' '.join(['{0:<{1}}'.format(name, width)] + cells))
+  return lines
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description="Measure the throughput, CPU and memory cost of the load test "
+                "harness: its hot paths in-process, and the sample tests against "
+                "a local Impala stand-in.")
+  parser.add_argument('--suites', default=','.join(SUITES),
+                      help="Comma-separated suites to run (default: %(default)s)")
+  parser.add_argument('--stages', default=','.join(HOT_PATHS),
+                      help="Comma-separated hot path stages to run "
+                           "(default: %(default)s)")
+  parser.add_argument('--rounds', type=int, default=5,
+                      help="Times to repeat each hot path stage, keeping the "
+                           "fastest (default: %(default)s)")
+  parser.add_argument('--tests', default=','.join(SAMPLE_TESTS),
+                      help="Comma-separated sample tests to run (default: %(default)s)")
+  parser.add_argument('--users', default='1,20',
+                      help="Comma-separated user counts to run each test with "
+                           "(default: %(default)s)")
+  parser.add_argument('--duration', type=int, default=30,
+                      help="Seconds to run each test for (default: %(default)s)")
+  parser.add_argument('--latency', default='fixed:0',
+                      help="Stand-in query latency; see impala_loadtest.standin "
+                           "(default: %(default)s)")
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                      help="Port for the stand-in (default: %(default)s)")
+  parser.add_argument('--output', help="File to save the results to, as JSON")
+  parser.add_argument('--baseline',
+                      help="JSON results of an earlier run to compare against; "
+                           "exits with status 1 on any regression")
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help="Fraction by which a metric may be worse than its "
+                           "baseline (default: %(default)s)")
+  return parser
+
+
+def _split_names(value, known, description):
+  names = [name.strip() for name in value.split(',') if name.strip()]
+  unknown = set(names) - set(known)
+  if unknown:
+    raise ValueError("Unknown {0}: {1}".format(description, ', '.join(sorted(unknown))))
+  return names
+
+
+def main(argv=None):
+  options = get_parser().parse_args(argv)
+  try:
+    suites = _split_names(options.suites, SUITES, 'suites')
+    stage_names = _split_names(options.stages, HOT_PATHS, 'hot path stages')
+    test_names = _split_names(options.tests, SAMPLE_TESTS, 'sample tests')
+  except ValueError as e:
+    logger.error(str(e))
+    return 2
+
+  results = collections.OrderedDict()
+  if 'hot_paths' in suites:
+    hot_paths = run_hot_paths(stage_names, options.rounds)
+    for line in format_results(hot_paths):
+      print(line)
+    print()
+    results.update(hot_paths)
+  if 'sample_tests' in suites:
+    sample_tests = run_sample_tests(
+      test_names, [int(users) for users in options.users.split(',')],
+      options.duration, options.latency, options.port)
+    for line in format_results(sample_tests):
+      print(line)
+    print()
+    results.update(sample_tests)
+
+  if options.output:
+    with open(options.output, 'w') as outfile:
+      json.dump(results, outfile, indent=2)
+
+  if options.baseline:
+    with open(options.baseline) as infile:
+      baseline = json.load(infile)
+    for skipped in skipped_metrics(results, baseline):
+      print("SKIPPED: {0}".format(skipped))
+    regressions = compare_to_baseline(results, baseline, options.tolerance)
+    for regression in regressions:
+      print("REGRESSION: {0}".format(regression))
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+Capture the expected results of a workload's queries from a reference cluster.
+
+Every query in workloads/<workload>/queries is run against the cluster, by a
+number of sessions in parallel, and its results are streamed, a batch of rows
+at a time, into two files in workloads/<workload>/results/scale_<N>:
+
+  <query>.rset: the result set, in the compiled format of
+    impala_loadtest.results, as read by ExpectedResults
+  <query>.digest: the ResultDigest of the result set, as read by
+    ExpectedDigests, for validation_mode: digest
+
+The results directory is created if it doesn't exist yet. Unlike the .rset
+files compiled from saved yaml results, which are ignored by git as build
+output, captured .rset files are the only copy of the results, so they can
+be committed for others to validate against. Run it with, e.g.:
+
+  python -m impala_loadtest.capture --workload TPCDS --scale 10 \\
+      --config sample_load_tests/test_tpcds_load/dc_tpcds_load_test.yaml \\
+      --target-db tpcds_10_decimal_parquet --parallelism 8
+
+A manifest (capture.manifest, as yaml) in the results directory records, for
+each query, a hash of the query text, its row count and digests, how long it
+took, and any error. Running the capture again only runs the queries that
+failed, are new, or whose text has changed since they were captured, so an
+interrupted capture picks up where it left off; --force runs everything
+again. Queries that took longest last time are started first, so that a
+long query doesn't start last and hold up the end of the capture.
+
+Sessions are greenlets. Queries overlap while they wait on the cluster as long
+as the client library's network I/O cooperates with gevent, as
+ImpylaClient's does; with a client that blocks in C code (e.g., ODBC), run one
+capture per subset of --queries instead.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import fnmatch
+import gevent
+import hashlib
+import logging
+import os
+import sys
+import yaml
+
+from gevent.queue import Empty, Queue
+
+import qe_client_lib.dbapi_clients as client_lib
+
+from impala_loadtest.common import QueryCatalog, Workloads, timer
+from impala_loadtest.results import RESULTS_EXTENSION, ResultSetWriter
+from impala_loadtest.validation import DEFAULT_BATCH_SIZE, DIGEST_EXTENSION, ResultDigest
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.capture')
+
+# Name of the manifest file in a results directory. It's yaml, but doesn't
+# have a .yaml extension, so it isn't mistaken for a saved result set.
+MANIFEST_FILE = 'capture.manifest'
+
+# Connection settings read from a test config file, as the sample tests do
+CLIENT_SETTINGS = ('client_type', 'auth_type', 'ssl', 'thrift_transport', 'user',
+                   'password')
+
+
+def query_hash(query_str):
+  """Return a short hash of a query's text, to tell when it has changed."""
+  return hashlib.sha1(query_str.encode('utf-8')).hexdigest()[:16]
+
+
+def _write_yaml(path, data):
+  tmp_file = '{0}.tmp.{1}'.format(path, os.getpid())
+  with open(tmp_file, 'w') as outfile:
+    yaml.safe_dump(data, outfile, default_flow_style=False)
+  os.rename(tmp_file, path)
+
+
+def load_manifest(results_dir):
+  """Return the capture manifest of a results directory, or {} if it has none."""
+  manifest_file = os.path.join(results_dir, MANIFEST_FILE)
+  if not os.path.exists(manifest_file):
+    return {}
+  with open(manifest_file) as infile:
+    return yaml.safe_load(infile) or {}
+
+
+def connect(host, target_db=None, client_type="ImpylaClient", **client_kwargs):
+  """
+  Open a DBAPI client session, with the target database selected.
+
+  Args:
+    host: FQDN to the coordinator
+    target_db: database to select, if any
+    client_type: name of the DBAPI client class to instantiate
+    client_kwargs: a dictionary of parameters needed to make a connection
+  """
+  ClientType = getattr(client_lib, client_type)
+  client = ClientType(host, **client_kwargs)
+  if target_db is not None:
+    client.query('use {target_db}'.format(target_db=target_db))
+  return client
+
+
+def capture_query(cursor, query_str, results_dir, query_name,
+                  batch_size=DEFAULT_BATCH_SIZE):
+  """
+  Run a query, and stream its results into a .rset and a .digest file.
+
+  At most batch_size rows are held in memory at any one time. Neither file is
+  written unless the whole result set was fetched.
+
+  Args:
+    cursor: a DBAPI cursor, with the target database already selected
+    query_str: the query to execute
+    results_dir: directory to write the files to
+    query_name: base name of the files
+    batch_size: number of rows to fetch from the cursor at a time
+
+  Returns:
+    the manifest entry for the query, as a dict
+  """
+  writer = ResultSetWriter(os.path.join(results_dir, query_name + RESULTS_EXTENSION))
+  digest = ResultDigest()
+
+  start_time = timer()
+  try:
+    cursor.execute(query_str)
+    while True:
+      rows = cursor.fetchmany(batch_size)
+      if not rows:
+        break
+      writer.write(rows)
+      digest.update(rows)
+  except Exception:
+    writer.discard()
+    raise
+  elapsed = timer() - start_time
+
+  writer.close()
+  _write_yaml(os.path.join(results_dir, query_name + DIGEST_EXTENSION),
+              digest.to_dict())
+
+  entry = digest.to_dict()
+  entry.update(query_hash=query_hash(query_str), seconds=round(elapsed, 3),
+               captured=datetime.datetime.utcnow().isoformat() + 'Z', error=None)
+  return entry
+
+
+class ResultCapture(object):
+  """
+  Captures the results of a set of queries into a results directory, running
+  them in parallel sessions, and keeping the directory's manifest up to date.
+  """
+
+  def __init__(self, results_dir, host, target_db=None, parallelism=4,
+               batch_size=DEFAULT_BATCH_SIZE, client_type="ImpylaClient",
+               **client_kwargs):
+    """
+    Args:
+      results_dir: directory to write the results and manifest to
+      host: FQDN of the reference cluster's coordinator
+      target_db: database to select in each session, if any
+      parallelism: number of sessions to run queries in at once
+      batch_size: number of rows to fetch from the cursor at a time
+      client_type: name of the DBAPI client class to instantiate
+      client_kwargs: a dictionary of parameters needed to make a connection
+    """
+    self.results_dir = results_dir
+    self.host = host
+    self.target_db = target_db
+    self.parallelism = parallelism
+    self.batch_size = batch_size
+    self.client_type = client_type
+    self.client_kwargs = client_kwargs
+    self.manifest = load_manifest(results_dir)
+
+  def is_current(self, query_name, query_str):
+    """Whether a query's captured results are complete and up to date."""
+    entry = self.manifest.get(query_name)
+    return bool(
+      entry and not entry.get('error') and
+      entry.get('query_hash') == query_hash(query_str) and
+      os.path.exists(os.path.join(self.results_dir, query_name + RESULTS_EXTENSION)) and
+      os.path.exists(os.path.join(self.results_dir, query_name + DIGEST_EXTENSION)))
+
+  def run(self, queries, force=False):
+    """
+    Capture the results of any queries that aren't current (or all of them,
+    with force).
+
+    Args:
+      queries: a dict of query name -> query string
+
+    Returns:
+      a list of the names of the queries that were captured, and a list of
+      the names of those that failed or weren't run
+    """
+    pending = [name for name in queries
+               if force or not self.is_current(name, queries[name])]
+    skipped = len(queries) - len(pending)
+    if skipped:
+      logger.info("Skipping {0} queries with current results".format(skipped))
+    # Longest first, by the time each took when it was last captured
+    pending.sort(key=lambda name: (
+      -(self.manifest.get(name) or {}).get('seconds', 0), name))
+
+    self._queue = Queue()
+    for name in pending:
+      self._queue.put((name, queries[name]))
+    self._total = len(pending)
+    self._done = 0
+    self._captured = []
+
+    workers = [gevent.spawn(self._worker, i)
+               for i in range(min(self.parallelism, len(pending)))]
+    gevent.joinall(workers)
+
+    failed = [name for name in pending if name not in self._captured]
+    return self._captured, failed
+
+  def _connect(self):
+    return connect(self.host, self.target_db, self.client_type, **self.client_kwargs)
+
+  def _worker(self, worker_id):
+    try:
+      client = self._connect()
+    except Exception as e:
+      logger.error("Session {0} couldn't connect: {1}".format(worker_id, e))
+      return
+
+    while True:
+      try:
+        query_name, query_str = self._queue.get_nowait()
+      except Empty:
+        break
+
+      try:
+        entry = capture_query(client._cursor, query_str, self.results_dir,
+                              query_name, self.batch_size)
+      except Exception as e:
+        logger.error("{0} failed: {1}".format(query_name, e))
+        entry = {'query_hash': query_hash(query_str), 'error': str(e)}
+        try:
+          # Start the next query with a fresh session
+          client.disconnect()
+          client = self._connect()
+        except Exception as e:
+          logger.error("Session {0} couldn't reconnect: {1}".format(worker_id, e))
+          self._record(query_name, entry)
+          break
+      else:
+        self._captured.append(query_name)
+
+      self._record(query_name, entry)
+      if not entry['error']:
+        logger.info("[{0}/{1}] {2}: {3} rows in {4:.1f}s".format(
+          self._done, self._total, query_name, entry['row_count'], entry['seconds']))
+
+    try:
+      client.disconnect()
+    except Exception:
+      pass
+
+  def _record(self, query_name, entry):
+    # Saved after every query, so an interrupted capture keeps its progress
+    self._done += 1
+    self.manifest[query_name] = entry
+    _write_yaml(os.path.join(self.results_dir, MANIFEST_FILE), self.manifest)
+
+
+def load_queries(queries_dir, patterns=None):
+  """
+  Return the queries in a directory of .sql files, as an ordered list of
+  (query name, query string) pairs, where a query's name is its file name
+  without the extension.
+
+  Args:
+    patterns: if given, only the files matching one of these glob patterns
+      (e.g., tpcds-0*.sql) are included
+  """
+  catalog = QueryCatalog(queries_dir, refresh_interval=None)
+  queries = []
+  for query_file in catalog.names:
+    if patterns and not any(fnmatch.fnmatch(query_file, pattern) for pattern in patterns):
+      continue
+    queries.append((os.path.splitext(query_file)[0], catalog[query_file]))
+  return queries
+
+
+def add_connection_arguments(parser):
+  """Add the options for connecting to a cluster to an ArgumentParser."""
+  parser.add_argument('--config',
+                      help="Test config file to read the coordinator, client "
+                           "settings and target_db from")
+  parser.add_argument('--coordinator', help="Coordinator to connect to")
+  parser.add_argument('--client-type', help="DBAPI client class (default: ImpylaClient)")
+  parser.add_argument('--target-db', help="Database to run the queries in")
+
+
+def connection_settings(options):
+  """
+  Return the host, target database and client kwargs (including client_type)
+  to connect with, from the options added by add_connection_arguments(). The
+  command line takes precedence over the config file.
+  """
+  config = {}
+  if options.config:
+    with open(options.config) as fh:
+      config = yaml.safe_load(fh) or {}
+  client_kwargs = dict((key, config[key]) for key in CLIENT_SETTINGS
+                       if config.get(key) is not None)
+  if options.client_type:
+    client_kwargs['client_type'] = options.client_type
+  return (options.coordinator or config.get('coordinator'),
+          options.target_db or config.get('target_db'), client_kwargs)
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description="Run every query of a workload against a reference cluster, and "
+                "save the results as the workload's expected results at a scale "
+                "factor.")
+  parser.add_argument('--workload', required=True,
+                      help="Workload under workloads/, e.g., TPCDS")
+  parser.add_argument('--scale', required=True,
+                      help="Scale factor; results go in results/scale_<scale>")
+  add_connection_arguments(parser)
+  parser.add_argument('--parallelism', type=int, default=4,
+                      help="Queries to run at once (default: %(default)s)")
+  parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                      help="Rows to fetch at a time (default: %(default)s)")
+  parser.add_argument('--queries', action='append',
+                      help="Glob pattern of the query files to capture, e.g., "
+                           "'tpcds-0*.sql'; may be repeated (default: all)")
+  parser.add_argument('--force', action='store_true',
+                      help="Capture every query again, even if its results are current")
+  return parser
+
+
+def main(argv=None):
+  options = get_parser().parse_args(argv)
+
+  host, target_db, client_kwargs = connection_settings(options)
+  if not host:
+    print("A coordinator is needed, from --coordinator or --config", file=sys.stderr)
+    return 2
+
+  queries = load_queries(Workloads.get_queries_directory(options.workload),
+                         options.queries)
+  if not queries:
+    print("No queries to capture", file=sys.stderr)
+    return 2
+  results_dir = Workloads.get_results_directory(options.workload, options.scale,
+                                                create=True)
+
+  logger.setLevel(logging.INFO)
+  logger.info("Capturing {0} queries from {1} into {2}".format(
+    len(queries), host, results_dir))
+  capture = ResultCapture(results_dir, host,
+                          target_db=target_db,
+                          parallelism=options.parallelism,
+                          batch_size=options.batch_size, **client_kwargs)
+  start_time = timer()
+  captured, failed = capture.run(dict(queries), force=options.force)
+
+  logger.info("Captured {0} queries in {1:.0f}s".format(len(captured), timer() - start_time))
+  if failed:
+    logger.error("Not captured: {0}".format(', '.join(sorted(failed))))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,13 +1,25 @@
 """Common classes and helpers for setting up a Locaust load test of Impala."""
 
+import itertools
 import logging
+import operator
 import os
 import re
+import six
 import sqlparse
+import sys
+import time
 import yaml
 
 from decimal import Decimal
 
+try:
+  # Monotonic, high-resolution clock for measuring durations
+  from time import perf_counter as timer
+except ImportError:
+  # Python 2 has no monotonic clock in the standard library
+  from timeit import default_timer as timer
+
 logging.basicConfig()
 logger = logging.getLogger(__file__)
 
@@ -19,6 +31,9 @@ class Workloads(object):
 
   BASE_DIR = os.path.abspath(os.path.join(LIB_DIR, os.pardir, 'workloads'))
 
+  # Shared QueryCatalog instances, keyed by workload name
+  _catalogs = {}
+
   @classmethod
   def get_workload_root(cls, workload_name):
     workload_root = os.path.join(cls.BASE_DIR, workload_name)
@@ -35,14 +50,152 @@ class Workloads(object):
     return queries_dir
 
   @classmethod
-  def get_results_directory(cls, workload_name, scale):
+  def get_results_directory(cls, workload_name, scale, create=False):
     """
+    Return the directory of expected results for a workload at a scale factor.
+
+    Args:
+      create: make the directory if it doesn't exist yet, e.g., when
+        capturing results with impala_loadtest.capture
     """
     workload_root = cls.get_workload_root(workload_name)
     results_dir = os.path.join(workload_root, 'results', 'scale_{}'.format(scale))
+    if create and not os.path.exists(results_dir):
+      os.makedirs(results_dir)
     assert os.path.exists(results_dir), "Invalid directory: {}".format(results_dir)
     return results_dir
 
+  @classmethod
+  def get_mixes_directory(cls, workload_name):
+    """
+    Return the directory of workload mix definitions for a workload.
+    """
+    return os.path.join(cls.get_workload_root(workload_name), 'mixes')
+
+  @classmethod
+  def get_templates_directory(cls, workload_name):
+    """
+    Return the directory of parameterised query templates for a workload.
+    """
+    workload_root = cls.get_workload_root(workload_name)
+    templates_dir = os.path.join(workload_root, 'templates')
+    assert os.path.exists(templates_dir), "Invalid directory: {}".format(templates_dir)
+    return templates_dir
+
+  @classmethod
+  def get_query_catalog(cls, workload_name):
+    """
+    Return the shared QueryCatalog for a workload, creating it on first use.
+
+    All locusts in a process share the same catalog, so each query file is
+    parsed at most once per process (or once per edit).
+    """
+    if workload_name not in cls._catalogs:
+      cls._catalogs[workload_name] = QueryCatalog(
+        cls.get_queries_directory(workload_name))
+    return cls._catalogs[workload_name]
+
+
+class QueryCatalog(object):
+  """
+  Formatted queries from a directory of .sql files, keyed by file name.
+
+  Each file is run through parse_sql_file() once, and the formatted query is
+  cached, so that looking up a query from inside a task is a dict lookup
+  rather than a file read plus an sqlparse pass. Files are parsed lazily on
+  first lookup, or all at once by calling load().
+
+  The directory is re-scanned at most once every refresh_interval seconds.
+  Files whose mtime has changed are re-parsed on their next lookup, new files
+  are picked up, and deleted files are dropped. Set refresh_interval to None
+  to disable the check entirely.
+  """
+
+  def __init__(self, queries_dir, extension='.sql', refresh_interval=5.0,
+               preload=False):
+    """
+    Args:
+      queries_dir: full path to a directory of query files
+      extension: only files with this extension are included in the catalog
+      refresh_interval: minimum number of seconds between mtime checks
+      preload: if True, parse every query file immediately
+    """
+    assert os.path.isdir(queries_dir), "Invalid directory: {}".format(queries_dir)
+    self.queries_dir = queries_dir
+    self.extension = extension
+    self.refresh_interval = refresh_interval
+
+    self._mtimes = {}   # query file -> mtime when last scanned
+    self._queries = {}  # query file -> (mtime when parsed, formatted query)
+    self._names = []
+    self._last_refresh = None
+    self.refresh()
+
+    if preload:
+      self.load()
+
+  @property
+  def names(self):
+    """Sorted list of the query file names in the catalog."""
+    self._maybe_refresh()
+    return self._names
+
+  def load(self):
+    """Parse (or re-parse) every query that is missing or out of date."""
+    for query_file in self.names:
+      self.get(query_file)
+    return self
+
+  def refresh(self):
+    """Re-scan the directory, recording the current mtime of each file."""
+    mtimes = {}
+    for query_file in os.listdir(self.queries_dir):
+      if query_file.endswith(self.extension):
+        mtimes[query_file] = os.path.getmtime(
+          os.path.join(self.queries_dir, query_file))
+
+    for query_file in set(self._queries) - set(mtimes):
+      del self._queries[query_file]
+
+    self._mtimes = mtimes
+    self._names = sorted(mtimes)
+    self._last_refresh = time.time()
+
+  def get(self, query_file):
+    """
+    Return the formatted query for a given file name, e.g., '1.sql'.
+
+    Raises KeyError if there is no such query file in the catalog.
+    """
+    self._maybe_refresh()
+    mtime = self._mtimes[query_file]
+    cached = self._queries.get(query_file)
+
+    if cached is None or cached[0] != mtime:
+      logger.debug('Parsing query file: {0}'.format(query_file))
+      query_str = parse_sql_file(os.path.join(self.queries_dir, query_file))
+      cached = self._queries[query_file] = (mtime, query_str)
+
+    return cached[1]
+
+  def _maybe_refresh(self):
+    if self.refresh_interval is None:
+      return
+    if time.time() - self._last_refresh >= self.refresh_interval:
+      self.refresh()
+
+  def __getitem__(self, query_file):
+    return self.get(query_file)
+
+  def __contains__(self, query_file):
+    return query_file in self._mtimes
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def __len__(self):
+    return len(self._mtimes)
+
 
 class DataTypeLoader(yaml.SafeLoader):
   """
@@ -81,6 +234,22 @@ def get_node_hostnames(cm_host):
   raise NotImplementedError("cm_api module is deprecated: need to use cm_client")
 
 
+def result_size(rows):
+  """
+  Return the number of bytes of Python objects held by a fetched result set.
+
+  Unlike sys.getsizeof(rows), which only measures the outer list, this
+  includes each row tuple and each of the values in it.
+  """
+  getsizeof = sys.getsizeof
+  size = getsizeof(rows)
+  for row in rows:
+    size += getsizeof(row)
+    for value in row:
+      size += getsizeof(value)
+  return size
+
+
 def parse_sql_file(sql_file):
   """
   Parse .sql file, and return formatted query as a string.
@@ -103,9 +272,10 @@ def parse_queries_from_file(sql_file, replace_strings=None):
     sql_file: full path to a text file containing any number of queries,
       delineated by semi-colons.
 
-    replace_strings: a dict in which the keys are regexes to replace in
-      the final queries, and the values are the strings to replace any
-      substring matching the regex.
+    replace_strings: a dict in which the keys are substrings to replace in
+      the final queries, and the values are their replacements. For values
+      that should change from one execution to the next, use a query
+      template (impala_loadtest.templates) instead.
 
   """
   with open(sql_file) as fh:
@@ -115,8 +285,329 @@ def parse_queries_from_file(sql_file, replace_strings=None):
 
   raw_sql = sqlparse.format(file_contents, reindent=True, keyword_case='upper')
 
-  if replace_strings is not None:
-    for pattern, replacement in replace_strings.iteritems():
-      raw_sql = re.sub(re.escape(pattern), replacement, raw_sql)
+  if replace_strings:
+    # One pass over the text for all of the substrings, longest first
+    pattern = re.compile('|'.join(
+      re.escape(key) for key in sorted(replace_strings, key=len, reverse=True)))
+    raw_sql = pattern.sub(lambda match: replace_strings[match.group(0)], raw_sql)
   return [q.strip() for q in raw_sql.split(';') if q.strip()]
 
+
+# Types of the values that a numeric tolerance applies to (but not bool)
+NUMBER_TYPES = six.integer_types + (float, Decimal)
+
+
+def _is_number(value):
+  return isinstance(value, NUMBER_TYPES) and not isinstance(value, bool)
+
+
+def _sort_key(row):
+  """
+  Return a key that orders rows by value, even when a column mixes types
+  (e.g., NULLs among numbers), which Python 3 can't compare directly. Only
+  used when the rows can't be sorted as they are, since it's much slower.
+  """
+  key = []
+  for value in row:
+    if value is None:
+      key.append((0, 0))
+    elif _is_number(value):
+      value = float(value)
+      key.append((1, value if value == value else float('-inf')))  # NaN first
+    elif isinstance(value, six.string_types):
+      key.append((2, value))
+    else:
+      key.append((3, type(value).__name__, value))
+  return tuple(key)
+
+
+def _sorted_rows(rows):
+  try:
+    return sorted(rows)
+  except TypeError:
+    return sorted(rows, key=_sort_key)
+
+
+def _sorted_values(values):
+  """Sort the values of a column, even when it mixes types."""
+  values = list(values)
+  try:
+    return sorted(values)
+  except TypeError:
+    return [row[0] for row in sorted(((value,) for value in values), key=_sort_key)]
+
+
+class ResultComparator(object):
+  """
+  Compares actual query results to expected results, under one set of rules.
+
+  By default, results must match exactly and in order, which is the same as
+  comparing them with ==. The rules can relax this:
+
+    ordered: if False, rows may come back in any order. Both sides are
+      sorted and compared pairwise, in O(n log n); sorting is done in C,
+      so it's quicker in practice than hashing each row. With a tolerance,
+      rows are sorted by the columns whose values match exactly first, and
+      then by the ones that differ (e.g., float aggregates), so that rounding
+      doesn't reorder them. (This pairs the rows as closely as any pairing
+      could when one column differs; with more, it's a good approximation.)
+    columns: indexes (from 0) of the only columns to compare, e.g., to skip
+      a column that holds a timestamp, or [] to compare only the number of
+      rows
+    abs_tol, rel_tol: numeric values (int, float or Decimal) match if they
+      differ by no more than abs_tol, or rel_tol times the larger of the two
+      in magnitude, e.g., to allow for rounding in float aggregates
+  """
+
+  def __init__(self, ordered=True, columns=None, abs_tol=0, rel_tol=0):
+    self.ordered = ordered
+    self.columns = None if columns is None else [int(column) for column in columns]
+    self.abs_tol = float(abs_tol)
+    self.rel_tol = float(rel_tol)
+    self.tolerant = bool(abs_tol or rel_tol)
+    self.exact = ordered and columns is None and not self.tolerant
+
+  @property
+  def digest_compatible(self):
+    """
+    Whether a ResultDigest can apply these rules. A digest can check the rows
+    in order or in any order, but can't skip columns or allow for rounding.
+    """
+    return self.columns is None and not self.tolerant
+
+  def compare(self, expected, actual):
+    """
+    Compare a result set to the expected one.
+
+    Args:
+      expected: the expected rows, as a sequence of tuples or a
+        CompiledResultSet
+      actual: the actual rows, as a sequence of tuples
+
+    Returns:
+      None if the results match, or else a description of the difference
+    """
+    if self.exact and expected == actual:
+      # Fast path, which doesn't decode a CompiledResultSet a row at a time
+      return None
+
+    expected = self._project(expected.rows() if hasattr(expected, 'rows') else expected)
+    actual = self._project(actual)
+    if len(expected) != len(actual):
+      return "expected {0} rows, got {1}".format(len(expected), len(actual))
+
+    if not self.ordered and self.tolerant:
+      expected, actual = self._sorted_tolerant(expected, actual)
+    elif not self.ordered:
+      expected = _sorted_rows(expected)
+      actual = _sorted_rows(actual)
+
+    i = self._first_mismatch(expected, actual)
+    if i is None:
+      return None
+    return "{0} {1}: expected {2}, got {3}".format(
+      'row' if self.ordered else 'sorted row', i, expected[i], actual[i])
+
+  def compare_sample(self, expected, actual, rows):
+    """
+    Compare the number of rows, and only the rows at the given indexes, of a
+    result set to the expected one. Unless the rows must be in order, only
+    the number of rows is compared, since a sample can't be paired up with
+    the expected rows without sorting all of them.
+
+    Args:
+      expected: the expected rows, as a sequence of tuples or a
+        CompiledResultSet
+      actual: the actual rows, as a sequence of tuples
+      rows: indexes of the rows to compare, e.g., a random sample
+
+    Returns:
+      None if the results match, or else a description of the difference
+    """
+    if len(expected) != len(actual):
+      return "expected {0} rows, got {1}".format(len(expected), len(actual))
+    if not self.ordered or not rows:
+      return None
+
+    if hasattr(expected, 'rows_at'):
+      expected = expected.rows_at(rows)
+    else:
+      expected = [expected[i] for i in rows]
+    expected = self._project(expected)
+    actual = self._project([actual[i] for i in rows])
+    i = self._first_mismatch(expected, actual)
+    if i is None:
+      return None
+    return "row {0}: expected {1}, got {2}".format(rows[i], expected[i], actual[i])
+
+  def _project(self, rows):
+    # Rows are made tuples (without copying rows that already are), since a
+    # list never equals a tuple with the same values
+    if self.columns is None:
+      return list(map(tuple, rows))
+    if not self.columns:
+      return [()] * len(rows)
+    if len(self.columns) == 1:
+      column = self.columns[0]
+      return [(row[column],) for row in rows]
+    return list(map(operator.itemgetter(*self.columns), rows))
+
+  def _sorted_tolerant(self, expected, actual):
+    """
+    Sort both sides for a comparison with a tolerance, by the columns whose
+    values are the same on both sides, and then by the ones that aren't.
+    """
+    widths = set(map(len, expected)) | set(map(len, actual))
+    if expected == actual or len(widths) != 1:
+      return _sorted_rows(expected), _sorted_rows(actual)
+
+    exact, inexact = [], []
+    for column in range(widths.pop()):
+      getter = operator.itemgetter(column)
+      if _sorted_values(map(getter, expected)) == _sorted_values(map(getter, actual)):
+        exact.append(column)
+      else:
+        inexact.append(column)
+    order = exact + inexact
+    if order == sorted(order):
+      return _sorted_rows(expected), _sorted_rows(actual)
+
+    # Sort with the columns reordered, and then put them back
+    reorder = operator.itemgetter(*order)
+    restore = operator.itemgetter(*[order.index(column) for column in range(len(order))])
+    return tuple(list(map(restore, _sorted_rows(list(map(reorder, rows)))))
+                 for rows in (expected, actual))
+
+  def _first_mismatch(self, expected, actual):
+    """Return the index of the first pair of rows that don't match, or None."""
+    if expected == actual:
+      return None
+    widths = set(map(len, expected)) | set(map(len, actual))
+    if not self.tolerant or len(widths) != 1:
+      for i, (expected_row, actual_row) in enumerate(zip(expected, actual)):
+        if expected_row != actual_row and (
+            not self.tolerant or len(expected_row) != len(actual_row) or
+            self._first_value_mismatch(expected_row, actual_row) is not None):
+          return i
+      return None
+
+    # A column at a time, so that the columns that match exactly (usually
+    # all but a float column or two) are compared in C
+    mismatches = []
+    for column in range(widths.pop()):
+      getter = operator.itemgetter(column)
+      expected_values = list(map(getter, expected))
+      actual_values = list(map(getter, actual))
+      if expected_values != actual_values:
+        i = self._first_value_mismatch(expected_values, actual_values)
+        if i is not None:
+          mismatches.append(i)
+    return min(mismatches) if mismatches else None
+
+  def _first_value_mismatch(self, expected_values, actual_values):
+    abs_tol, rel_tol = self.abs_tol, self.rel_tol
+    # Only the values that aren't exactly equal are visited in Python
+    differing = itertools.compress(
+      itertools.count(), map(operator.ne, expected_values, actual_values))
+    for i in differing:
+      expected_value, actual_value = expected_values[i], actual_values[i]
+      if not (_is_number(expected_value) and _is_number(actual_value)):
+        return i
+      expected_value, actual_value = float(expected_value), float(actual_value)
+      if expected_value != expected_value or actual_value != actual_value:
+        if expected_value == expected_value or actual_value == actual_value:
+          return i  # only one of them is NaN
+        continue
+      margin = max(abs_tol, rel_tol * max(abs(expected_value), abs(actual_value)))
+      if abs(expected_value - actual_value) > margin:
+        return i
+    return None
+
+
+class ComparisonRules(object):
+  """
+  Per-query ResultComparators, with a default for queries without rules.
+
+  Rules are defined as a dict (e.g., loaded from a yaml file) with the
+  ResultComparator settings for the default, and for each query by name:
+
+    default: {ordered: true}
+    queries:
+      73: {ordered: false}
+      39: {ordered: false, rel_tol: 1.0e-9}
+      65: {validate: false}
+
+  Query names may be given with or without their file extension. A query
+  with validate: false has results that no rule can check (e.g., the number
+  of rows varies), so it should be run without being validated.
+  """
+
+  def __init__(self, rules=None):
+    rules = rules or {}
+    self.default = ResultComparator(**(rules.get('default') or {}))
+    self.comparators = {}
+    self.unvalidated = set()
+    for query_name, options in (rules.get('queries') or {}).items():
+      query_name = _query_name(query_name)
+      options = dict(options or {})
+      if not options.pop('validate', True):
+        self.unvalidated.add(query_name)
+      self.comparators[query_name] = ResultComparator(**options)
+
+  def get(self, query_name):
+    """Return the ResultComparator for a query, e.g., '73' or '73.sql'."""
+    return self.comparators.get(_query_name(query_name), self.default)
+
+  def validates(self, query_name):
+    """Whether a query's results can be validated at all."""
+    return _query_name(query_name) not in self.unvalidated
+
+  def compare(self, query_name, expected, actual):
+    """
+    Compare a query's results under its rules, returning None if they match,
+    or else a description of the difference.
+    """
+    return self.get(query_name).compare(expected, actual)
+
+
+def _query_name(query_name):
+  return os.path.splitext(str(query_name))[0]
+
+
+def _load_rules_file(rules, base_dir, description):
+  if rules is None or isinstance(rules, dict):
+    return rules or {}
+  path = rules
+  if base_dir is not None and not os.path.isabs(path):
+    path = os.path.join(base_dir, path)
+  if not os.path.splitext(path)[1]:
+    path += '.yaml'
+  assert os.path.exists(path), "Invalid {0}: {1}".format(description, path)
+  with open(path) as fh:
+    return yaml.safe_load(fh) or {}
+
+
+def load_comparison_rules(rules, base_dir=None, manifest=None):
+  """
+  Return ComparisonRules for a test.
+
+  Args:
+    rules: either the rules themselves (e.g., inline in the config file), the
+      path of a yaml file containing them, or None for exact comparisons
+    base_dir: directory that a relative path is resolved against
+    manifest: a determinism manifest (or the path of one), as written by
+      impala_loadtest.determinism, whose rules apply to the queries that
+      rules doesn't mention
+  """
+  rules = _load_rules_file(rules, base_dir, "comparison rules")
+  if manifest is None:
+    return ComparisonRules(rules)
+
+  queries = {}
+  manifest = _load_rules_file(manifest, base_dir, "determinism manifest")
+  for query_name, entry in (manifest.get('queries') or {}).items():
+    if entry.get('rule') is not None:
+      queries[_query_name(query_name)] = entry['rule']
+  for query_name, options in (rules.get('queries') or {}).items():
+    queries[_query_name(query_name)] = options
+  return ComparisonRules({'default': rules.get('default'), 'queries': queries})
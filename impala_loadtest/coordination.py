@@ -0,0 +1,179 @@
+"""Synchronization between locust users, within a process or across a cluster."""
+
+import logging
+
+from collections import defaultdict
+from gevent.event import AsyncResult, Event
+from gevent.lock import Semaphore
+
+from impala_loadtest import messaging
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.coordination')
+
+MESSAGE_TYPE = 'impala_loadtest_coordination'
+
+
+class Coordinator(object):
+  """
+  Named barriers and run-once sections shared by all locust users in a test.
+
+  When locust is run standalone, users are coordinated with gevent events in
+  the local process. When it's run distributed (e.g., with impala-locust),
+  each slave reports arrivals to the master over locust's own master/slave
+  connection, and the master releases every slave at once when all users
+  have arrived. Either way, waiting users block on an event rather than
+  polling, so they're released together.
+
+  Barrier and run-once names are single-use: once released, a later wait()
+  on the same name returns immediately. Use distinct names (e.g., include an
+  iteration number) for barriers that are passed more than once.
+
+  All users in a test should share one Coordinator, typically created at
+  module level in the locust file.
+  """
+
+  def __init__(self, namespace='default'):
+    """
+    Args:
+      namespace: prefix for barrier names, to keep different Coordinators
+        from interfering with each other
+    """
+    self.namespace = namespace
+
+    # State for this process
+    self._released = defaultdict(Event)     # barrier name -> released
+    self._claims = {}                       # run-once name -> AsyncResult
+    self._once_lock = Semaphore()
+
+    # State kept by the master
+    self._arrivals = defaultdict(int)       # barrier name -> arrival count
+    self._claimed = set()                   # run-once names already granted
+    self._done = set()                      # barriers already released
+
+    messaging.register_message(self._message_type, self._on_message)
+
+  @property
+  def _message_type(self):
+    return '{0}:{1}'.format(MESSAGE_TYPE, self.namespace)
+
+  def wait(self, name, parties=None, timeout=None):
+    """
+    Arrive at a barrier, then block until all parties have arrived.
+
+    Args:
+      name: identifies the barrier
+      parties: number of users expected at the barrier; by default, the total
+        number of users in the test (across all slaves when distributed)
+      timeout: maximum number of seconds to wait, or None to wait forever
+
+    Returns:
+      True if the barrier was released, False if the wait timed out
+    """
+    if messaging.is_slave():
+      messaging.send_to_master(self._message_type,
+                               {'op': 'arrive', 'name': name, 'parties': parties})
+    else:
+      self._arrive(name, parties)
+
+    released = self._released[name].wait(timeout)
+    if not released:
+      logger.warning("Timed out waiting at barrier {0}".format(name))
+    return bool(released)
+
+  def run_once(self, name, func, *args, **kwargs):
+    """
+    Run func exactly once among all users, and block until it has finished.
+
+    The first user to get here runs func(*args, **kwargs); every other user
+    blocks until it returns (or raises), then carries on without running it.
+
+    Returns:
+      True if this user ran func, otherwise False
+    """
+    barrier = 'once:{0}'.format(name)
+
+    with self._once_lock:
+      # Only the first user in each process asks the master for the claim
+      if name not in self._claims:
+        self._claims[name] = AsyncResult()
+        first_in_process = True
+      else:
+        first_in_process = False
+
+    granted = False
+    if first_in_process:
+      if messaging.is_slave():
+        messaging.send_to_master(self._message_type, {'op': 'claim', 'name': name})
+        granted = self._claims[name].get()
+      else:
+        granted = self._claim(name)
+
+    if granted:
+      try:
+        func(*args, **kwargs)
+      finally:
+        if messaging.is_slave():
+          messaging.send_to_master(self._message_type,
+                                   {'op': 'release', 'name': barrier})
+        else:
+          self._release(barrier)
+
+    self._released[barrier].wait()
+    return granted
+
+  def _user_count(self):
+    runner = messaging.get_runner()
+    return runner.num_clients if runner is not None else 1
+
+  def _arrive(self, name, parties):
+    """Count an arrival at a barrier, releasing it when everyone is there."""
+    self._arrivals[name] += 1
+    if parties is None:
+      parties = self._user_count()
+    logger.debug("{0} of {1} users at barrier {2}".format(
+      self._arrivals[name], parties, name))
+    if self._arrivals[name] >= parties:
+      self._release(name)
+
+  def _claim(self, name):
+    """Grant a run-once claim to the first caller only."""
+    if name in self._claimed:
+      return False
+    self._claimed.add(name)
+    return True
+
+  def _release(self, name):
+    """Release a barrier, in this process and on all slaves."""
+    if name in self._done:
+      return
+    self._done.add(name)
+    self._arrivals.pop(name, None)
+    self._released[name].set()
+    if messaging.is_master():
+      messaging.send_to_slaves(self._message_type, {'op': 'release', 'name': name})
+
+  def _on_message(self, data, client_id):
+    """Handle coordination messages, on either the master or a slave."""
+    op, name = data['op'], data['name']
+
+    if not messaging.is_master():
+      if op == 'release':
+        self._released[name].set()
+      elif op == 'claim':
+        self._claims[name].set(data['granted'])
+      return
+
+    if op == 'arrive':
+      if name in self._done:
+        # Late arrival at a barrier that's already been released
+        messaging.send_to_slaves(self._message_type,
+                                 {'op': 'release', 'name': name}, client_id)
+      else:
+        self._arrive(name, data.get('parties'))
+    elif op == 'claim':
+      messaging.send_to_slaves(self._message_type,
+                               {'op': 'claim', 'name': name,
+                                'granted': self._claim(name)}, client_id)
+    elif op == 'release':
+      self._release(name)
@@ -0,0 +1,405 @@
+"""
+Find the queries whose results aren't deterministic, and how to validate them.
+
+Each query is run several times at once, in separate sessions, and the
+fingerprints (ResultDigests) of the runs are compared. Every query is then
+classified as:
+
+  deterministic: every run returned the same rows, in the same order
+  order_unstable: the same rows, but not always in the same order, e.g.,
+    when the ORDER BY leaves ties
+  value_unstable: different rows, e.g., float aggregates rounded differently
+    depending on the order they were summed in, or a LIMIT that cuts through
+    ties
+  error: a run failed
+
+and given the comparison rule (see impala_loadtest.common.ComparisonRules)
+that its runs all agree under:
+
+  order_unstable: {ordered: false}
+  value_unstable: {ordered: false}, plus a rel_tol when numeric values only
+    differ by rounding, and the columns that were stable, when some weren't;
+    or, when not even the number of rows is stable, {validate: false}
+
+Working out a rule for a value_unstable query needs the rows of its runs, so
+those are kept, up to --max-rows rows per run. A larger result set that isn't
+stable gets {validate: false}.
+
+The classifications and rules are written to a yaml manifest. Set
+determinism_manifest in a test's config file to the manifest, and the
+validation task compares each query's results under its rule, unless
+comparison_rules has one for it. Queries that were moved out of the test's
+queries by hand, as non-deterministic, can then be put back. Run it with, e.g.:
+
+  python -m impala_loadtest.determinism --runs 4 \\
+      --config sample_load_tests/test_tpcds_load/dc_tpcds_load_test.yaml \\
+      --output sample_load_tests/test_tpcds_load/TPCDS/determinism.yaml \\
+      sample_load_tests/test_tpcds_load/TPCDS/queries \\
+      sample_load_tests/test_tpcds_load/TPCDS/non_deterministic_queries
+
+Running it again for some of the queries (with --queries) updates their
+entries in an existing manifest, and keeps the rest.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import gevent
+import logging
+import math
+import operator
+import os
+import sys
+import yaml
+
+from gevent.queue import Empty, Queue
+
+from impala_loadtest.capture import (
+  add_connection_arguments, connect, connection_settings, load_queries)
+from impala_loadtest.common import ResultComparator, _is_number, _sorted_rows, timer
+from impala_loadtest.validation import DEFAULT_BATCH_SIZE, ResultDigest
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.determinism')
+
+# Classifications, from most to least stable
+DETERMINISTIC = 'deterministic'
+ORDER_UNSTABLE = 'order_unstable'
+VALUE_UNSTABLE = 'value_unstable'
+FAILED = 'error'
+CLASSES = (DETERMINISTIC, ORDER_UNSTABLE, VALUE_UNSTABLE, FAILED)
+
+# Numeric values that differ by more than this, relatively, aren't just
+# rounded differently, so a tolerance isn't suggested for them
+MAX_REL_TOL = 1e-6
+
+# Rows per run kept for working out a rule for a value_unstable query
+DEFAULT_MAX_ROWS = 100000
+
+MANIFEST_HEADER = """\
+# Written by impala_loadtest.determinism: how stable each query's results
+# were over repeated, concurrent runs, and the comparison rule its runs all
+# agreed under. Set determinism_manifest in the config file to use the rules.
+"""
+
+# The outcome of one run of a query: its ResultDigest, and its rows (None if
+# there were more than max_rows), or else the error it failed with
+QueryRun = collections.namedtuple('QueryRun', ['digest', 'rows', 'error'])
+
+
+def run_query(cursor, query_str, max_rows=DEFAULT_MAX_ROWS,
+              batch_size=DEFAULT_BATCH_SIZE):
+  """Run a query, and return a QueryRun of its results."""
+  digest = ResultDigest()
+  rows = []
+  cursor.execute(query_str)
+  while True:
+    batch = cursor.fetchmany(batch_size)
+    if not batch:
+      break
+    digest.update(batch)
+    if rows is not None:
+      rows.extend(map(tuple, batch))
+      if len(rows) > max_rows:
+        rows = None
+  return QueryRun(digest, rows, None)
+
+
+def _sorted_values(values):
+  return [row[0] for row in _sorted_rows([(value,) for value in values])]
+
+
+def _max_rel_diff(values, other_values):
+  """
+  Return the largest relative difference between pairs of values, or None if
+  a pair differs in a way that no tolerance allows for (e.g., strings).
+  """
+  max_diff = 0.0
+  for value, other_value in zip(values, other_values):
+    if value == other_value:
+      continue
+    if not (_is_number(value) and _is_number(other_value)):
+      return None
+    value, other_value = float(value), float(other_value)
+    if value != value or other_value != other_value:
+      if value == value or other_value == other_value:
+        return None  # only one of them is NaN
+      continue
+    max_diff = max(max_diff, abs(value - other_value) /
+                   max(abs(value), abs(other_value)))
+  return max_diff
+
+
+def _tolerance(max_diff):
+  # An order of magnitude of headroom over what was seen, as a power of ten
+  return 10.0 ** math.ceil(math.log10(max_diff * 10))
+
+
+def derive_rule(runs):
+  """
+  Work out a comparison rule under which the results of every run match.
+
+  Args:
+    runs: the rows of each run, as lists of tuples
+
+  Returns:
+    the rule, as a dict of ResultComparator settings (or {validate: false}),
+    and a list of the indexes of the columns that weren't stable
+  """
+  if len(set(map(len, runs))) > 1 or not runs[0]:
+    return {'validate': False}, []
+
+  num_cols = len(runs[0][0])
+  stable, unstable, exact, max_diff = [], [], [], 0.0
+  for column in range(num_cols):
+    getter = operator.itemgetter(column)
+    values = [_sorted_values(list(map(getter, rows))) for rows in runs]
+    diffs = [_max_rel_diff(values[0], other_values) for other_values in values[1:]]
+    if None in diffs or max(diffs) > MAX_REL_TOL:
+      unstable.append(column)
+    else:
+      stable.append(column)
+      max_diff = max([max_diff] + diffs)
+      if not max(diffs):
+        exact.append(column)
+
+  rule = {'ordered': False}
+  if unstable:
+    rule['columns'] = stable
+  if max_diff:
+    rule['rel_tol'] = _tolerance(max_diff)
+
+  # Each column was checked on its own; make sure the rows still pair up.
+  # If they don't, fall back to the columns that matched exactly, and then
+  # to only the row count. The unstable columns are still the ones that
+  # weren't stable on their own.
+  fallbacks = [{'ordered': False, 'columns': exact}] if exact != stable else []
+  fallbacks.append({'ordered': False, 'columns': []})
+  for fallback in [rule] + fallbacks:
+    comparator = ResultComparator(**fallback)
+    if all(comparator.compare(runs[0], rows) is None for rows in runs[1:]):
+      return fallback, unstable
+  return fallbacks[-1], unstable
+
+
+def classify(runs):
+  """
+  Classify a query by the QueryRuns of its repeated runs.
+
+  Returns:
+    its manifest entry, as a dict with its class, its rule (None when
+    deterministic), and the row counts of its runs
+  """
+  errors = [run.error for run in runs if run.error is not None]
+  if errors:
+    return {'class': FAILED, 'rule': None, 'error': errors[0]}
+
+  entry = {'row_counts': [run.digest.row_count for run in runs]}
+  if len(set(run.digest.ordered for run in runs)) == 1:
+    entry.update({'class': DETERMINISTIC, 'rule': None})
+  elif len(set(run.digest.unordered for run in runs)) == 1:
+    entry.update({'class': ORDER_UNSTABLE, 'rule': {'ordered': False}})
+  elif any(run.rows is None for run in runs):
+    entry.update({'class': VALUE_UNSTABLE, 'rule': {'validate': False}})
+  else:
+    rule, unstable = derive_rule([run.rows for run in runs])
+    entry.update({'class': VALUE_UNSTABLE, 'rule': rule})
+    if unstable:
+      entry['unstable_columns'] = unstable
+  return entry
+
+
+class DeterminismCheck(object):
+  """
+  Runs each of a set of queries several times, concurrently, and classifies
+  them by how stable their results were.
+  """
+
+  def __init__(self, host, target_db=None, runs=3, parallelism=None,
+               max_rows=DEFAULT_MAX_ROWS, batch_size=DEFAULT_BATCH_SIZE,
+               client_type="ImpylaClient", **client_kwargs):
+    """
+    Args:
+      host: FQDN to the coordinator
+      target_db: database to select in each session, if any
+      runs: number of times to run each query
+      parallelism: number of sessions to run queries in at once; by default,
+        one per run, so all of a query's runs overlap
+      max_rows: rows per run to keep, for working out a rule
+      batch_size: number of rows to fetch from the cursor at a time
+      client_type: name of the DBAPI client class to instantiate
+      client_kwargs: a dictionary of parameters needed to make a connection
+    """
+    assert runs >= 2, "Each query must be run at least twice"
+    self.host = host
+    self.target_db = target_db
+    self.runs = runs
+    self.parallelism = parallelism or runs
+    self.max_rows = max_rows
+    self.batch_size = batch_size
+    self.client_type = client_type
+    self.client_kwargs = client_kwargs
+
+  def run(self, queries):
+    """
+    Args:
+      queries: a list of (query name, query string) pairs
+
+    Returns:
+      a dict of query name -> manifest entry
+    """
+    self._queue = Queue()
+    for query_name, query_str in queries:
+      # A query's runs are queued together, so they run at the same time
+      for _ in range(self.runs):
+        self._queue.put((query_name, query_str))
+    self._runs = collections.defaultdict(list)
+    self._entries = {}
+    self._total = len(queries)
+
+    workers = [gevent.spawn(self._worker, i) for i in range(self.parallelism)]
+    gevent.joinall(workers)
+
+    for query_name, _ in queries:
+      if query_name not in self._entries:
+        self._entries[query_name] = {'class': FAILED, 'rule': None,
+                                     'error': 'Not run: no session could connect'}
+    return self._entries
+
+  def _connect(self):
+    return connect(self.host, self.target_db, self.client_type, **self.client_kwargs)
+
+  def _worker(self, worker_id):
+    try:
+      client = self._connect()
+    except Exception as e:
+      logger.error("Session {0} couldn't connect: {1}".format(worker_id, e))
+      return
+
+    while True:
+      try:
+        query_name, query_str = self._queue.get_nowait()
+      except Empty:
+        break
+
+      try:
+        run = run_query(client._cursor, query_str, self.max_rows, self.batch_size)
+      except Exception as e:
+        run = QueryRun(None, None, str(e))
+        try:
+          # Start the next query with a fresh session
+          client.disconnect()
+          client = self._connect()
+        except Exception as e:
+          logger.error("Session {0} couldn't reconnect: {1}".format(worker_id, e))
+          self._add_run(query_name, run)
+          break
+      self._add_run(query_name, run)
+
+    try:
+      client.disconnect()
+    except Exception:
+      pass
+
+  def _add_run(self, query_name, run):
+    runs = self._runs[query_name]
+    runs.append(run)
+    if len(runs) < self.runs:
+      return
+    entry = self._entries[query_name] = classify(runs)
+    del self._runs[query_name]
+    logger.info("[{0}/{1}] {2}: {3}{4}".format(
+      len(self._entries), self._total, query_name, entry['class'],
+      ', rule {0}'.format(entry['rule']) if entry['rule'] else ''))
+
+
+def load_manifest(path):
+  """Return a determinism manifest, or an empty one if there's none at path."""
+  if not os.path.exists(path):
+    return {'queries': {}}
+  with open(path) as infile:
+    manifest = yaml.safe_load(infile) or {}
+  manifest.setdefault('queries', {})
+  return manifest
+
+
+def write_manifest(path, manifest):
+  tmp_file = '{0}.tmp.{1}'.format(path, os.getpid())
+  with open(tmp_file, 'w') as outfile:
+    outfile.write(MANIFEST_HEADER)
+    yaml.safe_dump(manifest, outfile, default_flow_style=None)
+  os.rename(tmp_file, path)
+
+
+def format_summary(entries):
+  """Return the queries in each class, as lines of text."""
+  lines = []
+  for query_class in CLASSES:
+    names = sorted(name for name, entry in entries.items()
+                   if entry['class'] == query_class)
+    if names:
+      lines.append('{0:<15} {1:>4}  {2}'.format(query_class, len(names), ' '.join(names)))
+  return lines
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description="Run each query several times at once, classify its results as "
+                "deterministic, order_unstable or value_unstable, and write a "
+                "manifest of the comparison rules to validate it with.")
+  parser.add_argument('queries_dirs', nargs='+', metavar='queries_dir',
+                      help="Directory of .sql query files")
+  parser.add_argument('--output', required=True,
+                      help="Manifest file to write (or update)")
+  add_connection_arguments(parser)
+  parser.add_argument('--runs', type=int, default=3,
+                      help="Times to run each query (default: %(default)s)")
+  parser.add_argument('--parallelism', type=int,
+                      help="Queries to run at once (default: --runs)")
+  parser.add_argument('--max-rows', type=int, default=DEFAULT_MAX_ROWS,
+                      help="Rows per run to keep, for working out a rule "
+                           "(default: %(default)s)")
+  parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                      help="Rows to fetch at a time (default: %(default)s)")
+  parser.add_argument('--queries', action='append',
+                      help="Glob pattern of the query files to check, e.g., "
+                           "'3*.sql'; may be repeated (default: all)")
+  return parser
+
+
+def main(argv=None):
+  options = get_parser().parse_args(argv)
+  host, target_db, client_kwargs = connection_settings(options)
+  if not host:
+    print("A coordinator is needed, from --coordinator or --config", file=sys.stderr)
+    return 2
+
+  queries = []
+  for queries_dir in options.queries_dirs:
+    queries.extend(load_queries(queries_dir, options.queries))
+  if not queries:
+    print("No queries to check", file=sys.stderr)
+    return 2
+
+  logger.setLevel(logging.INFO)
+  logger.info("Running {0} queries {1} times each on {2}".format(
+    len(queries), options.runs, host))
+  check = DeterminismCheck(host, target_db=target_db, runs=options.runs,
+                           parallelism=options.parallelism,
+                           max_rows=options.max_rows,
+                           batch_size=options.batch_size, **client_kwargs)
+  start_time = timer()
+  entries = check.run(queries)
+  logger.info("Checked {0} queries in {1:.0f}s".format(len(entries), timer() - start_time))
+
+  manifest = load_manifest(options.output)
+  manifest['queries'].update(entries)
+  write_manifest(options.output, manifest)
+
+  for line in format_summary(entries):
+    print(line)
+  return 1 if any(entry['class'] == FAILED for entry in entries.values()) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,23 @@
+"""
+Event hooks for the harness's own measurements, which aren't requests.
+
+Timings like a query class's wait for a concurrency slot, or the server-side
+phases of a profiled query, would inflate locust's request counts, RPS and
+failures if they were logged as requests, since locust counts every entry in
+its totals. They're fired on these hooks instead, with the same arguments as
+locust's request_success and request_failure:
+
+  request_type, name: what was measured, e.g., ("class_wait", "dashboard")
+  response_time: the time taken, in whole milliseconds
+  response_time_seconds: the same, unrounded
+  response_length: a count that goes with the measurement, or 0
+  exception: (metric_failure only) why it failed
+
+LatencyRecorder (latency_report), TimeSeriesSampler (timeseries_file) and
+MetricsExporter (metrics_export) record them alongside the requests.
+"""
+
+import locust
+
+metric_success = locust.events.EventHook()
+metric_failure = locust.events.EventHook()
@@ -0,0 +1,439 @@
+"""
+Streams every request's stats out of the harness as the test runs.
+
+Locust's csv files only have totals, written at the end of the run, so
+lining up load with the cluster's own metrics means scraping them after the
+fact. A MetricsExporter instead keeps a record of every request, as reported
+to locust's request_success and request_failure events (and of the harness's
+own timings, from impala_loadtest.events), and writes them to one or more
+sinks:
+
+  events: a gzip compressed binary log of the requests, for full fidelity
+    with little disk. Read it back with read_events(), or dump it with:
+
+      python -m impala_loadtest.export [--line-protocol] <file>
+
+  line_protocol: a text file in InfluxDB line protocol, one line per request,
+    for tools like Telegraf to tail
+  socket: line protocol, sent to a local socket (a Unix socket path, or
+    host:port for TCP), e.g., a Telegraf socket_listener
+
+Each request only appends a tuple to an in-memory buffer, so the greenlet
+that ran the query does no I/O. Every flush_interval seconds, the buffered
+requests are handed to a background thread, which encodes and writes the
+batch to each sink in turn, so a slow disk or listener doesn't stall the
+event loop either. If the thread falls behind, requests keep buffering, up to
+max_buffered, after which they're dropped (and counted).
+
+Settings, in the metrics_export section of the config file:
+
+  sinks: a list of sinks, each with a type and that sink's settings:
+    {type: events, path: <file>, compresslevel: <1-9, default 6>}
+    {type: line_protocol, path: <file>, measurement: <name>, tags: {...}}
+    {type: socket, address: <path or host:port>, measurement: <name>,
+     tags: {...}}
+    where measurement defaults to impala_loadtest, and tags are added to
+    every line
+  flush_interval: seconds between flushes (default 1)
+  max_buffered: most requests to buffer before dropping them (default 200000)
+  request_types: the request types to export (default: all)
+
+Files are overwritten at the start of each run. When running distributed,
+each slave exports its own requests, and a path can include {pid}, for the
+slave's process ID; if it doesn't, '.<pid>' is added to it on slaves, so
+slaves on the same host write separate files. Other sinks can be added with
+register_sink().
+"""
+
+from __future__ import print_function
+
+import collections
+import gevent
+import gevent.monkey
+import gzip
+import locust
+import logging
+import os
+import six
+import socket
+import struct
+import sys
+import time
+
+from gevent.threadpool import ThreadPool
+from locust.log import console_logger
+
+from impala_loadtest import events, messaging
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.export')
+
+# A request, as exported. timestamp is when it ended, in seconds since the
+# epoch, and error is None for successes.
+Event = collections.namedtuple(
+  'Event', ['timestamp', 'request_type', 'name', 'response_time',
+            'response_length', 'error'])
+
+# Layout of the events log, after the gzip compression: the header, then a
+# record per string (request types, names and errors, each written once,
+# before its first use) and per request, which refers to strings by ID
+EVENTS_HEADER = b'IMPALA_LOADTEST_EVENTS 1\n'
+STRING_RECORD = struct.Struct('<BII')  # tag, ID, length of the UTF-8 bytes
+EVENT_RECORD = struct.Struct('<BdIIdqI')  # tag, timestamp, type, name, time, length, error
+STRING_TAG = 1
+EVENT_TAG = 2
+
+DEFAULT_MEASUREMENT = 'impala_loadtest'
+
+_sink_types = {}
+
+
+def register_sink(sink_type, sink_class):
+  """
+  Make a sink available to the metrics_export section of the config file.
+
+  Args:
+    sink_type: the name to refer to the sink by, in its 'type' setting
+    sink_class: a class, constructed with the sink's other settings as
+      keyword arguments, with write(batch) and close() methods. Batches are
+      lists of (timestamp, request_type, name, response_time,
+      response_length, error) tuples, as in Event. Both methods are called in
+      a background thread, one at a time.
+  """
+  _sink_types[sink_type] = sink_class
+
+
+def _utf8(value):
+  return value if isinstance(value, bytes) else six.text_type(value).encode('utf-8')
+
+
+def _text(value):
+  return value.decode('utf-8') if isinstance(value, bytes) else six.text_type(value)
+
+
+class EventLogSink(object):
+  """Writes requests to a gzip compressed binary log. See read_events()."""
+
+  def __init__(self, path, compresslevel=6):
+    self.path = path
+    self._file = gzip.open(path, 'wb', compresslevel)
+    self._file.write(EVENTS_HEADER)
+    self._ids = {}  # string -> ID, for the strings already written
+
+  def _id(self, value, chunks):
+    if value is None:
+      return 0
+    string_id = self._ids.get(value)
+    if string_id is None:
+      string_id = self._ids[value] = len(self._ids) + 1
+      encoded = _utf8(value)
+      chunks.append(STRING_RECORD.pack(STRING_TAG, string_id, len(encoded)))
+      chunks.append(encoded)
+    return string_id
+
+  def write(self, batch):
+    chunks = []
+    for timestamp, request_type, name, response_time, response_length, error in batch:
+      type_id = self._id(request_type, chunks)
+      name_id = self._id(name, chunks)
+      error_id = self._id(error, chunks)
+      chunks.append(EVENT_RECORD.pack(EVENT_TAG, timestamp, type_id, name_id,
+                                      response_time, response_length, error_id))
+    self._file.write(b''.join(chunks))
+
+  def close(self):
+    self._file.close()
+
+
+def read_events(path):
+  """Generate the requests in an events log, as Events."""
+  strings = {0: None}
+  with gzip.open(path, 'rb') as infile:
+    header = infile.read(len(EVENTS_HEADER))
+    if header != EVENTS_HEADER:
+      raise ValueError("{0} is not an events log".format(path))
+    while True:
+      tag = infile.read(1)
+      if not tag:
+        break
+      if ord(tag) == STRING_TAG:
+        _, string_id, length = STRING_RECORD.unpack(tag + infile.read(STRING_RECORD.size - 1))
+        strings[string_id] = infile.read(length).decode('utf-8')
+      elif ord(tag) == EVENT_TAG:
+        values = EVENT_RECORD.unpack(tag + infile.read(EVENT_RECORD.size - 1))
+        _, timestamp, type_id, name_id, response_time, response_length, error_id = values
+        yield Event(timestamp, strings[type_id], strings[name_id], response_time,
+                    response_length, strings[error_id])
+      else:
+        raise ValueError("Corrupt events log {0}: unknown record {1}".format(path, ord(tag)))
+
+
+def _escape(value, special=' ,='):
+  """Escape line protocol's special characters (in order) with backslashes."""
+  value = _text(value).replace('\n', ' ')
+  for char in special:
+    value = value.replace(char, '\\' + char)
+  return value
+
+
+class LineProtocolEncoder(object):
+  """Encodes requests as lines of InfluxDB line protocol."""
+
+  def __init__(self, measurement=DEFAULT_MEASUREMENT, tags=None):
+    # Unicode templates throughout, since on Python 2 formatting a str
+    # template with non-ASCII unicode values fails; lines are encoded once,
+    # at the end
+    extra_tags = u''.join(u',{0}={1}'.format(_escape(key), _escape(value))
+                          for key, value in sorted((tags or {}).items()))
+    self._prefix = _escape(measurement, ' ,') + extra_tags
+
+  def encode(self, batch):
+    """Return the lines for a batch of requests, as UTF-8 bytes."""
+    lines = []
+    for timestamp, request_type, name, response_time, response_length, error in batch:
+      fields = u'response_time={0!r},response_length={1}i'.format(
+        float(response_time), int(response_length))
+      if error is not None:
+        fields += u',error="{0}"'.format(_escape(error, '\\"'))
+      lines.append(u'{0},request_type={1},name={2},success={3} {4} {5}\n'.format(
+        self._prefix, _escape(request_type), _escape(name) or u'-',
+        u'false' if error is not None else u'true', fields,
+        int(timestamp * 1000000000)))
+    return _utf8(u''.join(lines))
+
+
+class LineProtocolFileSink(object):
+  """Writes requests to a file, in InfluxDB line protocol."""
+
+  def __init__(self, path, measurement=DEFAULT_MEASUREMENT, tags=None):
+    self.path = path
+    self._encoder = LineProtocolEncoder(measurement, tags)
+    self._file = open(path, 'wb')
+
+  def write(self, batch):
+    self._file.write(self._encoder.encode(batch))
+    self._file.flush()
+
+  def close(self):
+    self._file.close()
+
+
+class SocketSink(object):
+  """
+  Sends requests to a local socket, in InfluxDB line protocol.
+
+  The socket is (re)connected as needed. Batches that can't be sent are
+  dropped, rather than held up for a listener that's gone away.
+  """
+
+  def __init__(self, address, measurement=DEFAULT_MEASUREMENT, tags=None,
+               timeout=5):
+    self.address = address
+    self.timeout = timeout
+    self._encoder = LineProtocolEncoder(measurement, tags)
+    self._socket = None
+    self.failures = 0
+
+  def _connect(self):
+    # Runs in the exporter's thread, so the socket must be a plain blocking
+    # one, not gevent's
+    socket_class = gevent.monkey.get_original('socket', 'socket')
+    if ':' in self.address and not self.address.startswith('/'):
+      host, port = self.address.rsplit(':', 1)
+      sock = socket_class(socket.AF_INET, socket.SOCK_STREAM)
+      address = (host, int(port))
+    else:
+      sock = socket_class(socket.AF_UNIX, socket.SOCK_STREAM)
+      address = self.address
+    sock.settimeout(self.timeout)
+    try:
+      sock.connect(address)
+    except Exception:
+      sock.close()
+      raise
+    return sock
+
+  def write(self, batch):
+    data = self._encoder.encode(batch)
+    try:
+      if self._socket is None:
+        self._socket = self._connect()
+      self._socket.sendall(data)
+    except Exception as e:
+      self.failures += 1
+      if self.failures == 1:
+        logger.warning("Couldn't send requests to {0}; dropping them until it's "
+                       "back: {1}".format(self.address, e))
+      self.close()
+
+  def close(self):
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+
+
+register_sink('events', EventLogSink)
+register_sink('line_protocol', LineProtocolFileSink)
+register_sink('socket', SocketSink)
+
+
+class MetricsExporter(object):
+  """
+  Buffers every request reported to locust, and writes them out to sinks in
+  batches, in a background thread. One per process.
+  """
+
+  def __init__(self, config):
+    """
+    Args:
+      config: the metrics_export section of the config file (see the module
+        docstring)
+    """
+    self.sink_settings = config.get('sinks') or []
+    self.flush_interval = config.get('flush_interval', 1)
+    self.max_buffered = config.get('max_buffered', 200000)
+    request_types = config.get('request_types')
+    self.request_types = set(request_types) if request_types else None
+    for settings in self.sink_settings:
+      assert settings.get('type') in _sink_types, (
+        "Unknown metrics_export sink type: {0}".format(settings.get('type')))
+
+    self.sinks = []
+    self.exported = 0
+    self.dropped = 0
+    self._buffer = []
+    self._greenlet = None
+    self._pool = None
+    self._writing = None
+
+  def install(self):
+    """Attach the exporter to the locust events it needs."""
+    locust.events.request_success += self.on_request_success
+    locust.events.request_failure += self.on_request_failure
+    events.metric_success += self.on_request_success
+    events.metric_failure += self.on_request_failure
+    locust.events.locust_start_hatching += self.start
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def _path(self, path):
+    if '{pid}' not in path and messaging.is_slave():
+      path += '.{pid}'
+    return path.format(pid=os.getpid())
+
+  def start(self, **kwargs):
+    """Open the sinks, and start flushing, unless already started."""
+    if self._greenlet is not None:
+      return
+    for settings in self.sink_settings:
+      settings = dict(settings)
+      sink_class = _sink_types[settings.pop('type')]
+      if 'path' in settings:
+        settings['path'] = self._path(settings['path'])
+      self.sinks.append(sink_class(**settings))
+    self._pool = ThreadPool(1)
+    self._greenlet = gevent.spawn(self._run)
+
+  def _add(self, request_type, name, response_time, response_length,
+           response_time_seconds, error):
+    if self.request_types is not None and request_type not in self.request_types:
+      return
+    if len(self._buffer) >= self.max_buffered:
+      self.dropped += 1
+      return
+    if response_time_seconds is None:
+      response_time_seconds = response_time / 1000.0
+    self._buffer.append((time.time(), request_type, name, response_time_seconds,
+                         response_length or 0, error))
+
+  def on_request_success(self, request_type, name, response_time,
+                         response_length=0, response_time_seconds=None, **kwargs):
+    self._add(request_type, name, response_time, response_length,
+              response_time_seconds, None)
+
+  def on_request_failure(self, request_type, name, response_time, exception=None,
+                         response_length=0, response_time_seconds=None, **kwargs):
+    self._add(request_type, name, response_time, response_length,
+              response_time_seconds, repr(exception))
+
+  def _run(self):
+    while True:
+      gevent.sleep(self.flush_interval)
+      self.flush()
+
+  def flush(self):
+    """Hand the buffered requests to the writer thread, unless it's busy."""
+    if not self._buffer or (self._writing is not None and not self._writing.ready()):
+      return
+    batch, self._buffer = self._buffer, []
+    self._writing = self._pool.spawn(self._write, batch)
+
+  def _write(self, batch):
+    # Runs in the writer thread. Errors are logged rather than raised, where
+    # gevent would only print them.
+    for sink in self.sinks:
+      try:
+        sink.write(batch)
+      except Exception as e:
+        logger.error("Couldn't export requests with {0}: {1}".format(
+          type(sink).__name__, e))
+    self.exported += len(batch)
+
+  def _close(self):
+    for sink in self.sinks:
+      try:
+        sink.close()
+      except Exception as e:
+        logger.error("Couldn't close {0}: {1}".format(type(sink).__name__, e))
+
+  def on_quitting(self, **kwargs):
+    """Write out whatever's still buffered, and close the sinks."""
+    if self._greenlet is None:
+      return
+    self._greenlet.kill()
+    if self._writing is not None:
+      self._writing.get()
+    self._pool.spawn(self._write, self._buffer).get()
+    self._buffer = []
+    self._pool.spawn(self._close).get()
+    self._greenlet = None
+    console_logger.info("Metrics export: {0} requests exported to {1} sinks, {2} "
+                        "dropped".format(self.exported, len(self.sinks), self.dropped))
+
+
+def main(argv=None):
+  """
+  Dump an events log written by a MetricsExporter, as tab separated values,
+  or with --line-protocol, as InfluxDB line protocol.
+
+  Usage: python -m impala_loadtest.export [--line-protocol] <file>
+  """
+  args = list(sys.argv[1:] if argv is None else argv)
+  line_protocol = '--line-protocol' in args
+  if line_protocol:
+    args.remove('--line-protocol')
+  if len(args) != 1:
+    print(main.__doc__.strip())
+    return 1
+
+  output = getattr(sys.stdout, 'buffer', sys.stdout)
+  if line_protocol:
+    encoder = LineProtocolEncoder()
+    for event in read_events(args[0]):
+      output.write(encoder.encode([event]))
+    return 0
+
+  def field(value):
+    return _text(value).replace('\t', ' ').replace('\n', ' ')
+
+  output.write(b'Timestamp\tType\tName\tResponse time (s)\tLength\tError\n')
+  for event in read_events(args[0]):
+    output.write(_utf8('\t'.join([
+      '{0:.6f}'.format(event.timestamp), field(event.request_type),
+      field(event.name), '{0:.6f}'.format(event.response_time),
+      str(event.response_length), field(event.error or '')]) + '\n'))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+Health of the load generator itself, to tell a saturated client from a slow
+server.
+
+All of a locust process's users share one gevent loop on one CPU core. When
+the harness keeps that core busy (formatting SQL, loading yaml, building or
+comparing large result sets), greenlets that are ready to run wait their
+turn, and the wait is counted in the latency of whatever query they were
+timing. An overloaded generator then looks just like a slower Impala.
+
+A GeneratorHealth monitor measures, in each window of a few seconds:
+
+  event loop lag: how late a greenlet that sleeps for a short, fixed time
+    wakes up, which is how long any greenlet may wait to run
+  CPU use of the process, as a percentage of one core
+  harness time per request (process CPU time, divided by the requests), vs.
+    server time per request (the mean response time)
+
+A window is saturated when its p99 loop lag or its CPU use is over a
+threshold. Saturated windows are logged as they happen, and summarized in a
+"generator health" section of the run output. With throttle: true, new
+queries are also held back while the process is saturated (see
+backpressure()), trading offered load for latencies that can be trusted.
+
+Settings, in the generator_health section of the config file (all optional):
+
+  interval: seconds per window (default 5)
+  probe_interval: seconds between loop lag probes (default 0.1)
+  max_lag_ms: p99 loop lag above which a window is saturated (default 50)
+  max_cpu_percent: CPU use above which a window is saturated (default 90)
+  request_type: the requests to count (default 'query')
+  throttle: hold back new queries while saturated (default False)
+  max_delay: longest hold, in seconds, when throttling (default 1.0)
+
+When running distributed, each slave measures itself, and sends its windows
+to the master with its stats reports, so the master's summary has a row per
+slave.
+"""
+
+import collections
+import gevent
+import locust
+import logging
+import os
+
+from locust.log import console_logger
+
+from impala_loadtest import messaging
+from impala_loadtest.common import timer
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.health')
+
+# Delays when throttling: the first delay, and the delay below which
+# throttling stops as the process recovers
+MIN_DELAY = 0.01
+
+# The measurements of one window. Latencies are in milliseconds.
+HealthWindow = collections.namedtuple(
+  'HealthWindow', ['duration', 'cpu_percent', 'lag_p50', 'lag_p99', 'lag_max',
+                   'requests', 'harness_ms', 'server_ms', 'delay', 'saturated'])
+
+# Seconds to hold back each new query, while throttling
+_delay = 0.0
+
+
+def backpressure():
+  """
+  Hold back a new query for as long as the process is being throttled.
+
+  Called by DbApiLocustClient before it starts timing a query, so the hold
+  isn't counted in the query's latency. Does nothing unless throttling.
+  """
+  if _delay:
+    gevent.sleep(_delay)
+
+
+def _percentile(sorted_values, fraction):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+class HealthTotals(object):
+  """Running totals over the windows of one process."""
+
+  def __init__(self):
+    self.windows = 0
+    self.saturated = 0
+    self.seconds = 0.0
+    self.cpu_seconds = 0.0
+    self.cpu_max = 0.0
+    self.lag_p99_max = 0.0
+    self.lag_max = 0.0
+    self.requests = 0
+    self.harness_seconds = 0.0
+    self.server_seconds = 0.0
+
+  def add(self, window):
+    self.windows += 1
+    self.saturated += int(window.saturated)
+    self.seconds += window.duration
+    self.cpu_seconds += window.cpu_percent / 100.0 * window.duration
+    self.cpu_max = max(self.cpu_max, window.cpu_percent)
+    self.lag_p99_max = max(self.lag_p99_max, window.lag_p99)
+    self.lag_max = max(self.lag_max, window.lag_max)
+    self.requests += window.requests
+    self.harness_seconds += window.harness_ms * window.requests / 1000.0
+    self.server_seconds += window.server_ms * window.requests / 1000.0
+
+  @property
+  def cpu_percent(self):
+    return self.cpu_seconds / self.seconds * 100 if self.seconds else 0.0
+
+  def per_request_ms(self, seconds):
+    return seconds * 1000.0 / self.requests if self.requests else 0.0
+
+
+def format_totals(totals):
+  """Return the per-process totals as lines of a fixed-width table."""
+  lines = [' {0:<24} {1:>7} {2:>9} {3:>8} {4:>8} {5:>8} {6:>8} {7:>10} {8:>10}'.format(
+    'Process', 'Windows', 'Saturated', 'CPU avg', 'CPU max', 'Lag p99',
+    'Lag max', 'Harness ms', 'Server ms')]
+  lines.append('-' * len(lines[0]))
+  for name, total in sorted(totals.items()):
+    lines.append(' {0:<24} {1:>7} {2:>9} {3:>7.1f}% {4:>7.1f}% {5:>8.1f} {6:>8.1f} '
+                 '{7:>10.2f} {8:>10.2f}'.format(
+                   name[:24], total.windows, total.saturated, total.cpu_percent,
+                   total.cpu_max, total.lag_p99_max, total.lag_max,
+                   total.per_request_ms(total.harness_seconds),
+                   total.per_request_ms(total.server_seconds)))
+  return lines
+
+
+class GeneratorHealth(object):
+  """
+  Measures event loop lag, CPU use and harness vs. server time per window,
+  and flags (or throttles) the process when it's saturated.
+  """
+
+  def __init__(self, config=None):
+    """
+    Args:
+      config: the generator_health section of the config file (see the
+        module docstring)
+    """
+    config = config or {}
+    self.interval = config.get('interval', 5)
+    self.probe_interval = config.get('probe_interval', 0.1)
+    self.max_lag_ms = config.get('max_lag_ms', 50)
+    self.max_cpu_percent = config.get('max_cpu_percent', 90)
+    self.request_type = config.get('request_type', 'query')
+    self.throttle = config.get('throttle', False)
+    self.max_delay = config.get('max_delay', 1.0)
+
+    self.totals = {}   # process name -> HealthTotals
+    self._pending = []  # windows not yet sent to the master
+    self._greenlets = []
+    self._reset()
+
+  def _reset(self):
+    self._lags = []
+    self._requests = 0
+    self._server_seconds = 0.0
+    self._window_start = timer()
+    self._cpu_start = sum(os.times()[:2])
+
+  def install(self):
+    """Attach the monitor to the locust events it needs."""
+    locust.events.request_success += self.on_request
+    locust.events.request_failure += self.on_request
+    locust.events.report_to_master += self.on_report_to_master
+    locust.events.slave_report += self.on_slave_report
+    locust.events.locust_start_hatching += self.start
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def start(self, **kwargs):
+    """Start measuring, unless already started. Masters only collect."""
+    if self._greenlets or messaging.is_master():
+      return
+    self._reset()
+    self._greenlets = [gevent.spawn(self._probe), gevent.spawn(self._run)]
+
+  def _probe(self):
+    interval = self.probe_interval
+    while True:
+      start_time = timer()
+      gevent.sleep(interval)
+      self._lags.append(max(timer() - start_time - interval, 0.0) * 1000)
+
+  def _run(self):
+    while True:
+      gevent.sleep(self.interval)
+      self.end_window()
+
+  def on_request(self, request_type, name, response_time,
+                 response_time_seconds=None, **kwargs):
+    if request_type != self.request_type:
+      return
+    self._requests += 1
+    if response_time_seconds is None:
+      response_time_seconds = response_time / 1000.0
+    self._server_seconds += response_time_seconds
+
+  def end_window(self):
+    """Measure the window that just ended, and start a new one."""
+    global _delay
+    duration = timer() - self._window_start
+    cpu_seconds = sum(os.times()[:2]) - self._cpu_start
+    lags = sorted(self._lags)
+    requests = self._requests
+    cpu_percent = cpu_seconds / duration * 100 if duration else 0.0
+    lag_p99 = _percentile(lags, 0.99)
+    saturated = lag_p99 > self.max_lag_ms or cpu_percent > self.max_cpu_percent
+
+    if self.throttle:
+      # Back off exponentially while saturated, and recover the same way
+      if saturated:
+        _delay = min(max(_delay * 2, MIN_DELAY), self.max_delay)
+      else:
+        _delay = _delay / 2 if _delay / 2 >= MIN_DELAY else 0.0
+
+    window = HealthWindow(
+      duration=duration, cpu_percent=cpu_percent,
+      lag_p50=_percentile(lags, 0.5), lag_p99=lag_p99,
+      lag_max=lags[-1] if lags else 0.0, requests=requests,
+      harness_ms=cpu_seconds * 1000 / requests if requests else 0.0,
+      server_ms=self._server_seconds * 1000 / requests if requests else 0.0,
+      delay=_delay, saturated=saturated)
+    self._reset()
+
+    if saturated:
+      logger.warning("Load generator saturated: {0:.0f}% CPU, p99 event loop lag "
+                     "{1:.1f} ms; latencies measured now are inflated by the "
+                     "client{2}".format(cpu_percent, lag_p99,
+                                        ", holding back queries for {0:.2f}s".format(
+                                          _delay) if _delay else ''))
+    self._add('local', window)
+    if messaging.is_slave():
+      self._pending.append(window)
+    return window
+
+  def _add(self, name, window):
+    if name not in self.totals:
+      self.totals[name] = HealthTotals()
+    self.totals[name].add(window)
+
+  def on_report_to_master(self, client_id, data):
+    data['generator_health'] = [list(window) for window in self._pending]
+    self._pending = []
+
+  def on_slave_report(self, client_id, data):
+    for values in data.get('generator_health', []):
+      window = HealthWindow(*values)
+      self._add(client_id, window)
+      if window.saturated:
+        logger.warning("Load generator {0} saturated: {1:.0f}% CPU, p99 event "
+                       "loop lag {2:.1f} ms".format(client_id, window.cpu_percent,
+                                                    window.lag_p99))
+
+  def on_quitting(self, **kwargs):
+    """Print the generator health section of the run output."""
+    for greenlet in self._greenlets:
+      greenlet.kill()
+    if self._greenlets and messaging.is_slave():
+      return
+    if self._greenlets and timer() - self._window_start >= 1:
+      # The last, partial window, unless it's too short to measure
+      self.end_window()
+    if not self.totals:
+      return
+
+    console_logger.info("")
+    console_logger.info("Generator health ({0} requests):".format(self.request_type))
+    for line in format_totals(self.totals):
+      console_logger.info(line)
+    saturated = sum(total.saturated for total in self.totals.values())
+    windows = sum(total.windows for total in self.totals.values())
+    if saturated:
+      console_logger.info(
+        "WARNING: the load generator was saturated in {0} of {1} windows, so "
+        "it may have limited the load, and inflated the latencies, more than "
+        "Impala did. Run with fewer users per process, or more processes "
+        "(e.g., with impala-locust).".format(saturated, windows))
+    else:
+      console_logger.info("The load generator kept up: no saturated windows.")
+    console_logger.info("")
@@ -0,0 +1,325 @@
+"""High-resolution, mergeable latency histograms for locust requests."""
+
+import csv
+import locust
+import logging
+import math
+import six
+
+from collections import defaultdict
+
+from impala_loadtest import events, messaging
+from impala_loadtest.common import timer
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.histogram')
+
+# Percentiles included in the report
+REPORT_PERCENTILES = (50, 75, 90, 95, 99, 99.9, 99.99)
+
+# The LatencyIndex shared by all users in this process
+_latency_index = None
+
+
+class LatencyHistogram(object):
+  """
+  A log-linear (HDR-style) histogram of latencies, in whole microseconds.
+
+  Values are counted in buckets whose width grows with their magnitude, so
+  every value is recorded to within a fixed relative precision, from single
+  microseconds up to hours, in a small, sparse dict of bucket counts. With the
+  default of 3 significant figures, buckets are at most 1/1024 of the values
+  in them wide, so values are within about 0.1%. Recording a value is a few
+  integer operations and a dict update.
+
+  Histograms can be merged by adding their bucket counts, so per-process
+  histograms can be combined into one for the whole test.
+  """
+
+  def __init__(self, significant_figures=3):
+    # Values below 2 ** sub_bucket_bits are counted exactly. Above that,
+    # each power of two is split into 2 ** (sub_bucket_bits - 1) buckets.
+    self.significant_figures = significant_figures
+    self.sub_bucket_bits = int(math.ceil(math.log(10 ** significant_figures, 2))) + 1
+    self._half = 1 << (self.sub_bucket_bits - 1)
+    self.reset()
+
+  def reset(self):
+    self.counts = defaultdict(int)
+    self.total_count = 0
+    self.min = None
+    self.max = None
+    self.sum = 0
+
+  def record(self, value):
+    """Record a single latency, in microseconds."""
+    value = int(value)
+    if value < 0:
+      value = 0
+
+    shift = value.bit_length() - self.sub_bucket_bits
+    if shift > 0:
+      self.counts[(shift << (self.sub_bucket_bits - 1)) + (value >> shift)] += 1
+    else:
+      self.counts[value] += 1
+
+    self.total_count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def _bucket_range(self, index):
+    """Return the (lowest, highest) values counted in the given bucket."""
+    if index < 2 * self._half:
+      return index, index
+    shift = index // self._half - 1
+    lowest = (index - shift * self._half) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+  def percentile(self, percentile):
+    """
+    Return the value at the given percentile (0-100), in microseconds.
+
+    As in HdrHistogram, this is the highest value that is equivalent (within
+    the histogram's precision) to the recorded value at that percentile.
+    """
+    if not self.total_count:
+      return None
+    target = max(int(math.ceil(percentile / 100.0 * self.total_count)), 1)
+    seen = 0
+    for index in sorted(self.counts):
+      seen += self.counts[index]
+      if seen >= target:
+        return min(self._bucket_range(index)[1], self.max)
+    return self.max
+
+  def merge(self, other):
+    """Add the counts from another histogram (or its serialized form)."""
+    if isinstance(other, dict):
+      other = LatencyHistogram.unserialize(other, self.significant_figures)
+    assert other.significant_figures == self.significant_figures, \
+        "Can't merge histograms with different precision"
+
+    for index, count in six.iteritems(other.counts):
+      self.counts[index] += count
+    self.total_count += other.total_count
+    self.sum += other.sum
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+    return self
+
+  def serialize(self):
+    """Return the histogram as msgpack-friendly builtins."""
+    return {
+      'significant_figures': self.significant_figures,
+      'counts': [[index, count] for index, count in six.iteritems(self.counts)],
+      'total_count': self.total_count,
+      'min': self.min,
+      'max': self.max,
+      'sum': self.sum,
+    }
+
+  @classmethod
+  def unserialize(cls, data, significant_figures=3):
+    histogram = cls(data.get('significant_figures', significant_figures))
+    for index, count in data['counts']:
+      histogram.counts[index] += count
+    histogram.total_count = data['total_count']
+    histogram.min = data['min']
+    histogram.max = data['max']
+    histogram.sum = data['sum']
+    return histogram
+
+
+class LatencyRecorder(object):
+  """
+  Records every request's latency into a LatencyHistogram per request name.
+
+  Request times are taken from the response_time_seconds keyword argument of
+  the request_success/request_failure events when it's present (as it is for
+  queries logged by DbApiLocustClient), and otherwise from locust's integer
+  millisecond response_time. The harness's own timings, fired on the metric
+  hooks in impala_loadtest.events, are recorded the same way.
+
+  When running distributed, each slave sends its histograms to the master
+  with its regular stats report, then starts over, and the master merges
+  them. At shutdown, the master (or the only process, when not distributed)
+  writes a CSV report with the percentiles of each request name.
+  """
+
+  def __init__(self, report_file, significant_figures=3):
+    """
+    Args:
+      report_file: path of the CSV percentile report to write at shutdown
+      significant_figures: precision of the histograms
+    """
+    self.report_file = report_file
+    self.significant_figures = significant_figures
+    self.histograms = {}  # (request_type, name) -> LatencyHistogram
+    self.failures = defaultdict(int)  # (request_type, name) -> failure count
+
+  def install(self):
+    """Attach the recorder to the locust events it needs."""
+    locust.events.request_success += self.on_request_success
+    locust.events.request_failure += self.on_request_failure
+    events.metric_success += self.on_request_success
+    events.metric_failure += self.on_request_failure
+    locust.events.report_to_master += self.on_report_to_master
+    locust.events.slave_report += self.on_slave_report
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def _histogram(self, key):
+    if key not in self.histograms:
+      self.histograms[key] = LatencyHistogram(self.significant_figures)
+    return self.histograms[key]
+
+  def on_request_success(self, request_type, name, response_time,
+                         response_time_seconds=None, **kwargs):
+    if response_time_seconds is not None:
+      micros = response_time_seconds * 1000000
+    else:
+      micros = response_time * 1000
+    self._histogram((request_type, name)).record(micros)
+
+  def on_request_failure(self, request_type, name, response_time,
+                         response_time_seconds=None, **kwargs):
+    self.failures[(request_type, name)] += 1
+
+  def on_report_to_master(self, client_id, data):
+    data['latency_histograms'] = [
+      [request_type, name, histogram.serialize()]
+      for (request_type, name), histogram in six.iteritems(self.histograms)]
+    data['latency_failures'] = [
+      [request_type, name, count]
+      for (request_type, name), count in six.iteritems(self.failures)]
+    self.histograms = {}
+    self.failures = defaultdict(int)
+
+  def on_slave_report(self, client_id, data):
+    for request_type, name, histogram in data.get('latency_histograms', []):
+      self._histogram((request_type, name)).merge(histogram)
+    for request_type, name, count in data.get('latency_failures', []):
+      self.failures[(request_type, name)] += count
+
+  def on_quitting(self, **kwargs):
+    if messaging.is_slave():
+      return
+    self.write_report()
+
+  def report_rows(self):
+    """Return the rows of the percentile report, with latencies in ms."""
+    def ms(micros):
+      return '' if micros is None else '{0:.3f}'.format(micros / 1000.0)
+
+    rows = []
+    keys = sorted(set(self.histograms) | set(self.failures))
+    for request_type, name in keys:
+      histogram = self.histograms.get((request_type, name),
+                                      LatencyHistogram(self.significant_figures))
+      rows.append([request_type, name, histogram.total_count,
+                   self.failures[(request_type, name)], ms(histogram.min)] +
+                  [ms(histogram.percentile(p)) for p in REPORT_PERCENTILES] +
+                  [ms(histogram.max)])
+    return rows
+
+  def write_report(self):
+    header = (['Type', 'Name', '# successes', '# failures', 'Min (ms)'] +
+              ['p{0:g} (ms)'.format(p) for p in REPORT_PERCENTILES] +
+              ['Max (ms)'])
+    with open(self.report_file, 'w') as outfile:
+      writer = csv.writer(outfile)
+      writer.writerow(header)
+      writer.writerows(self.report_rows())
+    logger.info("Wrote latency percentiles to {0}".format(self.report_file))
+
+
+class LatencyIndex(object):
+  """
+  A live index of the latencies of successful requests, by request name.
+
+  The index is fed by the request_success event, so it's always up to date
+  with the requests made in this process, and doesn't depend on locust's
+  --csv output. Tasks can use it to look up, e.g., the median time of a
+  query so far, in order to time a cancellation.
+
+  Percentiles are cached per request for up to refresh_interval seconds, so
+  lookups from a hot task path are a dict lookup in the common case, rather
+  than a walk over the histogram's buckets.
+
+  When running distributed, each slave's index only covers the requests made
+  by that slave's own users.
+  """
+
+  def __init__(self, significant_figures=2, refresh_interval=1.0):
+    """
+    Args:
+      significant_figures: precision of the histograms
+      refresh_interval: maximum age, in seconds, of a cached percentile
+    """
+    self.significant_figures = significant_figures
+    self.refresh_interval = refresh_interval
+    self.histograms = {}  # (request_type, name) -> LatencyHistogram
+    self._names = defaultdict(list)  # request_type -> names, in order seen
+    self._cache = {}  # (request_type, name, percentile) -> (time, seconds)
+
+  def install(self):
+    """Attach the index to the request_success event."""
+    locust.events.request_success += self.on_request_success
+    return self
+
+  def on_request_success(self, request_type, name, response_time,
+                         response_time_seconds=None, **kwargs):
+    if response_time_seconds is not None:
+      micros = response_time_seconds * 1000000
+    else:
+      micros = response_time * 1000
+    key = (request_type, name)
+    if key not in self.histograms:
+      self.histograms[key] = LatencyHistogram(self.significant_figures)
+      self._names[request_type].append(name)
+    self.histograms[key].record(micros)
+
+  def names(self, request_type='query'):
+    """Return the names of the requests of the given type seen so far."""
+    return self._names[request_type]
+
+  def count(self, name, request_type='query'):
+    """Return the number of successful requests with the given name."""
+    histogram = self.histograms.get((request_type, name))
+    return histogram.total_count if histogram else 0
+
+  def percentile(self, name, percentile, request_type='query'):
+    """
+    Return a percentile (0-100) of the latency of a request, in seconds.
+
+    Returns None if there have been no successful requests with this name.
+    """
+    cache_key = (request_type, name, percentile)
+    cached = self._cache.get(cache_key)
+    now = timer()
+    if cached is not None and now - cached[0] < self.refresh_interval:
+      return cached[1]
+
+    histogram = self.histograms.get((request_type, name))
+    if histogram is None:
+      return None
+    seconds = histogram.percentile(percentile) / 1000000.0
+    self._cache[cache_key] = (now, seconds)
+    return seconds
+
+  def median(self, name, request_type='query'):
+    """Return the median latency of a request, in seconds."""
+    return self.percentile(name, 50, request_type)
+
+
+def get_latency_index():
+  """Return the LatencyIndex shared by this process, installing it if needed."""
+  global _latency_index
+  if _latency_index is None:
+    _latency_index = LatencyIndex().install()
+  return _latency_index
@@ -0,0 +1,124 @@
+"""Launch a locust master and one locust slave per CPU core on the local host."""
+
+import argparse
+import logging
+import multiprocessing
+import signal
+import subprocess
+import sys
+import time
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.launcher')
+logger.setLevel(logging.INFO)
+
+# Seconds to wait for processes to exit after being signalled, before they
+# are killed outright
+SHUTDOWN_TIMEOUT = 10
+
+# Locust options that must also be given to every slave process, along with
+# whether each one takes a value
+SLAVE_OPTIONS = {
+  '--reset-stats': False,
+  '--loglevel': True,
+  '-L': True,
+  '--heartbeat-liveness': True,
+  '--heartbeat-interval': True,
+}
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description="Run a locust file in distributed mode on the local host: one "
+                "master process, plus one slave process per CPU core. Any "
+                "other arguments are passed through to the locust master, "
+                "which splits the requested number of users (-c) across the "
+                "slaves. The CONFIG environment variable is inherited by all "
+                "processes, so they all share the same TestConfig.")
+  parser.add_argument('-f', '--locustfile', required=True,
+                      help="Python module file to import, e.g. test_tpcds_load.py")
+  parser.add_argument('-w', '--workers', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help="Number of slave processes to start (default: one "
+                           "per CPU core, i.e. %(default)s)")
+  parser.add_argument('--master-port', type=int, default=5557,
+                      help="Port for the master to bind to. Locust also uses "
+                           "this port + 1 (default: %(default)s)")
+  return parser
+
+
+def get_commands(options, locust_args):
+  """
+  Return the command lines for the master and slave processes.
+
+  Args:
+    options: the parsed launcher options
+    locust_args: the remaining arguments, which are passed to the master
+  """
+  locust = [sys.executable, '-m', 'locust', '-f', options.locustfile]
+  port = ['--master-port', str(options.master_port)]
+
+  master = locust + ['--master', '--master-bind-port', str(options.master_port)]
+  if '--no-web' in locust_args and '--expect-slaves' not in locust_args:
+    master += ['--expect-slaves', str(options.workers)]
+  master += locust_args
+
+  slave = locust + ['--slave', '--master-host', '127.0.0.1'] + port
+  args = iter(locust_args)
+  for arg in args:
+    name = arg.split('=')[0]
+    if name in SLAVE_OPTIONS:
+      slave.append(arg)
+      if SLAVE_OPTIONS[name] and '=' not in arg:
+        slave.append(next(args, ''))
+
+  return master, [slave] * options.workers
+
+
+def _terminate(processes):
+  """Ask each process to exit, then kill any that are still running."""
+  for process in processes:
+    if process.poll() is None:
+      process.send_signal(signal.SIGINT)
+
+  deadline = time.time() + SHUTDOWN_TIMEOUT
+  for process in processes:
+    while process.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+    if process.poll() is None:
+      process.kill()
+
+
+def main(argv=None):
+  options, locust_args = get_parser().parse_known_args(argv)
+  if options.workers < 1:
+    logger.error("--workers must be >= 1")
+    return 1
+
+  master_cmd, slave_cmds = get_commands(options, locust_args)
+
+  logger.info("Starting locust master: {0}".format(' '.join(master_cmd)))
+  master = subprocess.Popen(master_cmd)
+
+  logger.info("Starting {0} locust slaves".format(len(slave_cmds)))
+  slaves = [subprocess.Popen(cmd) for cmd in slave_cmds]
+
+  # SIGINT is delivered to the whole process group, so the master and slaves
+  # get it directly; the launcher only needs to wait for them to exit.
+  signal.signal(signal.SIGINT, lambda signum, frame: None)
+  signal.signal(signal.SIGTERM, lambda signum, frame: _terminate([master] + slaves))
+
+  try:
+    while master.poll() is None:
+      if all(slave.poll() is not None for slave in slaves):
+        logger.info("All locust slaves have exited, stopping the master")
+        break
+      time.sleep(0.5)
+  finally:
+    _terminate([master] + slaves)
+
+  return master.returncode
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Stepped load profiles, for finding the load at which throughput saturates.
+
+Rather than re-running a test once per concurrency level, a LoadProfile steps
+a single run through a series of stages, each with a number of users (or an
+open loop arrival rate, per user), and measures each stage's throughput,
+latency and error rate. Past some point, adding load stops adding
+throughput, and only makes queries queue up or fail; the last stage before
+that point is reported as the knee.
+
+The profile is set in the load_profile section of the config file, either as
+a list of stages:
+
+  load_profile:
+    stages:
+      - {users: 8, duration: 300}
+      - {users: 16, duration: 300}
+      - {users: 32, duration: 300}
+
+or as a ramp, which expands to stages from start to stop (inclusive):
+
+  load_profile:
+    ramp: {load: users, start: 8, stop: 64, step: 8, duration: 300}
+
+with load: target_qps to step the arrival rate of an open loop test instead.
+Other settings, all optional:
+
+  hatch_rate: users started per second when moving up a stage (default 10)
+  warmup: seconds at the start of each stage that aren't measured, to allow
+    for hatching and queues to settle (default 30, at most half the stage)
+  request_type: the requests to measure (default 'query')
+  report: file name for a CSV of the per-stage results
+  stop_at_knee: end the run as soon as the knee has been found (default False)
+  knee: thresholds for find_knee(), i.e., min_scaling, latency_growth and
+    max_error_rate
+
+Once the last stage ends, the test stops. Any --run-time limit should be
+long enough to cover all of the stages. When running distributed, the master
+only sees the slaves' requests in their stats reports, every 3 seconds, so
+stages should last minutes rather than seconds.
+"""
+
+import collections
+import csv
+import gevent
+import locust
+import logging
+
+from locust.log import console_logger
+from locust.runners import STATE_HATCHING
+from locust.stats import calculate_response_time_percentile, diff_response_time_dicts
+
+from impala_loadtest import messaging, openloop
+from impala_loadtest.common import timer
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.loadprofile')
+
+# Message type for sending arrival rate changes to the slaves
+MESSAGE_TYPE = 'impala_loadtest_load_profile'
+
+# Kinds of load a profile can step through
+LOAD_TYPES = ('users', 'target_qps')
+
+# Percentiles reported for each stage
+STAGE_PERCENTILES = (0.5, 0.95, 0.99)
+
+# The measured results of one stage, numbered from 1. Latencies are in
+# milliseconds, and throughput is successful requests per second.
+StageResult = collections.namedtuple(
+  'StageResult', ['stage', 'load_type', 'load', 'users', 'duration', 'requests',
+                  'failures', 'throughput', 'error_rate', 'p50', 'p95', 'p99'])
+
+# Request counts and response times of some requests at a point in time
+_Snapshot = collections.namedtuple(
+  '_Snapshot', ['requests', 'failures', 'response_times'])
+
+
+def expand_stages(config):
+  """
+  Return the list of stages in a load_profile config, as dicts with one of
+  LOAD_TYPES as a key, plus a duration in seconds.
+  """
+  if 'ramp' in config:
+    ramp = config['ramp']
+    load_type = ramp.get('load', 'users')
+    start, stop, step = ramp['start'], ramp['stop'], ramp['step']
+    assert step > 0, "Load profile ramp step must be > 0"
+    stages = []
+    count = int((stop - start) / float(step) + 1e-9) + 1
+    for i in range(count):
+      # Rounded, so that steps like 0.1 qps don't accumulate float error
+      load = start + i * step if isinstance(step, int) else round(start + i * step, 6)
+      stages.append({load_type: load, 'duration': ramp['duration']})
+  else:
+    stages = [dict(stage) for stage in config['stages']]
+
+  assert stages, "Load profile has no stages"
+  for stage in stages:
+    load_types = [load_type for load_type in LOAD_TYPES if load_type in stage]
+    assert len(load_types) == 1, \
+        "Each load profile stage must set one of: {0}".format(', '.join(LOAD_TYPES))
+    assert stage.get('duration', 0) > 0, "Each load profile stage needs a duration"
+  return stages
+
+
+def find_knee(results, min_scaling=0.5, latency_growth=0.2, max_error_rate=0.01):
+  """
+  Find the stage at which throughput saturated.
+
+  A stage is saturated when, compared to the stage before it, throughput grew
+  by less than min_scaling times as much as the load did (e.g., 10% more
+  throughput for 50% more users, with the default of 0.5), and either p95
+  latency grew by more than latency_growth (a fraction), or the error rate
+  rose above max_error_rate. That is, the extra load only went into queueing
+  or failures.
+
+  Args:
+    results: a list of StageResult, in the order the stages were run
+
+  Returns:
+    the index in results of the last stage before the first saturated stage,
+    i.e., the highest load that still paid off, or None if no stage was
+    saturated
+  """
+  for i in range(1, len(results)):
+    previous, current = results[i - 1], results[i]
+    if not previous.load or not previous.throughput:
+      continue
+    load_gain = float(current.load) / previous.load - 1
+    throughput_gain = current.throughput / previous.throughput - 1
+    if load_gain <= 0 or throughput_gain >= min_scaling * load_gain:
+      continue
+
+    slower = current.p95 > previous.p95 * (1 + latency_growth)
+    failing = (current.error_rate > max_error_rate and
+               current.error_rate > previous.error_rate)
+    if slower or failing:
+      return i - 1
+  return None
+
+
+def format_results(results, knee=None):
+  """Return the per-stage results as lines of a fixed-width table."""
+  lines = [' {0:>5} {1:>10} {2:>10} {3:>6} {4:>8} {5:>8} {6:>9} {7:>7}  | '
+           '{8:>7} {9:>7} {10:>7}'.format(
+             'Stage', 'Load', 'Type', 'Users', 'Duration', '# reqs', 'req/s',
+             'Error %', '50%', '95%', '99%')]
+  lines.append('-' * len(lines[0]))
+  for i, result in enumerate(results):
+    lines.append(' {0:>5} {1:>10} {2:>10} {3:>6} {4:>8.0f} {5:>8} {6:>9.2f} '
+                 '{7:>7.2f}  | {8:>7} {9:>7} {10:>7}{11}'.format(
+                   result.stage, result.load, result.load_type, result.users,
+                   result.duration, result.requests, result.throughput,
+                   result.error_rate * 100, result.p50, result.p95, result.p99,
+                   '  <- knee' if i == knee else ''))
+  if knee is None:
+    lines.append('No knee found: no stage added load without adding throughput')
+  return lines
+
+
+def write_results(path, results, knee=None):
+  """Write the per-stage results to a CSV file, with a column for the knee."""
+  with open(path, 'w') as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(list(StageResult._fields) + ['knee'])
+    for i, result in enumerate(results):
+      writer.writerow(list(result) + [i == knee])
+
+
+class LoadProfile(object):
+  """
+  Steps the load through stages, measuring each one from locust's stats.
+
+  Stages are run by the master, or by the only process when not running
+  distributed. User counts are changed through the runner, the same as
+  when the user count is changed in the web UI, and arrival rates by
+  sending the new rate to every slave. Results come from locust's own
+  (aggregated) request stats, so the profile works the same in either mode.
+  """
+
+  def __init__(self, config):
+    """
+    Args:
+      config: the load_profile section of the config file (see the module
+        docstring)
+    """
+    self.stages = expand_stages(config)
+    self.hatch_rate = config.get('hatch_rate', 10)
+    self.warmup = config.get('warmup', 30)
+    self.request_type = config.get('request_type', 'query')
+    self.report = config.get('report')
+    self.stop_at_knee = config.get('stop_at_knee', False)
+    self.knee_thresholds = config.get('knee') or {}
+    self.results = []
+    self.knee = None
+    self._greenlet = None
+
+  def install(self):
+    """Attach the profile to the locust events, so it starts with the test."""
+    locust.events.locust_start_hatching += self.start
+    locust.events.master_start_hatching += self.start
+    locust.events.quitting += self.on_quitting
+    messaging.register_message(MESSAGE_TYPE, self.on_message)
+    return self
+
+  def start(self, **kwargs):
+    """Start stepping through the stages, unless this process is a slave."""
+    if messaging.is_slave() or self._greenlet is not None:
+      return
+    self._greenlet = gevent.spawn(self._run)
+
+  def _run(self):
+    runner = messaging.get_runner()
+    # Let the initial hatch finish, so it doesn't race with the first stage
+    while runner.state == STATE_HATCHING:
+      gevent.sleep(0.5)
+
+    for i, stage in enumerate(self.stages):
+      self._apply(runner, stage)
+      warmup = min(self.warmup, stage['duration'] / 2.0)
+      gevent.sleep(warmup)
+
+      before = self._snapshot(runner.stats)
+      start_time = timer()
+      gevent.sleep(stage['duration'] - warmup)
+      result = self._measure(i, stage, before, self._snapshot(runner.stats),
+                             timer() - start_time, runner.user_count)
+      self.results.append(result)
+      logger.info("Load profile stage {0}: {1} {2}, {3:.2f} req/s, p95 {4} ms, "
+                  "{5:.2f}% errors".format(i + 1, result.load, result.load_type,
+                                           result.throughput, result.p95,
+                                           result.error_rate * 100))
+
+      self.knee = find_knee(self.results, **self.knee_thresholds)
+      if self.knee is not None and self.stop_at_knee:
+        logger.info("Throughput saturated after stage {0}; stopping".format(
+          self.knee + 1))
+        break
+
+    if runner.options.no_web:
+      runner.quit()
+    else:
+      runner.stop()
+
+  def _apply(self, runner, stage):
+    if 'users' in stage:
+      runner.start_hatching(stage['users'], self.hatch_rate)
+    else:
+      if messaging.is_master():
+        messaging.send_to_slaves(MESSAGE_TYPE, {'target_qps': stage['target_qps']})
+      else:
+        openloop.set_rate(stage['target_qps'])
+
+  def on_message(self, data, client_id):
+    """Apply an arrival rate sent by the master."""
+    openloop.set_rate(data['target_qps'])
+
+  def _snapshot(self, stats):
+    requests = failures = 0
+    response_times = {}
+    for (name, request_type), entry in list(stats.entries.items()):
+      if request_type != self.request_type:
+        continue
+      requests += entry.num_requests
+      failures += entry.num_failures
+      for response_time, count in entry.response_times.items():
+        response_times[response_time] = response_times.get(response_time, 0) + count
+    return _Snapshot(requests, failures, response_times)
+
+  def _measure(self, i, stage, before, after, duration, users):
+    if after.requests < before.requests or after.failures < before.failures:
+      # The stats were reset during the stage (e.g., with --reset-stats)
+      logger.warning("Stats were reset during load profile stage {0}; only "
+                     "requests since the reset are counted".format(i + 1))
+      before = _Snapshot(0, 0, {})
+
+    # Locust counts failures in num_requests too, so requests is the total
+    requests = after.requests - before.requests
+    failures = after.failures - before.failures
+    response_times = diff_response_time_dicts(after.response_times,
+                                              before.response_times)
+    p50, p95, p99 = [
+      calculate_response_time_percentile(response_times, requests, percentile)
+      for percentile in STAGE_PERCENTILES]
+
+    load_type = 'users' if 'users' in stage else 'target_qps'
+    return StageResult(
+      stage=i + 1, load_type=load_type, load=stage[load_type], users=users,
+      duration=duration, requests=requests, failures=failures,
+      throughput=(requests - failures) / duration if duration else 0.0,
+      error_rate=float(failures) / requests if requests else 0.0,
+      p50=p50, p95=p95, p99=p99)
+
+  def on_quitting(self, **kwargs):
+    """Print the per-stage results, and write them to the report file."""
+    if not self.results:
+      return
+    console_logger.info("")
+    console_logger.info("Load profile ({0} requests):".format(self.request_type))
+    for line in format_results(self.results, self.knee):
+      console_logger.info(line)
+    if self.knee is not None:
+      knee = self.results[self.knee]
+      console_logger.info("Throughput saturates at {0} {1}, {2:.2f} req/s".format(
+        knee.load, knee.load_type, knee.throughput))
+    console_logger.info("")
+
+    if self.report:
+      write_results(self.report, self.results, self.knee)
@@ -0,0 +1,113 @@
+"""Custom messages between a locust master and its slaves."""
+
+import logging
+
+from locust import runners
+from locust.rpc import Message, rpc
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.messaging')
+
+# Handlers for custom message types, keyed by message type
+_handlers = {}
+
+
+def get_runner():
+  """Return the active locust runner, or None if it hasn't been created yet."""
+  return runners.locust_runner
+
+
+def is_master():
+  return isinstance(get_runner(), runners.MasterLocustRunner)
+
+
+def is_slave():
+  return isinstance(get_runner(), runners.SlaveLocustRunner)
+
+
+def is_distributed():
+  return is_master() or is_slave()
+
+
+def register_message(msg_type, handler):
+  """
+  Register a handler for a custom message type.
+
+  On the master, the handler is called as handler(data, client_id) for each
+  message of this type sent by a slave. On a slave, it's called as
+  handler(data, None) for each message of this type sent by the master.
+
+  Handlers run in the greenlet that receives messages from the network, so
+  they must not block.
+  """
+  _handlers[msg_type] = handler
+
+
+def send_to_master(msg_type, data):
+  """Send a custom message from a slave to the master."""
+  runner = get_runner()
+  runner.client.send(Message(msg_type, data, runner.client_id))
+
+
+def send_to_slaves(msg_type, data, client_id=None):
+  """
+  Send a custom message from the master to one slave, or to all of them.
+
+  Args:
+    msg_type: a message type with a handler registered on the slaves
+    data: the message payload, which must be serializable by msgpack
+    client_id: the slave to send to, or None to send to all slaves
+  """
+  runner = get_runner()
+  client_ids = [client_id] if client_id else list(runner.clients)
+  for node_id in client_ids:
+    runner.server.send_to_client(Message(msg_type, data, node_id))
+
+
+def _dispatch(msg, client_id):
+  """Call the handler for a custom message. Returns False for other messages."""
+  handler = _handlers.get(msg.type)
+  if handler is None:
+    return False
+  try:
+    handler(msg.data, client_id)
+  except Exception:
+    logger.exception("Error handling {0} message".format(msg.type))
+  return True
+
+
+def _install():
+  """
+  Route custom messages received by this process to their handlers.
+
+  Locust 0.13 silently drops message types it doesn't know about, so the
+  socket receive methods used by the runners' listener greenlets are wrapped
+  to dispatch custom messages before locust sees them. This is done when this
+  module is imported, i.e., while the locust file is being imported and before
+  the runner starts listening, so no message can slip past.
+  """
+  socket_class = rpc.BaseSocket
+  if getattr(socket_class, '_impala_loadtest_messaging', False):
+    return
+
+  recv = socket_class.recv
+  recv_from_client = socket_class.recv_from_client
+
+  def recv_from_master(self):
+    while True:
+      msg = recv(self)
+      if not _dispatch(msg, None):
+        return msg
+
+  def recv_from_slaves(self):
+    while True:
+      client_id, msg = recv_from_client(self)
+      if not _dispatch(msg, client_id):
+        return client_id, msg
+
+  socket_class.recv = recv_from_master
+  socket_class.recv_from_client = recv_from_slaves
+  socket_class._impala_loadtest_messaging = True
+
+
+_install()
@@ -0,0 +1,327 @@
+"""Weighted workload mixes, with per-class concurrency caps."""
+
+import bisect
+import fnmatch
+import itertools
+import logging
+import os
+import random
+import six
+import yaml
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from gevent.event import AsyncResult
+
+from impala_loadtest import messaging
+from impala_loadtest.common import Workloads, timer
+from impala_loadtest.events import metric_failure, metric_success
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.mix')
+
+MESSAGE_TYPE = 'impala_loadtest_mix'
+
+
+def load_mix_config(mix, base_dir=None):
+  """
+  Return a workload mix definition as a dict.
+
+  Args:
+    mix: either the definition itself (e.g., inline in the config file), or
+      the path of a yaml file containing it
+    base_dir: directory that a relative path is resolved against
+  """
+  if isinstance(mix, dict):
+    return mix
+  path = mix
+  if base_dir is not None and not os.path.isabs(path):
+    path = os.path.join(base_dir, path)
+  if not os.path.splitext(path)[1]:
+    path += '.yaml'
+  assert os.path.exists(path), "Invalid workload mix: {}".format(path)
+  with open(path) as fh:
+    return yaml.safe_load(fh)
+
+
+class WeightedChoice(object):
+  """Choose among items in proportion to their weights, in O(log n)."""
+
+  def __init__(self, weighted_items):
+    """
+    Args:
+      weighted_items: iterable of (item, weight) pairs; weights must be >= 0
+    """
+    self.items = []
+    self.cumulative_weights = []
+    total = 0
+    for item, weight in weighted_items:
+      assert weight >= 0, "Invalid weight for {0}: {1}".format(item, weight)
+      if weight:
+        total += weight
+        self.items.append(item)
+        self.cumulative_weights.append(total)
+    assert self.items, "Nothing to choose from: all weights are zero"
+    self.total = total
+
+  def choose(self, rng=random):
+    index = bisect.bisect_right(self.cumulative_weights, rng.random() * self.total)
+    return self.items[min(index, len(self.items) - 1)]
+
+
+class QueryClass(object):
+  """A named group of queries, with a weight and an optional concurrency cap."""
+
+  def __init__(self, name, query_weights, weight=1, max_concurrency=None):
+    """
+    Args:
+      name: the class name, as reported in the per-class stats
+      query_weights: list of (query name, weight) pairs
+      weight: relative share of query starts that go to this class
+      max_concurrency: maximum number of queries of this class in flight at
+        once, across all users, or None for no limit
+    """
+    self.name = name
+    self.weight = weight
+    self.max_concurrency = max_concurrency
+    self.queries = WeightedChoice(query_weights)
+
+
+def _expand_queries(queries, names):
+  """
+  Expand a class's queries setting into (query name, weight) pairs.
+
+  The setting is either a list of query names, each with weight 1, or a dict
+  of query names to weights. Names may be fnmatch patterns (e.g., '7*.sql'),
+  in which case each matching query gets the pattern's weight.
+  """
+  if not isinstance(queries, dict):
+    queries = dict((query, 1) for query in queries)
+
+  weights = {}
+  for pattern, weight in sorted(six.iteritems(queries)):
+    matches = fnmatch.filter(names, pattern)
+    assert matches, "No queries match {0}".format(pattern)
+    for query in matches:
+      weights[query] = weight
+  return sorted(six.iteritems(weights))
+
+
+class WorkloadMix(object):
+  """
+  Chooses queries according to a weighted mix, and enforces per-class caps.
+
+  A mix is defined in yaml (see load_mix_config()) as a set of query classes:
+
+    classes:
+      dashboard:
+        weight: 80            # share of query starts
+        max_concurrency: 16   # across all users; omit for no limit
+        queries: [3.sql, 7.sql, '4*.sql']
+      report:
+        weight: 20
+        max_concurrency: 2
+        queries: {4.sql: 2, 11.sql: 1}   # per-query weights
+
+  Each query run with run() is chosen by picking a class by weight, then a
+  query within the class by weight. If the class is already at its
+  max_concurrency, the user waits for a slot, in first-come, first-served
+  order, the way a query waits in an admission control queue. Slots are
+  counted across every user in the test: when running distributed, slaves
+  ask the master for each slot. (Slots held by a slave that dies without
+  releasing them aren't recovered.)
+
+  Two extra timings are recorded per class, so its throughput and latency can
+  be compared with the others':
+
+    class / <class name>: each query in the class, timed without the wait
+    class_wait / <class name>: the time spent waiting for a slot, if capped
+
+  They're fired on impala_loadtest.events' metric hooks, rather than as
+  locust requests, so they don't add to locust's request totals; they're
+  reported by the latency report, time series and metrics export, if set up.
+
+  All users in a test should share one WorkloadMix, typically created at
+  module level in the locust file.
+  """
+
+  def __init__(self, config, query_names, namespace='default'):
+    """
+    Args:
+      config: the mix definition, as returned by load_mix_config()
+      query_names: names of all the queries in the workload (e.g., from
+        QueryCatalog.names), against which the classes' queries are matched
+      namespace: prefix for slot messages, to keep different mixes apart
+    """
+    self.namespace = namespace
+    self.classes = {}
+    for name, class_config in sorted(six.iteritems(config['classes'])):
+      self.classes[name] = QueryClass(
+        name, _expand_queries(class_config['queries'], query_names),
+        weight=class_config.get('weight', 1),
+        max_concurrency=class_config.get('max_concurrency'))
+    self._choice = WeightedChoice(
+      (name, query_class.weight) for name, query_class in sorted(six.iteritems(self.classes)))
+
+    # State for this process
+    self._grants = {}                   # slot request token -> AsyncResult
+    self._tokens = itertools.count()
+
+    # State kept by the master (or the only process, when not distributed)
+    self._in_use = defaultdict(int)     # class name -> slots in use
+    self._waiting = defaultdict(deque)  # class name -> queued slot requests
+
+    messaging.register_message(self._message_type, self._on_message)
+
+  @property
+  def _message_type(self):
+    return '{0}:{1}'.format(MESSAGE_TYPE, self.namespace)
+
+  def choose(self, rng=random):
+    """Return a (class name, query name) tuple, chosen by weight."""
+    class_name = self._choice.choose(rng)
+    return class_name, self.classes[class_name].queries.choose(rng)
+
+  @contextmanager
+  def slot(self, class_name):
+    """
+    Hold one of a class's concurrency slots, waiting for one if necessary.
+    """
+    if self.classes[class_name].max_concurrency is None:
+      yield
+      return
+
+    start_time = timer()
+    self._acquire(class_name)
+    elapsed = timer() - start_time
+    metric_success.fire(
+      request_type="class_wait", name=class_name,
+      response_time=int(elapsed * 1000), response_length=0,
+      response_time_seconds=elapsed
+    )
+    try:
+      yield
+    finally:
+      self._release(class_name)
+
+  def run(self, run_query, rng=random):
+    """
+    Choose a query from the mix, and run it within its class's limit.
+
+    Args:
+      run_query: called as run_query(class_name, query_name) to run the query,
+        e.g., with DbApiLocustClient.logged_query()
+      rng: a random.Random instance, for a reproducible sequence of queries
+
+    Returns:
+      whatever run_query returns
+    """
+    class_name, query_name = self.choose(rng)
+    with self.slot(class_name):
+      start_time = timer()
+      try:
+        result = run_query(class_name, query_name)
+      except Exception as e:
+        elapsed = timer() - start_time
+        metric_failure.fire(
+          request_type="class", name=class_name,
+          response_time=int(elapsed * 1000), response_length=len(str(e)),
+          exception=e, response_time_seconds=elapsed
+        )
+        raise
+      elapsed = timer() - start_time
+      metric_success.fire(
+        request_type="class", name=class_name,
+        response_time=int(elapsed * 1000), response_length=0,
+        response_time_seconds=elapsed
+      )
+    return result
+
+  def _acquire(self, class_name):
+    grant = AsyncResult()
+    if messaging.is_slave():
+      token = next(self._tokens)
+      self._grants[token] = grant
+      messaging.send_to_master(self._message_type,
+                               {'op': 'acquire', 'class': class_name, 'token': token})
+    else:
+      token = None
+      self._request_slot(class_name, grant)
+
+    try:
+      grant.get()
+    except BaseException:
+      # E.g., the user was killed while queued; give up its place or its slot
+      if token is not None:
+        self._grants.pop(token, None)
+        messaging.send_to_master(self._message_type,
+                                 {'op': 'abandon', 'class': class_name, 'token': token})
+      else:
+        self._abandon_slot(class_name, grant)
+      raise
+
+  def _release(self, class_name):
+    if messaging.is_slave():
+      messaging.send_to_master(self._message_type,
+                               {'op': 'release', 'class': class_name})
+    else:
+      self._release_slot(class_name)
+
+  def _request_slot(self, class_name, waiter):
+    """Grant a slot to a waiter now if one is free, otherwise queue it."""
+    if self._in_use[class_name] < self.classes[class_name].max_concurrency:
+      self._in_use[class_name] += 1
+      self._grant(waiter)
+    else:
+      self._waiting[class_name].append(waiter)
+
+  def _release_slot(self, class_name):
+    """Free a slot, handing it straight to the next waiter if there is one."""
+    if self._waiting[class_name]:
+      self._grant(self._waiting[class_name].popleft())
+    else:
+      self._in_use[class_name] -= 1
+
+  def _abandon_slot(self, class_name, waiter):
+    """Withdraw a slot request, releasing the slot if it was already granted."""
+    try:
+      self._waiting[class_name].remove(waiter)
+    except ValueError:
+      self._release_slot(class_name)
+
+  def _grant(self, waiter):
+    if isinstance(waiter, AsyncResult):
+      waiter.set(True)
+    else:
+      client_id, token = waiter
+      messaging.send_to_slaves(self._message_type,
+                               {'op': 'grant', 'token': token}, client_id)
+
+  def _on_message(self, data, client_id):
+    """Handle slot messages, on either the master or a slave."""
+    if not messaging.is_master():
+      grant = self._grants.pop(data['token'], None)
+      if data['op'] == 'grant' and grant is not None:
+        grant.set(True)
+      return
+
+    if data['op'] == 'acquire':
+      self._request_slot(data['class'], (client_id, data['token']))
+    elif data['op'] == 'release':
+      self._release_slot(data['class'])
+    elif data['op'] == 'abandon':
+      self._abandon_slot(data['class'], (client_id, data['token']))
+
+
+def get_workload_mix(workload_name, mix):
+  """
+  Return a WorkloadMix over the queries of a workload in the workloads dir.
+
+  Args:
+    workload_name: e.g., 'TPCDS'
+    mix: an inline mix definition, or the name of a yaml file in the
+      workload's mixes directory (with or without the .yaml extension)
+  """
+  catalog = Workloads.get_query_catalog(workload_name)
+  config = load_mix_config(mix, Workloads.get_mixes_directory(workload_name))
+  return WorkloadMix(config, catalog.names, namespace=workload_name)
@@ -0,0 +1,158 @@
+"""Open-loop (constant arrival rate) scheduling of requests."""
+
+import gevent
+import logging
+import random
+import weakref
+
+from gevent.pool import Pool
+
+from impala_loadtest.common import timer
+from impala_loadtest.events import metric_success
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.openloop')
+
+ARRIVAL_DISTRIBUTIONS = ('poisson', 'fixed')
+
+# The schedulers currently running in this process, for set_rate()
+_schedulers = weakref.WeakSet()
+
+# The last rate given to set_rate(), if any
+_rate = None
+
+
+def arrival_intervals(rate, distribution='poisson', rng=random):
+  """
+  Generate the intervals, in seconds, between successive arrivals.
+
+  Args:
+    rate: mean number of arrivals per second
+    distribution: 'poisson' for exponentially-distributed intervals, or
+      'fixed' for evenly-spaced arrivals
+    rng: a random.Random instance, for reproducible schedules
+  """
+  assert rate > 0, "Arrival rate must be > 0"
+  assert distribution in ARRIVAL_DISTRIBUTIONS, \
+      "Invalid arrival distribution: {0}".format(distribution)
+
+  if distribution == 'fixed':
+    interval = 1.0 / rate
+    while True:
+      yield interval
+  else:
+    while True:
+      yield rng.expovariate(rate)
+
+
+class OpenLoopScheduler(object):
+  """
+  Starts requests on a fixed schedule, regardless of how long they take.
+
+  In a closed loop (the usual locust model), each user waits for its request
+  to finish before issuing the next one, so the offered load drops as the
+  server slows down, and queueing delay goes unmeasured. Here, arrivals are
+  scheduled up front at the target rate, and each one runs in its own
+  greenlet, up to max_concurrency at a time.
+
+  If all greenlets are busy when an arrival is due, it starts as soon as one
+  frees up, and the schedule isn't shifted to compensate. The time between
+  each request's scheduled and actual start is recorded as the
+  "schedule / start lag" timing (on impala_loadtest.events' metric hooks, so
+  that it's in the latency report, time series and metrics export without
+  adding to locust's request totals), so that coordinated omission is visible
+  rather than hidden: a growing lag means the ceiling (or the load generator
+  itself) is holding back the offered load. Each request reports its own
+  start lag with report_start_lag(), once it's ready to start timing, so
+  that waits for its resources (e.g., a session) count as lag too.
+  """
+
+  def __init__(self, rate, distribution='poisson', max_concurrency=100, seed=None):
+    """
+    Args:
+      rate: target number of requests started per second
+      distribution: 'poisson' or 'fixed'; see arrival_intervals()
+      max_concurrency: maximum number of requests in flight at once
+      seed: seed for the arrival schedule, for reproducible runs
+    """
+    self.rate = rate
+    self.distribution = distribution
+    self.max_concurrency = max_concurrency
+    self.rng = random.Random(seed)
+    self._pool = Pool(max_concurrency)
+
+  def run(self, func, duration=None):
+    """
+    Call func(scheduled_start) at each scheduled arrival, each call in its
+    own greenlet. func should call report_start_lag(scheduled_start) just
+    before it starts timing its request.
+
+    Blocks until duration seconds have passed, or forever if duration is None.
+    Requests still in flight are killed if this greenlet is killed (e.g.,
+    when locust stops the user), so they don't outlive the test.
+
+    The rate can be changed while running, with set_rate(); the new rate
+    applies from the next arrival.
+    """
+    start_time = next_start = timer()
+    _schedulers.add(self)
+    rate = self.rate
+    intervals = arrival_intervals(rate, self.distribution, self.rng)
+    try:
+      while True:
+        if self.rate != rate:
+          rate = self.rate
+          intervals = arrival_intervals(rate, self.distribution, self.rng)
+        next_start += next(intervals)
+        if duration is not None and next_start - start_time > duration:
+          break
+
+        delay = next_start - timer()
+        if delay > 0:
+          gevent.sleep(delay)
+
+        # Blocks while max_concurrency requests are already in flight
+        self._pool.spawn(func, next_start)
+
+      self._pool.join()
+    finally:
+      _schedulers.discard(self)
+      self._pool.kill()
+
+
+def report_start_lag(scheduled_start):
+  """
+  Record the time from an arrival's scheduled start until now, when its
+  request is about to start.
+
+  Args:
+    scheduled_start: the time the arrival was scheduled for, as passed to
+      the function run by OpenLoopScheduler.run()
+  """
+  lag = max(timer() - scheduled_start, 0)
+  metric_success.fire(
+    request_type="schedule", name="start lag",
+    response_time=int(lag * 1000), response_length=0,
+    response_time_seconds=lag
+  )
+
+
+def set_rate(rate):
+  """
+  Change the target rate of every OpenLoopScheduler running in this process.
+
+  Schedulers started later should take their rate from current_rate().
+
+  Args:
+    rate: the new number of requests started per second, per scheduler
+  """
+  global _rate
+  assert rate > 0, "Arrival rate must be > 0"
+  _rate = rate
+  for scheduler in list(_schedulers):
+    scheduler.rate = rate
+
+
+def current_rate(default):
+  """Return the last rate given to set_rate(), or default if there was none."""
+  return default if _rate is None else _rate
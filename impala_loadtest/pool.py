@@ -0,0 +1,201 @@
+"""Pools of pre-authenticated DBAPI client sessions."""
+
+import gevent
+import locust
+import logging
+
+from gevent.queue import Empty, Queue
+
+import qe_client_lib.dbapi_clients as client_lib
+
+from impala_loadtest.common import timer
+from impala_loadtest.events import metric_success
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.pool')
+
+# Shared SessionPool instances, keyed by connection settings
+_pools = {}
+
+
+class SessionPool(object):
+  """
+  A pool of connected DBAPI client sessions, with the target database selected.
+
+  The pool keeps a number of warm spare sessions ready, so that handing one
+  out doesn't wait on a connection handshake (which can take seconds with
+  Kerberos, SSL or HTTP transport). Whenever a spare is taken, a background
+  greenlet opens a replacement. Sessions returned with release() are put back
+  at the end of the queue, to be reused by later checkouts.
+
+  Two timings are recorded, so the costs can be told apart:
+
+    connect / handshake: opening a new session, i.e., constructing the client
+      and selecting the target database
+    connect / checkout: getting a session from the pool, including any wait
+      for a spare to become available
+
+  Handshakes are logged as locust requests. Checkouts, which an open loop
+  test makes for every query, are fired on impala_loadtest.events'
+  metric_success instead, so they don't add to locust's request totals.
+
+  Spares that have been idle for longer than max_idle seconds are closed
+  rather than handed out, in case the server has already timed them out.
+  Sessions released beyond the number of spares are closed, unless keep_idle
+  is set, in which case the pool keeps them all, and grows to the most
+  sessions checked out at once (e.g., for open loop tests, where each
+  in-flight query needs a session).
+
+  A checkout only waits for a spare that no other checkout is already waiting
+  for; otherwise it opens a session inline, so many users hatching at once
+  handshake in parallel, rather than one spare at a time. If a spare that a
+  checkout is waiting for fails to open, the checkout opens one inline.
+  """
+
+  def __init__(self, host, client_type="ImpylaClient", target_db=None,
+               spares=1, max_idle=300, checkout_timeout=None, keep_idle=False,
+               **client_kwargs):
+    """
+    Args:
+      host: FQDN to the node under test
+      client_type: name of the DBAPI client class to instantiate
+      target_db: database to select in each new session, if any
+      spares: number of idle sessions to keep ready
+      max_idle: seconds a spare session may sit idle before being closed
+      checkout_timeout: seconds to wait for a spare before opening a new
+        session inline, or None to wait for as long as it takes
+      keep_idle: keep every released session for reuse, rather than closing
+        those beyond spares
+      client_kwargs: a dictionary of parameters needed to make a connection
+    """
+    self.host = host
+    self.client_type = client_type
+    self.target_db = target_db
+    self.spares = spares
+    self.max_idle = max_idle
+    self.checkout_timeout = checkout_timeout
+    self.keep_idle = keep_idle
+    self.client_kwargs = client_kwargs
+
+    self._idle = Queue()  # (time returned to the pool, client)
+    self._opening = 0     # number of spares currently being opened
+    self._waiting = 0     # number of checkouts waiting for a spare
+
+  def acquire(self):
+    """Check a session out of the pool, opening one if necessary."""
+    start_time = timer()
+    self._replenish()
+
+    while True:
+      if self._idle.qsize() + self._opening <= self._waiting:
+        # Nothing is warm or warming up that another checkout isn't already
+        # waiting for, so pay for the handshake inline
+        client = self._open()
+        break
+      self._waiting += 1
+      try:
+        idle_since, client = self._idle.get(timeout=self.checkout_timeout)
+      except Empty:
+        client = self._open()
+        break
+      finally:
+        self._waiting -= 1
+      if client is None:
+        # The spare this checkout was waiting for failed to open
+        client = self._open()
+        break
+      if timer() - idle_since <= self.max_idle:
+        break
+      self._close(client)
+
+    self._replenish()
+    elapsed = timer() - start_time
+    metric_success.fire(
+      request_type="connect", name="checkout",
+      response_time=int(elapsed * 1000), response_length=0,
+      response_time_seconds=elapsed
+    )
+    return client
+
+  def release(self, client):
+    """Return a session to the pool, for reuse by a later checkout."""
+    if not self.keep_idle and self._idle.qsize() >= self.spares:
+      self._close(client)
+    else:
+      self._idle.put((timer(), client))
+
+  def close(self):
+    """Close all idle sessions."""
+    while not self._idle.empty():
+      client = self._idle.get()[1]
+      if client is not None:
+        self._close(client)
+
+  def _open(self):
+    """Open a new session, logging the time taken as a handshake."""
+    start_time = timer()
+    try:
+      ClientType = getattr(client_lib, self.client_type)
+      client = ClientType(self.host, **self.client_kwargs)
+      if self.target_db is not None:
+        client.query('use {target_db}'.format(target_db=self.target_db))
+    except Exception as e:
+      locust.events.request_failure.fire(
+        request_type="connect", name="handshake",
+        response_time=int((timer() - start_time) * 1000),
+        response_length=len(str(e)), exception=e
+      )
+      raise
+
+    locust.events.request_success.fire(
+      request_type="connect", name="handshake",
+      response_time=int((timer() - start_time) * 1000), response_length=0
+    )
+    return client
+
+  def _replenish(self):
+    """Start opening sessions in the background until there are enough spares."""
+    while self._idle.qsize() + self._opening < self.spares:
+      self._opening += 1
+      gevent.spawn(self._open_spare)
+
+  def _open_spare(self):
+    try:
+      client = self._open()
+    except Exception as e:
+      logger.warning("Failed to open a spare session: {0}".format(e))
+      self._opening -= 1
+      if self._waiting:
+        # Wake a checkout that was waiting for this spare, to open its own
+        self._idle.put((timer(), None))
+      return
+    self._opening -= 1
+    self._idle.put((timer(), client))
+
+  def _close(self, client):
+    """Disconnect a session in the background, ignoring any errors."""
+    def disconnect():
+      try:
+        client.disconnect()
+      except Exception as e:
+        logger.debug("Error closing session: {0}".format(e))
+    gevent.spawn(disconnect)
+
+
+def get_session_pool(host, client_type="ImpylaClient", target_db=None,
+                     spares=1, keep_idle=False, **client_kwargs):
+  """
+  Return the shared SessionPool for the given connection settings.
+
+  All users in a process with the same client type, host, target database and
+  client_kwargs (e.g., auth settings) share a pool. The arguments are the same
+  as for SessionPool; if any user asks for keep_idle, the shared pool keeps
+  idle sessions.
+  """
+  key = (client_type, host, target_db, tuple(sorted(client_kwargs.items())))
+  if key not in _pools:
+    _pools[key] = SessionPool(host, client_type=client_type, target_db=target_db,
+                              spares=spares, **client_kwargs)
+  if keep_idle:
+    _pools[key].keep_idle = True
+  return _pools[key]
@@ -0,0 +1,293 @@
+"""
+Server-side timing breakdowns, from the runtime profiles of sampled queries.
+
+A query's client-side latency lumps together everything Impala did: waiting
+for admission, planning, executing, and streaming rows back. Impala's runtime
+profile has a timeline of when each of those happened, so a ProfileCollector
+fetches the profiles of a sample of the queries run, once they've completed,
+and records the main phases of each as timings of their own, under the
+query's name:
+
+  server_planning: from submission until planning finished
+  server_admission_wait: time spent queued for admission
+  server_rows_available: from submission until the first rows were ready
+  server_first_row: from submission until the client fetched the first row
+  server_last_row: from submission until the client fetched the last row
+
+with the number of rows produced as the response length. They're fired on
+impala_loadtest.events' metric hooks, rather than as locust requests, so they
+don't add to locust's request totals, and show up next to the "query"
+requests in the latency report, time series and metrics export. The
+query_profile event is also fired with each parsed profile.
+
+Profiles are fetched off the measured path: queries are only queued for a
+background greenlet, which fetches their profiles on sessions of its own, so
+the users' next queries aren't held up, and fetching isn't counted in any
+query's latency. If the queue is full, queries are skipped instead of
+waiting.
+
+Only clients with an Impyla cursor (one that keeps its _last_operation) have
+profiles to fetch. Settings, in the query_profiles section of the config
+file (all optional):
+
+  sample_rate: fraction of queries to fetch profiles for (default 0.1)
+  max_pending: most queries waiting for their profiles to be fetched
+    (default 100)
+  profile_dir: directory to save each fetched profile to, as
+    <query id>.profile (default: profiles aren't saved)
+  seed: seed for the random sampling, to repeat it from one run to the next
+"""
+
+import collections
+import gevent
+import gevent.queue
+import locust
+import logging
+import os
+import random
+import re
+import six
+
+from locust.log import console_logger
+
+import qe_client_lib.dbapi_clients as client_lib
+
+from impala_loadtest.events import metric_success
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.profiles')
+
+# Timings recorded for each profiled query, in timeline order
+PHASES = ('server_planning', 'server_admission_wait', 'server_rows_available',
+          'server_first_row', 'server_last_row')
+
+# Query Timeline events, by the prefix of their labels, and the phase
+# measured from submission to each
+TIMELINE_EVENTS = (
+  ('Planning finished', 'server_planning'),
+  ('Rows available', 'server_rows_available'),
+  ('First row fetched', 'server_first_row'),
+  ('Last row fetched', 'server_last_row'),
+)
+
+# The parsed parts of a runtime profile. phases maps request types in PHASES
+# to seconds; phases missing from the timeline are left out.
+QueryProfile = collections.namedtuple(
+  'QueryProfile', ['query_id', 'phases', 'rows_produced', 'admission_result'])
+
+DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}
+DURATION_PART = re.compile(r'([\d.]+)(ms|us|ns|h|m|s)')
+TIMELINE_EVENT = re.compile(r'^\s*- ([^:]+): (\S+)')
+QUERY_ID = re.compile(r'Query \(id=([^)]+)\)')
+ADMISSION_RESULT = re.compile(r'Admission result: (.*)')
+ROWS_FETCHED = re.compile(r'NumRowsFetched: (?:\S+ \()?(\d+)')
+
+
+def parse_duration(text):
+  """
+  Return the seconds in a duration as printed in a runtime profile, e.g.,
+  1m2s, 1s234ms or 5.678ms.
+  """
+  parts = DURATION_PART.findall(text)
+  if not parts:
+    raise ValueError("Not a duration: {0}".format(text))
+  return sum(float(value) * DURATION_UNITS[unit] for value, unit in parts)
+
+
+def _timeline(lines):
+  """Return the events of the Query Timeline, as {label: seconds}."""
+  events = {}
+  indent = None
+  for line in lines:
+    if indent is None:
+      if line.strip().startswith('Query Timeline:'):
+        indent = len(line) - len(line.lstrip())
+      continue
+    if len(line) - len(line.lstrip()) <= indent:
+      break
+    match = TIMELINE_EVENT.match(line)
+    if match:
+      events[match.group(1)] = parse_duration(match.group(2))
+  return events
+
+
+def parse_profile(text):
+  """
+  Parse the query timeline, and the other parts that are recorded, out of a
+  text runtime profile.
+
+  Returns:
+    a QueryProfile
+  """
+  lines = text.splitlines()
+  events = _timeline(lines)
+
+  phases = {}
+  for prefix, phase in TIMELINE_EVENTS:
+    for label, seconds in six.iteritems(events):
+      if label.startswith(prefix):
+        phases[phase] = seconds
+        break
+  submitted = [seconds for label, seconds in six.iteritems(events)
+               if label.startswith('Submit for admission')]
+  admitted = [seconds for label, seconds in six.iteritems(events)
+              if label.startswith('Completed admission')]
+  if submitted and admitted:
+    phases['server_admission_wait'] = max(admitted[0] - submitted[0], 0.0)
+
+  def first_match(pattern):
+    match = pattern.search(text)
+    return match.group(1) if match else None
+
+  rows = first_match(ROWS_FETCHED)
+  admission_result = first_match(ADMISSION_RESULT)
+  return QueryProfile(query_id=first_match(QUERY_ID), phases=phases,
+                      rows_produced=int(rows) if rows is not None else None,
+                      admission_result=admission_result and admission_result.strip())
+
+
+class ProfileCollector(object):
+  """
+  Fetches the runtime profiles of a sample of queries in the background, and
+  records their server-side phases. Shared by all of the users in a process.
+  """
+
+  def __init__(self, config=None):
+    """
+    Args:
+      config: the query_profiles section of the config file (see the module
+        docstring)
+    """
+    config = config or {}
+    self.sample_rate = config.get('sample_rate', 0.1)
+    self.max_pending = config.get('max_pending', 100)
+    self.profile_dir = config.get('profile_dir')
+    assert 0 <= self.sample_rate <= 1, "sample_rate must be between 0 and 1"
+    self._random = random.Random(config.get('seed'))
+    self._queue = gevent.queue.Queue(self.max_pending)
+    self._greenlet = None
+    self._sessions = {}  # connection settings -> client for fetching profiles
+    self._warned = False
+    self.fetched = 0
+    self.failed = 0
+    self.skipped = 0
+    if self.profile_dir and not os.path.isdir(self.profile_dir):
+      os.makedirs(self.profile_dir)
+
+  def install(self):
+    """Attach the collector to the locust events it needs."""
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def sample(self):
+    """Return whether to fetch the profile of the query that just ran."""
+    return self._random.random() < self.sample_rate
+
+  def submit(self, settings, query_name, cursor):
+    """
+    Queue the profile of the cursor's last query to be fetched. Never blocks.
+
+    Args:
+      settings: (host, client_type, client_kwargs) to connect with, to fetch
+        the profile on a session of the collector's own
+      query_name: the name to record the query's phases under
+      cursor: the cursor the query was run on
+    """
+    operation = getattr(cursor, '_last_operation', None)
+    if operation is None:
+      if not self._warned:
+        logger.warning("Can't fetch query profiles from {0} cursors, which don't "
+                       "keep the query's operation".format(type(cursor).__name__))
+        self._warned = True
+      return
+
+    try:
+      self._queue.put_nowait((settings, query_name, operation))
+    except gevent.queue.Full:
+      self.skipped += 1
+      return
+    if self._greenlet is None:
+      self._greenlet = gevent.spawn(self._run)
+
+  def _run(self):
+    while True:
+      settings, query_name, operation = self._queue.get()
+      try:
+        text = self._fetch(settings, operation)
+      except Exception as e:
+        self.failed += 1
+        logger.debug("Couldn't fetch the profile of {0}: {1}".format(query_name, e))
+        self._disconnect(self._sessions.pop(self._key(settings), None))
+        continue
+      self.fetched += 1
+      self.record(query_name, text)
+
+  @staticmethod
+  def _key(settings):
+    host, client_type, client_kwargs = settings
+    return host, client_type, tuple(sorted(client_kwargs.items()))
+
+  def _fetch(self, settings, operation):
+    key = self._key(settings)
+    client = self._sessions.get(key)
+    if client is None:
+      host, client_type, client_kwargs = settings
+      client = getattr(client_lib, client_type)(host, **client_kwargs)
+      self._sessions[key] = client
+    # The same query, looked up from the collector's session
+    return type(operation)(client._cursor.session, operation.handle).get_profile()
+
+  @staticmethod
+  def _disconnect(client):
+    if client is None:
+      return
+    try:
+      client.disconnect()
+    except Exception:
+      pass
+
+  def record(self, query_name, text):
+    """
+    Record the phases of a fetched profile, and fire query_profile with it.
+
+    Returns:
+      the QueryProfile
+    """
+    profile = parse_profile(text)
+    for phase in PHASES:
+      seconds = profile.phases.get(phase)
+      if seconds is None:
+        continue
+      metric_success.fire(
+        request_type=phase, name=query_name,
+        response_time=int(seconds * 1000),
+        response_length=profile.rows_produced or 0,
+        response_time_seconds=seconds
+      )
+    query_profile.fire(name=query_name, profile=profile, text=text)
+
+    if self.profile_dir and profile.query_id:
+      file_name = '{0}.profile'.format(profile.query_id.replace(':', '_'))
+      with open(os.path.join(self.profile_dir, file_name), 'w') as outfile:
+        outfile.write(text)
+    return profile
+
+  def on_quitting(self, **kwargs):
+    if self._greenlet is not None:
+      self._greenlet.kill()
+    for client in self._sessions.values():
+      self._disconnect(client)
+    self._sessions = {}
+    if self.fetched or self.failed or self.skipped:
+      console_logger.info(
+        "Query profiles: {0} fetched, {1} failed, {2} skipped (over {3} "
+        "pending)".format(self.fetched, self.failed, self.skipped, self.max_pending))
+
+
+# 'query_profile' is fired by a ProfileCollector for each query profile it
+# fetches. Handlers are called with the following keyword arguments:
+#
+#   name: the query name, as reported to Locust
+#   profile: the QueryProfile parsed from the profile
+#   text: the text runtime profile
+query_profile = locust.events.EventHook()
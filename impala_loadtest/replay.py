@@ -0,0 +1,245 @@
+"""Replay of captured query logs, with their original timing and sessions."""
+
+import calendar
+import collections
+import csv
+import gevent
+import json
+import locust
+import logging
+
+from datetime import datetime
+from gevent.queue import Empty, Queue
+
+from impala_loadtest.common import timer
+from impala_loadtest.events import metric_success
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.replay')
+
+# Timestamp formats accepted in a trace, besides seconds since the epoch
+TIMESTAMP_FORMATS = (
+  '%Y-%m-%dT%H:%M:%S.%f',
+  '%Y-%m-%dT%H:%M:%S',
+  '%Y-%m-%d %H:%M:%S.%f',
+  '%Y-%m-%d %H:%M:%S',
+)
+
+# One query in a trace. timestamp is in seconds; name is used for the query's
+# locust stats, and defaults to the user.
+TraceEntry = collections.namedtuple(
+  'TraceEntry', ['timestamp', 'session', 'user', 'database', 'sql', 'name'])
+
+
+def parse_timestamp(value):
+  """Convert seconds since the epoch, or an ISO 8601 date/time, to seconds."""
+  try:
+    return float(value)
+  except ValueError:
+    pass
+  value = value.strip().rstrip('Z')
+  for timestamp_format in TIMESTAMP_FORMATS:
+    try:
+      parsed = datetime.strptime(value, timestamp_format)
+    except ValueError:
+      continue
+    # Only the differences between timestamps matter, so UTC will do
+    return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1000000.0
+  raise ValueError("Invalid timestamp: {0}".format(value))
+
+
+def _make_entry(record):
+  user = record.get('user') or None
+  database = record.get('database') or None
+  return TraceEntry(
+    timestamp=parse_timestamp(record['timestamp']),
+    session=record.get('session') or user,
+    user=user,
+    database=database,
+    sql=record['sql'],
+    name=record.get('name') or 'replay ({0})'.format(user or 'unknown user'))
+
+
+def read_trace(path):
+  """
+  Generate the entries of a query log, one at a time.
+
+  The log is either JSON lines (if the file name ends in .json or .jsonl),
+  with one object per query, or CSV with a header row. Either way, the fields
+  are:
+
+    timestamp: when the query was submitted, in seconds since the epoch or as
+      an ISO 8601 date and time (e.g., 2020-03-01 13:45:10.250)
+    sql: the query text
+    user: the user who ran the query (optional)
+    database: the database the query was run in (optional)
+    session: identifies the session the query was run in (optional; defaults
+      to the user, so each user's queries are replayed one at a time)
+    name: how to report the query in the locust stats (optional; defaults to
+      "replay (<user>)")
+
+  Entries should be in timestamp order. Only one line is held at a time, so
+  logs of any size can be replayed.
+  """
+  with open(path) as infile:
+    if path.endswith(('.json', '.jsonl')):
+      for line in infile:
+        line = line.strip()
+        if line:
+          yield _make_entry(json.loads(line))
+    else:
+      for record in csv.DictReader(infile):
+        yield _make_entry(record)
+
+
+def schedule(entries, speedup=1.0, max_gap=None):
+  """
+  Assign each entry a start time, in seconds after the start of the replay.
+
+  Args:
+    entries: iterable of TraceEntry, in timestamp order
+    speedup: factor by which to compress the time between queries, e.g., 2 to
+      replay at twice the original pace
+    max_gap: if set, longer idle periods (after scaling) are cut to this many
+      seconds, so quiet stretches of the log don't stall the replay
+
+  Returns:
+    a generator of (offset, entry) tuples
+  """
+  assert speedup > 0, "Replay speedup must be > 0"
+  previous = None
+  offset = 0.0
+  out_of_order = 0
+  for entry in entries:
+    if previous is None:
+      previous = entry.timestamp
+    gap = entry.timestamp - previous
+    if gap < 0:
+      # Issue it now, rather than moving the timeline backwards
+      out_of_order += 1
+      gap = 0
+    else:
+      previous = entry.timestamp
+    gap /= speedup
+    if max_gap is not None:
+      gap = min(gap, max_gap)
+    offset += gap
+    yield offset, entry
+
+  if out_of_order:
+    logger.warning("{0} trace entries were out of timestamp order, and were "
+                   "replayed as soon as they were reached".format(out_of_order))
+
+
+class TraceReplayer(object):
+  """
+  Re-issues the queries in a trace at their original (or a scaled) pace.
+
+  Entries are read from the trace one at a time, and each is handed, at its
+  scheduled time, to a greenlet for its session. Each session runs its
+  queries one after another, in trace order, so a query never starts before
+  the previous query in the same session has finished, while queries in
+  different sessions overlap as they did originally. A session's greenlet
+  (and its connection) is closed once it's been idle for idle_timeout
+  seconds, and reopened if the session shows up again.
+
+  For each query, the time between its scheduled start and the moment it
+  was actually issued is recorded as "replay / lag", on impala_loadtest.events'
+  metric_success rather than as a locust request, so it shows up in the
+  latency report, time series and metrics export. Lag builds up
+  when a session's previous query is slower than it was originally, or when
+  the load generator can't keep up; a steadily growing lag across all
+  sessions means the replay is no longer representative.
+
+  Memory is bounded by the number of open sessions times queue_size: if a
+  session falls more than queue_size queries behind, reading the trace
+  pauses until it catches up.
+  """
+
+  def __init__(self, entries, open_session, speedup=1.0, max_gap=None,
+               queue_size=100, idle_timeout=60):
+    """
+    Args:
+      entries: iterable of TraceEntry, e.g., from read_trace()
+      open_session: called as open_session(entry) with the first entry of
+        each session, and returns an object with run(entry) and close()
+        methods, e.g., a ReplaySession
+      speedup: see schedule()
+      max_gap: see schedule()
+      queue_size: maximum number of queries queued for any one session
+      idle_timeout: seconds a session may sit idle before it's closed
+    """
+    self.entries = entries
+    self.open_session = open_session
+    self.speedup = speedup
+    self.max_gap = max_gap
+    self.queue_size = queue_size
+    self.idle_timeout = idle_timeout
+    self._sessions = {}  # session key -> (queue, greenlet)
+
+  def run(self):
+    """Replay the whole trace, blocking until every query has finished."""
+    start_time = timer()
+    try:
+      for offset, entry in schedule(self.entries, self.speedup, self.max_gap):
+        delay = start_time + offset - timer()
+        if delay > 0:
+          gevent.sleep(delay)
+
+        if entry.session not in self._sessions:
+          queue = Queue(self.queue_size)
+          self._sessions[entry.session] = (
+            queue, gevent.spawn(self._run_session, entry, queue))
+        # Blocks while the session is queue_size queries behind
+        self._sessions[entry.session][0].put((start_time + offset, entry))
+
+      # Let each session finish its queued queries, then close
+      sessions = list(self._sessions.values())
+      for queue, _ in sessions:
+        queue.put(None)
+      gevent.joinall([greenlet for _, greenlet in sessions])
+    finally:
+      gevent.killall([greenlet for _, greenlet in list(self._sessions.values())])
+
+  def _run_session(self, first_entry, queue):
+    session = open_error = None
+    try:
+      session = self.open_session(first_entry)
+    except Exception as e:
+      logger.error("Failed to open replay session {0}: {1}".format(
+        first_entry.session, e))
+      open_error = e
+
+    try:
+      while True:
+        try:
+          item = queue.get(timeout=self.idle_timeout)
+        except Empty:
+          break
+        if item is None:
+          break
+        scheduled_start, entry = item
+        lag = max(timer() - scheduled_start, 0)
+        metric_success.fire(
+          request_type="replay", name="lag",
+          response_time=int(lag * 1000), response_length=0,
+          response_time_seconds=lag
+        )
+        if session is None:
+          # Keep draining the queue, so the reader doesn't block on it
+          locust.events.request_failure.fire(
+            request_type="query", name=entry.name, response_time=0,
+            response_length=len(str(open_error)), exception=open_error
+          )
+          continue
+        try:
+          session.run(entry)
+        except Exception as e:
+          # The failure has already been reported to locust
+          logger.debug("Replayed query failed: {0}".format(e))
+    finally:
+      # Nothing can be queued for this session once it's been removed, since
+      # the reader only yields to other greenlets while putting to a full queue
+      del self._sessions[first_entry.session]
+      if session is not None:
+        session.close()
@@ -0,0 +1,464 @@
+"""Compact, memory-mapped storage for expected query results."""
+from __future__ import print_function
+
+import logging
+import mmap
+import os
+import pickle
+import six
+import struct
+import sys
+import tempfile
+import yaml
+
+from decimal import Decimal
+
+from impala_loadtest.common import DataTypeLoader
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+
+# Compiled result sets are stored alongside the yaml files they came from,
+# with the same base name and this extension.
+RESULTS_EXTENSION = '.rset'
+
+MAGIC = b'ILRS'
+VERSION = 1
+
+# Column types
+NULL_COLUMN = 0     # every value is None
+INT_COLUMN = 1      # int64
+FLOAT_COLUMN = 2    # float64
+DECIMAL_COLUMN = 3  # int64, scaled by 10 ** scale
+STRING_COLUMN = 4   # uint64 offsets followed by a utf-8 blob
+OBJECT_COLUMN = 5   # uint64 offsets followed by pickled values
+
+# File header: magic, version, row count, column count
+HEADER = struct.Struct('<4sHQI')
+
+# Column descriptor: type, scale, null bitmap offset/length, data offset/length
+COLUMN = struct.Struct('<BBQQQQ')
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Single values, for decoding individual rows
+INT64 = struct.Struct('<q')
+FLOAT64 = struct.Struct('<d')
+OFFSETS = struct.Struct('<QQ')
+BYTE = struct.Struct('<B')
+
+
+def _column_type(values):
+  """Pick the most compact column type that can represent the given values."""
+  types = set(type(v) for v in values if v is not None)
+
+  if not types:
+    return NULL_COLUMN, 0
+  if len(types) > 1 or bool in types:
+    return OBJECT_COLUMN, 0
+
+  value_type = types.pop()
+
+  if issubclass(value_type, six.integer_types):
+    if all(INT64_MIN <= v <= INT64_MAX for v in values if v is not None):
+      return INT_COLUMN, 0
+  elif value_type is float:
+    return FLOAT_COLUMN, 0
+  elif value_type is Decimal:
+    if all(v.is_finite() for v in values if v is not None):
+      scale = max(max(-v.as_tuple().exponent, 0)
+                  for v in values if v is not None)
+      if scale < 256 and all(INT64_MIN <= v.scaleb(scale) <= INT64_MAX
+                             for v in values if v is not None):
+        return DECIMAL_COLUMN, scale
+  elif issubclass(value_type, six.string_types + (six.text_type,)):
+    return STRING_COLUMN, 0
+
+  return OBJECT_COLUMN, 0
+
+
+def _encode_column(column_type, scale, values):
+  """Return the encoded data section for a single column."""
+  if column_type == NULL_COLUMN:
+    return b''
+  elif column_type == INT_COLUMN:
+    return struct.pack('<{0}q'.format(len(values)),
+                       *[0 if v is None else v for v in values])
+  elif column_type == FLOAT_COLUMN:
+    return struct.pack('<{0}d'.format(len(values)),
+                       *[0.0 if v is None else v for v in values])
+  elif column_type == DECIMAL_COLUMN:
+    return struct.pack('<{0}q'.format(len(values)),
+                       *[0 if v is None else int(v.scaleb(scale))
+                         for v in values])
+
+  if column_type == STRING_COLUMN:
+    blobs = [b'' if v is None else v.encode('utf-8') for v in values]
+  else:
+    blobs = [pickle.dumps(v, protocol=2) for v in values]
+
+  offsets = [0]
+  for blob in blobs:
+    offsets.append(offsets[-1] + len(blob))
+  return struct.pack('<{0}Q'.format(len(offsets)), *offsets) + b''.join(blobs)
+
+
+def _encode_nulls(values):
+  """Return a null bitmap for the column, or b'' if it has no nulls."""
+  if all(v is not None for v in values):
+    return b''
+  bitmap = bytearray((len(values) + 7) // 8)
+  for i, value in enumerate(values):
+    if value is None:
+      bitmap[i >> 3] |= 1 << (i & 7)
+  return bytes(bitmap)
+
+
+def encode_result_set(rows):
+  """
+  Encode a result set (a list of tuples) into the compiled binary format.
+
+  The layout is columnar. A fixed header is followed by one descriptor per
+  column, and then by each column's null bitmap and data section. Decimals are
+  stored as 64-bit integers scaled by the largest scale in their column.
+  """
+  num_rows = len(rows)
+  num_cols = len(rows[0]) if rows else 0
+  columns = [[row[i] for row in rows] for i in range(num_cols)]
+
+  offset = HEADER.size + COLUMN.size * num_cols
+  descriptors = []
+  sections = []
+
+  for values in columns:
+    column_type, scale = _column_type(values)
+    nulls = _encode_nulls(values)
+    data = _encode_column(column_type, scale, values)
+    descriptors.append(COLUMN.pack(column_type, scale,
+                                   offset, len(nulls),
+                                   offset + len(nulls), len(data)))
+    sections.extend([nulls, data])
+    offset += len(nulls) + len(data)
+
+  header = HEADER.pack(MAGIC, VERSION, num_rows, num_cols)
+  return b''.join([header] + descriptors + sections)
+
+
+class ResultSetWriter(object):
+  """
+  Writes a result set in the compiled binary format, a batch of rows at a time.
+
+  Each batch is split into columns, which are spilled to one temporary file
+  per column, so the rows of a large result set are never held in memory
+  together. When the writer is closed, the columns are read back and encoded
+  one at a time, into the same layout as encode_result_set().
+
+  The file only appears at path once it is complete, so a running test never
+  maps a partially-written result set.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.num_rows = 0
+    self._spills = None  # one temporary file per column
+
+  def write(self, rows):
+    """Append a batch of rows (a sequence of tuples)."""
+    if not rows:
+      return
+    if self._spills is None:
+      self._spills = [tempfile.TemporaryFile() for _ in rows[0]]
+    for i, spill in enumerate(self._spills):
+      pickle.dump([row[i] for row in rows], spill, protocol=2)
+    self.num_rows += len(rows)
+
+  def _read_column(self, spill):
+    spill.seek(0)
+    values = []
+    while True:
+      try:
+        values.extend(pickle.load(spill))
+      except EOFError:
+        return values
+
+  def close(self):
+    """Encode the spilled columns, and move the finished file into place."""
+    spills = self._spills or []
+    tmp_file = '{0}.tmp.{1}'.format(self.path, os.getpid())
+    with open(tmp_file, 'wb') as outfile:
+      # Descriptors are filled in once the column sections have been written
+      outfile.write(HEADER.pack(MAGIC, VERSION, self.num_rows, len(spills)))
+      outfile.write(b'\0' * COLUMN.size * len(spills))
+      offset = HEADER.size + COLUMN.size * len(spills)
+      descriptors = []
+
+      for spill in spills:
+        values = self._read_column(spill)
+        spill.close()
+        column_type, scale = _column_type(values)
+        nulls = _encode_nulls(values)
+        data = _encode_column(column_type, scale, values)
+        descriptors.append(COLUMN.pack(column_type, scale,
+                                       offset, len(nulls),
+                                       offset + len(nulls), len(data)))
+        outfile.write(nulls)
+        outfile.write(data)
+        offset += len(nulls) + len(data)
+
+      outfile.seek(HEADER.size)
+      outfile.write(b''.join(descriptors))
+    os.rename(tmp_file, self.path)
+    self._spills = None
+    return self.path
+
+  def discard(self):
+    """Throw away the rows written so far, without writing the file."""
+    for spill in self._spills or []:
+      spill.close()
+    self._spills = None
+
+
+def load_yaml_results(yaml_file):
+  """Load a result set saved as yaml, returning a list of tuples."""
+  with open(yaml_file) as infile:
+    return yaml.load(infile, Loader=DataTypeLoader)
+
+
+def compile_results_file(yaml_file, output_file=None):
+  """
+  Compile a single yaml result set into the binary format.
+
+  Args:
+    yaml_file: full path to a yaml file of expected results
+    output_file: path to write to, by default alongside yaml_file
+  """
+  if output_file is None:
+    output_file = os.path.splitext(yaml_file)[0] + RESULTS_EXTENSION
+
+  data = encode_result_set(load_yaml_results(yaml_file))
+
+  # Write to a temp file first, so that a running test never maps a
+  # partially-written result set.
+  tmp_file = '{0}.tmp.{1}'.format(output_file, os.getpid())
+  with open(tmp_file, 'wb') as outfile:
+    outfile.write(data)
+  os.rename(tmp_file, output_file)
+  return output_file
+
+
+def compile_results_directory(results_dir, force=False):
+  """
+  Compile every yaml result set in a directory that is missing or stale.
+
+  Returns a list of the files that were (re)compiled.
+  """
+  compiled = []
+  for filename in sorted(os.listdir(results_dir)):
+    if not filename.endswith('.yaml'):
+      continue
+    yaml_file = os.path.join(results_dir, filename)
+    output_file = os.path.splitext(yaml_file)[0] + RESULTS_EXTENSION
+    if force or _is_stale(yaml_file, output_file):
+      logger.info('Compiling {0}'.format(yaml_file))
+      compiled.append(compile_results_file(yaml_file, output_file))
+  return compiled
+
+
+def _is_stale(source_file, compiled_file):
+  return (not os.path.exists(compiled_file) or
+          os.path.getmtime(compiled_file) < os.path.getmtime(source_file))
+
+
+class CompiledResultSet(object):
+  """
+  A read-only, memory-mapped result set in the compiled binary format.
+
+  Opening a result set only maps the file and reads its header, so it's
+  near-instant regardless of size. The pages are backed by the OS page cache,
+  and are shared by every locust process on the host that maps the same file.
+
+  Rows are decoded on demand, and are not cached, so comparing against an
+  actual result set doesn't leave a second copy of the results in memory.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as fh:
+      self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, self.num_rows, self.num_cols = HEADER.unpack_from(self._mmap, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("Not a compiled result set: {0}".format(path))
+
+    self._columns = [COLUMN.unpack_from(self._mmap, HEADER.size + COLUMN.size * i)
+                     for i in range(self.num_cols)]
+
+  def __len__(self):
+    return self.num_rows
+
+  def column(self, index):
+    """Decode a single column, returning its values as a list."""
+    column_type, scale, null_offset, null_length, offset, length = \
+        self._columns[index]
+    n = self.num_rows
+
+    if column_type == NULL_COLUMN:
+      return [None] * n
+    elif column_type == INT_COLUMN:
+      values = list(struct.unpack_from('<{0}q'.format(n), self._mmap, offset))
+    elif column_type == FLOAT_COLUMN:
+      values = list(struct.unpack_from('<{0}d'.format(n), self._mmap, offset))
+    elif column_type == DECIMAL_COLUMN:
+      values = [Decimal(v).scaleb(-scale) for v in
+                struct.unpack_from('<{0}q'.format(n), self._mmap, offset)]
+    else:
+      offsets = struct.unpack_from('<{0}Q'.format(n + 1), self._mmap, offset)
+      start = offset + 8 * (n + 1)
+      blobs = [self._mmap[start + offsets[i]:start + offsets[i + 1]]
+               for i in range(n)]
+      if column_type == STRING_COLUMN:
+        values = [blob.decode('utf-8') for blob in blobs]
+      else:
+        values = [pickle.loads(blob) for blob in blobs]
+
+    if null_length:
+      bitmap = bytearray(self._mmap[null_offset:null_offset + null_length])
+      for i in range(n):
+        if bitmap[i >> 3] & (1 << (i & 7)):
+          values[i] = None
+    return values
+
+  def values_at(self, index, rows):
+    """Decode a single column at only the given row indexes."""
+    column_type, scale, null_offset, null_length, offset, length = \
+        self._columns[index]
+
+    if column_type == NULL_COLUMN:
+      return [None] * len(rows)
+    elif column_type == INT_COLUMN:
+      values = [INT64.unpack_from(self._mmap, offset + 8 * i)[0] for i in rows]
+    elif column_type == FLOAT_COLUMN:
+      values = [FLOAT64.unpack_from(self._mmap, offset + 8 * i)[0] for i in rows]
+    elif column_type == DECIMAL_COLUMN:
+      values = [Decimal(INT64.unpack_from(self._mmap, offset + 8 * i)[0]).scaleb(-scale)
+                for i in rows]
+    else:
+      start = offset + 8 * (self.num_rows + 1)
+      values = []
+      for i in rows:
+        blob_start, blob_end = OFFSETS.unpack_from(self._mmap, offset + 8 * i)
+        blob = self._mmap[start + blob_start:start + blob_end]
+        values.append(blob.decode('utf-8') if column_type == STRING_COLUMN
+                      else pickle.loads(blob))
+
+    if null_length:
+      for j, i in enumerate(rows):
+        if BYTE.unpack_from(self._mmap, null_offset + (i >> 3))[0] & (1 << (i & 7)):
+          values[j] = None
+    return values
+
+  def rows_at(self, rows):
+    """
+    Decode only the rows at the given indexes, e.g., to check a sample of
+    them, returning them as a list of tuples.
+    """
+    if not self.num_cols:
+      return [()] * len(rows)
+    return list(zip(*[self.values_at(i, rows) for i in range(self.num_cols)]))
+
+  def rows(self):
+    """Decode the whole result set, returning it as a list of tuples."""
+    if not self.num_cols:
+      return [()] * self.num_rows
+    return list(zip(*[self.column(i) for i in range(self.num_cols)]))
+
+  def __iter__(self):
+    return iter(self.rows())
+
+  def __eq__(self, other):
+    if isinstance(other, CompiledResultSet):
+      other = other.rows()
+    if not isinstance(other, (list, tuple)):
+      return NotImplemented
+    if len(other) != self.num_rows:
+      return False
+    if not self.num_rows:
+      return True
+    if any(len(row) != self.num_cols for row in other):
+      return False
+
+    # Compare a column at a time, so only one column is decoded at once
+    for i in range(self.num_cols):
+      if self.column(i) != [row[i] for row in other]:
+        return False
+    return True
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def close(self):
+    self._mmap.close()
+
+
+class ExpectedResults(object):
+  """
+  Lazily-loaded expected results for a directory of saved result sets.
+
+  Result sets are looked up by query name, i.e., the file name without its
+  extension. A compiled .rset file is used when it is at least as new as the
+  yaml it came from. Otherwise, the yaml file is parsed (slowly) as a fallback.
+  Either way, each result set is only opened once per process.
+  """
+
+  def __init__(self, results_dir):
+    assert os.path.isdir(results_dir), "Invalid directory: {}".format(results_dir)
+    self.results_dir = results_dir
+    self._cache = {}
+
+  def get(self, query_name):
+    if query_name not in self._cache:
+      self._cache[query_name] = self._load(query_name)
+    return self._cache[query_name]
+
+  __getitem__ = get
+
+  def _load(self, query_name):
+    yaml_file = os.path.join(self.results_dir, '{0}.yaml'.format(query_name))
+    compiled_file = os.path.join(self.results_dir, query_name + RESULTS_EXTENSION)
+
+    if os.path.exists(compiled_file) and (not os.path.exists(yaml_file) or
+                                          not _is_stale(yaml_file, compiled_file)):
+      return CompiledResultSet(compiled_file)
+
+    logger.warning("No up-to-date compiled results for {0}, loading yaml. "
+                   "Run `python -m impala_loadtest.results {1}` to compile "
+                   "them.".format(query_name, self.results_dir))
+    return load_yaml_results(yaml_file)
+
+
+def main(argv=None):
+  """
+  Compile the yaml result sets in one or more directories.
+
+  Usage: python -m impala_loadtest.results [--force] <results_dir> ...
+  """
+  args = sys.argv[1:] if argv is None else argv
+  force = '--force' in args
+  directories = [arg for arg in args if arg != '--force']
+
+  if not directories:
+    print(main.__doc__.strip())
+    return 1
+
+  logger.setLevel(logging.INFO)
+  for results_dir in directories:
+    compiled = compile_results_directory(results_dir, force=force)
+    logger.info("Compiled {0} result sets in {1}".format(len(compiled), results_dir))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Sampled result validation, so that validating results doesn't use up the
+client CPU that should be driving load.
+
+Comparing every row of every validated result set, or hashing every row into
+a digest, costs the load generator far more CPU than running the query does.
+A ValidationSampler decides, for each execution of a query, how much of its
+results to check:
+
+  full: the whole result set, compared under the query's comparison rules
+    (or its whole digest, with validation_mode: digest)
+  sampled: the row count, plus a random sample of rows, compared by position
+    (only the row count, for queries whose rows may come back in any order,
+    and with validation_mode: digest, which has no rows to compare)
+  count: only the row count
+
+A fraction of executions (full_fraction) are validated in full, chosen at
+random. On top of that, every query is guaranteed coverage: its first
+execution in each process is validated in full, and so is at least one in
+every full_every of its executions, however unlucky the random draws. A
+wrong-results regression is then caught within full_every executions of the
+query, even when the row count and sampled rows happen to match. How many
+executions were validated at each level is logged when the test quits.
+
+Settings, in the validation_sampling section of the config file (all
+optional):
+
+  full_fraction: fraction of executions to validate in full (default 0.1)
+  full_every: most executions of a query in a row before one is validated in
+    full (default 20)
+  sample_rows: rows to compare on the other executions, or 0 to only check
+    the row count (default 32)
+  seed: seed for the random choices, to repeat them from one run to the next
+"""
+
+import locust
+import logging
+import random
+
+from locust.log import console_logger
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.sampling')
+
+# How much of a result set to validate
+FULL = 'full'
+SAMPLED = 'sampled'
+COUNT = 'count'
+
+
+class ValidationSampler(object):
+  """
+  Chooses how much of each result set to validate, keeping track of each
+  query's executions since it was last validated in full. Shared by all of
+  the users in a process.
+  """
+
+  def __init__(self, config=None):
+    """
+    Args:
+      config: the validation_sampling section of the config file (see the
+        module docstring)
+    """
+    config = config or {}
+    self.full_fraction = config.get('full_fraction', 0.1)
+    self.full_every = config.get('full_every', 20)
+    self.sample_rows = config.get('sample_rows', 32)
+    assert 0 <= self.full_fraction <= 1, "full_fraction must be between 0 and 1"
+    assert self.full_every >= 1, "full_every must be at least 1"
+    self._random = random.Random(config.get('seed'))
+    self._since_full = {}  # query name -> executions since its last full validation
+    self.counts = {FULL: 0, SAMPLED: 0, COUNT: 0}
+
+  def install(self):
+    """Attach the sampler to the locust events it needs."""
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def level(self, query_name):
+    """Return how much of this execution's results to validate."""
+    since_full = self._since_full.get(query_name)
+    if (since_full is None or since_full + 1 >= self.full_every or
+        self._random.random() < self.full_fraction):
+      self._since_full[query_name] = 0
+      level = FULL
+    else:
+      self._since_full[query_name] = since_full + 1
+      level = SAMPLED if self.sample_rows else COUNT
+    self.counts[level] += 1
+    return level
+
+  def sample(self, num_rows):
+    """Return the sorted indexes of a random sample of the rows."""
+    if num_rows <= self.sample_rows:
+      return list(range(num_rows))
+    return sorted(self._random.sample(range(num_rows), self.sample_rows))
+
+  def on_quitting(self, **kwargs):
+    if any(self.counts.values()):
+      console_logger.info(
+        "Result validation: {0} full, {1} sampled, {2} row count only".format(
+          self.counts[FULL], self.counts[SAMPLED], self.counts[COUNT]))
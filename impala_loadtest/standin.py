@@ -0,0 +1,546 @@
+"""
+A local stand-in for an Impala coordinator, for benchmarking the harness.
+
+The stand-in speaks enough of Impala's flavour of the HiveServer2 protocol
+for ImpylaClient to connect, run queries, fetch their results and get their
+profiles, but does no query processing:
+queries whose text matches a known query file are answered with that query's
+saved result set, and anything else gets an empty result. Each query takes
+a latency drawn from a configurable distribution, so the time and CPU spent
+on the client side can be measured apart from the server's.
+
+Run it with, e.g.:
+
+  python -m impala_loadtest.standin --port 21050 --latency lognormal:0.05,0.5 \\
+      --canned sample_load_tests/test_tpcds_load/TPCDS/queries:sample_load_tests/test_tpcds_load/TPCDS/scale_factor_10_results
+
+See parse_latency() for the latency specs, and impala_loadtest.benchmark for
+a suite that runs the sample tests against it.
+"""
+from __future__ import print_function
+
+import argparse
+import binascii
+import collections
+import datetime
+import fnmatch
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import yaml
+
+from decimal import Decimal
+
+import six
+
+from impala._thrift_gen.ImpalaService import ImpalaHiveServer2Service
+from impala._thrift_gen.ImpalaService import ttypes as impala_ttypes
+from impala._thrift_gen.TCLIService import ttypes
+from thrift.protocol import TBinaryProtocol
+from thrift.server import TServer
+from thrift.transport import TSocket, TTransport
+
+from impala_loadtest.common import parse_sql_file
+from impala_loadtest.results import ExpectedResults
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.standin')
+
+# HiveServer2's default port for Impala
+DEFAULT_PORT = 21050
+
+# Statements that return a result set, as opposed to e.g., 'use' or 'set'
+RESULT_STATEMENTS = ('select', 'with', 'show', 'describe', 'values', 'explain')
+
+# Closed queries whose profiles are kept, as Impala does, for clients that
+# ask for the profile after closing the query
+CLOSED_QUERIES_KEPT = 1000
+
+STATUS_OK = ttypes.TStatus(statusCode=ttypes.TStatusCode.SUCCESS_STATUS)
+
+
+def parse_latency(spec):
+  """
+  Parse a latency distribution, in seconds, from a spec string:
+
+    fixed:<seconds>
+    uniform:<min>,<max>
+    exponential:<mean>
+    lognormal:<median>,<sigma>
+
+  Returns a LatencyModel.
+  """
+  distribution, _, args = spec.partition(':')
+  args = [float(arg) for arg in args.split(',') if arg.strip()]
+  return LatencyModel(distribution, *args)
+
+
+class LatencyModel(object):
+  """A distribution of query latencies, in seconds."""
+
+  DISTRIBUTIONS = {
+    'fixed': 1,
+    'uniform': 2,
+    'exponential': 1,
+    'lognormal': 2,
+  }
+
+  def __init__(self, distribution, *args):
+    assert distribution in self.DISTRIBUTIONS, \
+        "Invalid latency distribution: {0}".format(distribution)
+    assert len(args) == self.DISTRIBUTIONS[distribution], \
+        "Wrong number of arguments for {0} latency".format(distribution)
+    self.distribution = distribution
+    self.args = args
+
+  @property
+  def mean(self):
+    """The mean latency, in seconds."""
+    if self.distribution == 'uniform':
+      return sum(self.args) / 2.0
+    if self.distribution == 'lognormal':
+      median, sigma = self.args
+      return median * math.exp(sigma ** 2 / 2.0)
+    return self.args[0]
+
+  def sample(self, rng=random):
+    if self.distribution == 'fixed':
+      return self.args[0]
+    if self.distribution == 'uniform':
+      return rng.uniform(*self.args)
+    if self.distribution == 'exponential':
+      return rng.expovariate(1.0 / self.args[0]) if self.args[0] else 0.0
+    median, sigma = self.args
+    return rng.lognormvariate(math.log(median), sigma) if median else 0.0
+
+  def __str__(self):
+    return '{0}:{1}'.format(self.distribution, ','.join(str(arg) for arg in self.args))
+
+
+def normalize_sql(sql):
+  """Return the query text in a form that ignores case, whitespace and a final ';'."""
+  return ' '.join(sql.lower().split()).rstrip('; ')
+
+
+class CannedResults(object):
+  """
+  Saved result sets, looked up by the text of the query that produced them.
+
+  Queries are added a directory at a time, along with the directory of their
+  expected results, as used by the validation tasks. Result sets are decoded
+  once, when they're added, so serving one costs no more than encoding it.
+  Query files without a saved result set still get a query name, for
+  per-query latencies, and an empty result.
+  """
+
+  def __init__(self):
+    self._queries = {}  # normalized sql -> (query name, rows)
+
+  def add_directory(self, queries_dir, results_dir=None):
+    """
+    Args:
+      queries_dir: directory of .sql files
+      results_dir: directory of their saved result sets (optional)
+    """
+    results = ExpectedResults(results_dir) if results_dir else None
+    for query_file in sorted(os.listdir(queries_dir)):
+      if not query_file.endswith('.sql'):
+        continue
+      query_str = parse_sql_file(os.path.join(queries_dir, query_file))
+      query_name = os.path.splitext(query_file)[0]
+      rows = []
+      if results is not None:
+        try:
+          rows = list(results[query_name])
+        except (IOError, OSError):
+          logger.info("No saved result set for {0}".format(query_file))
+      self._queries[normalize_sql(query_str)] = (query_name, rows)
+    return self
+
+  def __len__(self):
+    return len(self._queries)
+
+  def lookup(self, sql):
+    """Return (query name, rows) for a query, or (None, []) if it's unknown."""
+    return self._queries.get(normalize_sql(sql), (None, []))
+
+
+def _column_type(values):
+  types = set(type(value) for value in values if value is not None)
+  value_type = types.pop() if len(types) == 1 else None
+  if value_type is bool:
+    return ttypes.TTypeId.BOOLEAN_TYPE
+  if value_type in six.integer_types:
+    return ttypes.TTypeId.BIGINT_TYPE
+  if value_type is float:
+    return ttypes.TTypeId.DOUBLE_TYPE
+  if value_type is Decimal:
+    return ttypes.TTypeId.DECIMAL_TYPE
+  if value_type in (datetime.datetime, datetime.date):
+    return ttypes.TTypeId.TIMESTAMP_TYPE
+  return ttypes.TTypeId.STRING_TYPE
+
+
+def _nulls(values):
+  """Return the null bitmap for a column, one bit per value, LSB first."""
+  bitmap = bytearray((len(values) + 7) // 8)
+  for i, value in enumerate(values):
+    if value is None:
+      bitmap[i >> 3] |= 1 << (i & 7)
+  return bytes(bitmap)
+
+
+def _encode_column(type_id, values):
+  nulls = _nulls(values)
+  if type_id == ttypes.TTypeId.BOOLEAN_TYPE:
+    return ttypes.TColumn(boolVal=ttypes.TBoolColumn(
+      values=[bool(value) for value in values], nulls=nulls))
+  if type_id == ttypes.TTypeId.BIGINT_TYPE:
+    return ttypes.TColumn(i64Val=ttypes.TI64Column(
+      values=[value or 0 for value in values], nulls=nulls))
+  if type_id == ttypes.TTypeId.DOUBLE_TYPE:
+    return ttypes.TColumn(doubleVal=ttypes.TDoubleColumn(
+      values=[value or 0.0 for value in values], nulls=nulls))
+  return ttypes.TColumn(stringVal=ttypes.TStringColumn(
+    values=[b'' if value is None else six.text_type(value).encode('utf-8')
+            for value in values],
+    nulls=nulls))
+
+
+def _pretty_time(seconds):
+  """Format a duration the way Impala's profiles do, e.g., 1s234ms or 5.678ms."""
+  if seconds >= 60:
+    return '{0}m{1}s'.format(int(seconds // 60), int(seconds % 60))
+  if seconds >= 1:
+    return '{0}s{1:03d}ms'.format(int(seconds), int(seconds * 1000) % 1000)
+  if seconds >= 1e-3:
+    return '{0:.3f}ms'.format(seconds * 1e3)
+  if seconds >= 1e-6:
+    return '{0:.3f}us'.format(seconds * 1e6)
+  return '{0:.3f}ns'.format(seconds * 1e9)
+
+
+class _Operation(object):
+  """A query submitted to the stand-in, and the state needed to serve it."""
+
+  def __init__(self, sql, rows, has_result_set, ready_at, query_id='0:0',
+               session_id=None):
+    self.sql = sql
+    self.rows = rows
+    self.num_rows = len(rows)
+    self.has_result_set = has_result_set
+    self.ready_at = ready_at
+    self.query_id = query_id
+    self.session_id = session_id
+    self.submitted_at = time.time()
+    self.first_fetch_at = None
+    self.last_fetch_at = None
+    self.position = 0
+    self.cancelled = False
+    self.num_cols = len(rows[0]) if rows else 1
+    columns = list(zip(*rows)) if rows else [()] * self.num_cols
+    self.types = [_column_type(column) for column in columns]
+    self.scales = [max([-value.as_tuple().exponent for value in column
+                        if isinstance(value, Decimal)] or [0])
+                   for column in columns]
+
+  @property
+  def state(self):
+    if self.cancelled:
+      return ttypes.TOperationState.CANCELED_STATE
+    if time.time() < self.ready_at:
+      return ttypes.TOperationState.RUNNING_STATE
+    return ttypes.TOperationState.FINISHED_STATE
+
+  def profile(self):
+    """
+    Return a minimal text runtime profile for the query, with a query
+    timeline like Impala's. Planning and admission take no time, and rows
+    become available once the query's latency has passed.
+    """
+    state = ttypes.TOperationState._VALUES_TO_NAMES[self.state]
+    events = [('Query submitted', self.submitted_at),
+              ('Planning finished', self.submitted_at),
+              ('Submit for admission', self.submitted_at),
+              ('Completed admission', self.submitted_at),
+              ('Rows available', max(self.ready_at, self.submitted_at)),
+              ('First row fetched', self.first_fetch_at),
+              ('Last row fetched', self.last_fetch_at)]
+    events = [(label, at - self.submitted_at) for label, at in events if at is not None]
+
+    lines = ['Query (id={0}):'.format(self.query_id),
+             '  Summary:',
+             '    Query State: {0}'.format(state.replace('_STATE', '')),
+             '    Sql Statement: {0}'.format(self.sql),
+             '    Admission result: Admitted immediately',
+             '    Query Timeline: {0}'.format(_pretty_time(events[-1][1]))]
+    previous = 0.0
+    for label, offset in events:
+      lines.append('       - {0}: {1} ({2})'.format(
+        label, _pretty_time(offset), _pretty_time(offset - previous)))
+      previous = offset
+    lines.extend(['  ImpalaServer:',
+                  '     - NumRowsFetched: {0} ({0})'.format(self.position),
+                  '  Execution Profile {0}:(Total: {1})'.format(
+                    self.query_id, _pretty_time(events[4][1])),
+                  ''])
+    return '\n'.join(lines)
+
+  def schema(self):
+    columns = []
+    for i, (type_id, scale) in enumerate(zip(self.types, self.scales)):
+      qualifiers = None
+      if type_id == ttypes.TTypeId.DECIMAL_TYPE:
+        qualifiers = ttypes.TTypeQualifiers(qualifiers={
+          'precision': ttypes.TTypeQualifierValue(i32Value=38),
+          'scale': ttypes.TTypeQualifierValue(i32Value=scale)})
+      type_desc = ttypes.TTypeDesc(types=[ttypes.TTypeEntry(
+        primitiveEntry=ttypes.TPrimitiveTypeEntry(type=type_id,
+                                                  typeQualifiers=qualifiers))])
+      columns.append(ttypes.TColumnDesc(columnName='_c{0}'.format(i),
+                                        typeDesc=type_desc, position=i + 1))
+    return ttypes.TTableSchema(columns=columns)
+
+  def fetch(self, max_rows):
+    if self.first_fetch_at is None:
+      self.first_fetch_at = time.time()
+    self.last_fetch_at = time.time()
+    rows = self.rows[self.position:self.position + max_rows]
+    self.position += len(rows)
+    columns = list(zip(*rows)) if rows else [()] * self.num_cols
+    return ttypes.TRowSet(
+      startRowOffset=self.position - len(rows), rows=[],
+      columns=[_encode_column(type_id, list(column))
+               for type_id, column in zip(self.types, columns)])
+
+
+class StandInHandler(ImpalaHiveServer2Service.Iface):
+  """Implements the HiveServer2 calls that impyla makes to run queries."""
+
+  def __init__(self, canned, latency, query_latency=None, seed=None):
+    """
+    Args:
+      canned: a CannedResults
+      latency: the LatencyModel for queries with no more specific latency
+      query_latency: list of (query name pattern, LatencyModel) pairs, for
+        queries whose latency should differ from the default
+      seed: seed for the latency samples, for reproducible runs
+    """
+    self.canned = canned
+    self.latency = latency
+    self.query_latency = query_latency or []
+    self.rng = random.Random(seed)
+    self._sessions = set()
+    self._operations = {}
+    self._closed = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _latency_for(self, query_name):
+    if query_name is not None:
+      for pattern, model in self.query_latency:
+        if fnmatch.fnmatch(query_name, pattern):
+          return model
+    return self.latency
+
+  def OpenSession(self, req):
+    handle = ttypes.TSessionHandle(sessionId=ttypes.THandleIdentifier(
+      guid=uuid.uuid4().bytes, secret=uuid.uuid4().bytes))
+    with self._lock:
+      self._sessions.add(handle.sessionId.guid)
+    return ttypes.TOpenSessionResp(
+      status=STATUS_OK, sessionHandle=handle, configuration={},
+      serverProtocolVersion=ttypes.TProtocolVersion.HIVE_CLI_SERVICE_PROTOCOL_V6)
+
+  def CloseSession(self, req):
+    # As in Impala, the session's queries are closed with it, and any later
+    # calls on the session or its queries fail
+    session_id = req.sessionHandle.sessionId.guid
+    with self._lock:
+      if session_id not in self._sessions:
+        return self._invalid_session(ttypes.TCloseSessionResp)
+      self._sessions.discard(session_id)
+      guids = [guid for guid, operation in six.iteritems(self._operations)
+               if operation.session_id == session_id]
+    for guid in guids:
+      self._close(guid)
+    return ttypes.TCloseSessionResp(status=STATUS_OK)
+
+  def _invalid_session(self, resp_type):
+    return resp_type(status=ttypes.TStatus(
+      statusCode=ttypes.TStatusCode.ERROR_STATUS, errorMessage='Invalid session id'))
+
+  def GetInfo(self, req):
+    return ttypes.TGetInfoResp(status=STATUS_OK,
+                               infoValue=ttypes.TGetInfoValue(stringValue='Impala stand-in'))
+
+  def ExecuteStatement(self, req):
+    session_id = req.sessionHandle.sessionId.guid
+    if session_id not in self._sessions:
+      return self._invalid_session(ttypes.TExecuteStatementResp)
+    sql = req.statement
+    query_name, rows = self.canned.lookup(sql)
+    has_result_set = sql.strip().lower().startswith(RESULT_STATEMENTS)
+    with self._lock:
+      latency = self._latency_for(query_name).sample(self.rng)
+    guid = uuid.uuid4().bytes
+    query_id = '{0}:{1}'.format(binascii.hexlify(guid[:8]).decode('ascii'),
+                                binascii.hexlify(guid[8:]).decode('ascii'))
+    operation = _Operation(sql, rows if has_result_set else [], has_result_set,
+                           time.time() + latency, query_id, session_id)
+    if not req.runAsync and latency > 0:
+      time.sleep(latency)
+
+    with self._lock:
+      self._operations[guid] = operation
+    handle = ttypes.TOperationHandle(
+      operationId=ttypes.THandleIdentifier(guid=guid, secret=guid),
+      operationType=ttypes.TOperationType.EXECUTE_STATEMENT,
+      hasResultSet=has_result_set)
+    return ttypes.TExecuteStatementResp(status=STATUS_OK, operationHandle=handle)
+
+  def _operation(self, handle):
+    return self._operations.get(handle.operationId.guid)
+
+  def _unknown_operation(self, resp_type):
+    return resp_type(status=ttypes.TStatus(
+      statusCode=ttypes.TStatusCode.ERROR_STATUS, errorMessage='Invalid query handle'))
+
+  def GetOperationStatus(self, req):
+    operation = self._operation(req.operationHandle)
+    if operation is None:
+      return self._unknown_operation(ttypes.TGetOperationStatusResp)
+    return ttypes.TGetOperationStatusResp(status=STATUS_OK,
+                                          operationState=operation.state)
+
+  def CancelOperation(self, req):
+    operation = self._operation(req.operationHandle)
+    if operation is not None:
+      operation.cancelled = True
+    return ttypes.TCancelOperationResp(status=STATUS_OK)
+
+  def _close(self, guid):
+    with self._lock:
+      operation = self._operations.pop(guid, None)
+      if operation is not None:
+        operation.rows = []
+        self._closed[guid] = operation
+        while len(self._closed) > CLOSED_QUERIES_KEPT:
+          self._closed.popitem(last=False)
+
+  def CloseOperation(self, req):
+    self._close(req.operationHandle.operationId.guid)
+    return ttypes.TCloseOperationResp(status=STATUS_OK)
+
+  def CloseImpalaOperation(self, req):
+    self._close(req.operationHandle.operationId.guid)
+    return impala_ttypes.TCloseImpalaOperationResp(status=STATUS_OK)
+
+  def PingImpalaHS2Service(self, req):
+    return impala_ttypes.TPingImpalaHS2ServiceResp(status=STATUS_OK,
+                                                   version='Impala stand-in')
+
+  def GetRuntimeProfile(self, req):
+    operation = (self._operation(req.operationHandle) or
+                 self._closed.get(req.operationHandle.operationId.guid))
+    if operation is None:
+      return self._unknown_operation(impala_ttypes.TGetRuntimeProfileResp)
+    return impala_ttypes.TGetRuntimeProfileResp(status=STATUS_OK, profile=operation.profile())
+
+  def GetExecSummary(self, req):
+    return impala_ttypes.TGetExecSummaryResp(status=STATUS_OK)
+
+  def GetResultSetMetadata(self, req):
+    operation = self._operation(req.operationHandle)
+    if operation is None:
+      return self._unknown_operation(ttypes.TGetResultSetMetadataResp)
+    return ttypes.TGetResultSetMetadataResp(status=STATUS_OK, schema=operation.schema())
+
+  def FetchResults(self, req):
+    operation = self._operation(req.operationHandle)
+    if operation is None:
+      return self._unknown_operation(ttypes.TFetchResultsResp)
+    # fetchType isn't in the TFetchResultsReq of older impyla versions, which
+    # only fetch results
+    if getattr(req, 'fetchType', 0) == 1:
+      # Query log, rather than results
+      return ttypes.TFetchResultsResp(
+        status=STATUS_OK, hasMoreRows=False,
+        results=ttypes.TRowSet(startRowOffset=0, rows=[], columns=[
+          ttypes.TColumn(stringVal=ttypes.TStringColumn(values=[], nulls=b''))]))
+    results = operation.fetch(req.maxRows)
+    return ttypes.TFetchResultsResp(
+      status=STATUS_OK, results=results,
+      hasMoreRows=operation.position < operation.num_rows)
+
+  def GetLog(self, req):
+    return ttypes.TGetLogResp(status=STATUS_OK, log='')
+
+
+def make_server(handler, host='0.0.0.0', port=DEFAULT_PORT):
+  """Return a thrift server for the handler, with a thread per connection."""
+  transport = TSocket.TServerSocket(host=host, port=port)
+  return TServer.TThreadedServer(
+    ImpalaHiveServer2Service.Processor(handler), transport,
+    TTransport.TBufferedTransportFactory(), TBinaryProtocol.TBinaryProtocolFactory(),
+    daemon=True)
+
+
+def get_parser():
+  parser = argparse.ArgumentParser(
+    description="Serve canned query results over the HiveServer2 protocol, "
+                "for benchmarking the load test harness without a cluster.")
+  parser.add_argument('--host', default='0.0.0.0', help="Address to bind to")
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                      help="Port to listen on (default: %(default)s)")
+  parser.add_argument('--canned', action='append', default=[],
+                      metavar='QUERIES_DIR[:RESULTS_DIR]',
+                      help="Directory of query files, and optionally of their "
+                           "saved results, to answer queries from. May be "
+                           "given more than once.")
+  parser.add_argument('--latency', default='fixed:0',
+                      help="Query latency distribution in seconds, e.g. "
+                           "fixed:0.1, uniform:0.05,0.2, exponential:0.1 or "
+                           "lognormal:0.1,0.5 (default: %(default)s)")
+  parser.add_argument('--config',
+                      help="Yaml file with 'latency' (a distribution, as for "
+                           "--latency), 'query_latency' (query name patterns "
+                           "to distributions) and 'canned' (a list of "
+                           "QUERIES_DIR[:RESULTS_DIR]) settings")
+  parser.add_argument('--seed', type=int, help="Seed for the latency samples")
+  return parser
+
+
+def main(argv=None):
+  options = get_parser().parse_args(argv)
+  config = {}
+  if options.config:
+    with open(options.config) as fh:
+      config = yaml.safe_load(fh) or {}
+
+  canned = CannedResults()
+  for spec in config.get('canned', []) + options.canned:
+    queries_dir, _, results_dir = spec.partition(':')
+    canned.add_directory(queries_dir, results_dir or None)
+
+  latency = parse_latency(config.get('latency', options.latency))
+  query_latency = [(pattern, parse_latency(spec))
+                   for pattern, spec in sorted((config.get('query_latency') or {}).items())]
+
+  handler = StandInHandler(canned, latency, query_latency, seed=options.seed)
+  server = make_server(handler, options.host, options.port)
+  logger.warning("Impala stand-in listening on {0}:{1}, with {2} canned queries "
+                 "and {3} latency".format(options.host, options.port, len(canned), latency))
+  try:
+    server.serve()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
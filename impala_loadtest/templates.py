@@ -0,0 +1,270 @@
+"""Parameterised query templates, rendered with fresh values on every run."""
+
+import datetime
+import itertools
+import logging
+import os
+import random
+import re
+import yaml
+
+from impala_loadtest.common import Workloads
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.templates')
+
+# {{ name }}, or {{ name.attribute }} for parameters with several parts
+PLACEHOLDER = re.compile(r'\{\{\s*([A-Za-z_]\w*)(?:\.([A-Za-z_]\w*))?\s*\}\}')
+
+# Shared TemplateCatalog instances, keyed by workload name
+_catalogs = {}
+
+# Numbers the random streams handed out in this process, for make_rng()
+_streams = itertools.count()
+
+
+def make_rng(seed=None):
+  """
+  Return a random.Random for one locust user's template values.
+
+  Each call in a process gets a different stream, derived from the seed and
+  the order of the call, so with a fixed seed (and the same number of users),
+  every run renders the same sequence of queries for each user. With no
+  seed, values differ from run to run.
+  """
+  stream = next(_streams)
+  if seed is None:
+    return random.Random()
+  return random.Random('{0}:{1}'.format(seed, stream))
+
+
+def _to_date(value):
+  if isinstance(value, datetime.date):
+    return value
+  return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+
+
+class Parameter(object):
+  """
+  A typed placeholder, which generates a value for each rendering.
+
+  Subclasses implement generate(rng), which returns the SQL text to
+  substitute, or for parameters with several parts (e.g., date_range), a dict
+  of attribute names to SQL text.
+  """
+
+  def __init__(self, name, **options):
+    self.name = name
+
+  def generate(self, rng):
+    raise NotImplementedError()
+
+
+class IntParameter(Parameter):
+  """An integer between min and max, inclusive."""
+
+  def __init__(self, name, min, max, **options):
+    super(IntParameter, self).__init__(name)
+    self.min = int(min)
+    self.max = int(max)
+
+  def generate(self, rng):
+    return str(rng.randint(self.min, self.max))
+
+
+class FloatParameter(Parameter):
+  """A number between min and max, with the given number of decimal places."""
+
+  def __init__(self, name, min, max, precision=2, **options):
+    super(FloatParameter, self).__init__(name)
+    self.min = float(min)
+    self.max = float(max)
+    self.format = '{{0:.{0}f}}'.format(int(precision))
+
+  def generate(self, rng):
+    return self.format.format(rng.uniform(self.min, self.max))
+
+
+class ChoiceParameter(Parameter):
+  """
+  One or more distinct values from a list, e.g., item IDs for an IN list.
+
+  The list is given inline as values, or as values_file, the path (relative
+  to the template file) of a file with one value per line. With count > 1,
+  the chosen values are joined with commas. With quote: true, each value is
+  quoted as a SQL string literal.
+  """
+
+  def __init__(self, name, values=None, values_file=None, count=1, quote=False,
+               base_dir=None, **options):
+    super(ChoiceParameter, self).__init__(name)
+    if values_file is not None:
+      if base_dir is not None:
+        values_file = os.path.join(base_dir, values_file)
+      with open(values_file) as fh:
+        values = [line.strip() for line in fh if line.strip()]
+    assert values, "No values for parameter {0}".format(name)
+
+    if quote:
+      values = ["'{0}'".format(str(value).replace("'", "''")) for value in values]
+    self.values = [str(value) for value in values]
+    self.count = int(count)
+    assert self.count <= len(self.values), \
+        "Parameter {0} has fewer than {1} values".format(name, self.count)
+
+  def generate(self, rng):
+    if self.count == 1:
+      return rng.choice(self.values)
+    return ', '.join(rng.sample(self.values, self.count))
+
+
+class DateParameter(Parameter):
+  """A date between start and end, inclusive, formatted with format."""
+
+  def __init__(self, name, start, end, format='%Y-%m-%d', **options):
+    super(DateParameter, self).__init__(name)
+    self.start = _to_date(start).toordinal()
+    self.end = _to_date(end).toordinal()
+    self.format = format
+
+  def _date(self, rng, days=0):
+    return datetime.date.fromordinal(rng.randint(self.start, self.end - days))
+
+  def _format(self, date):
+    if self.format == '%Y-%m-%d':
+      return date.isoformat()
+    return date.strftime(self.format)
+
+  def generate(self, rng):
+    return self._format(self._date(rng))
+
+
+class DateRangeParameter(DateParameter):
+  """
+  A period of the given number of days, within start and end.
+
+  Substituted with {{ name.start }} and {{ name.end }}, which are the first
+  and last days of the period.
+  """
+
+  def __init__(self, name, start, end, days, format='%Y-%m-%d', **options):
+    super(DateRangeParameter, self).__init__(name, start, end, format)
+    self.days = int(days) - 1
+    assert self.start + self.days <= self.end, \
+        "Parameter {0} is longer than its date range".format(name)
+
+  def generate(self, rng):
+    first = self._date(rng, self.days)
+    last = first + datetime.timedelta(days=self.days)
+    return {'start': self._format(first), 'end': self._format(last)}
+
+
+PARAMETER_TYPES = {
+  'int': IntParameter,
+  'float': FloatParameter,
+  'choice': ChoiceParameter,
+  'date': DateParameter,
+  'date_range': DateRangeParameter,
+}
+
+
+class QueryTemplate(object):
+  """
+  A query with typed placeholders, compiled once for fast rendering.
+
+  The SQL is split at its placeholders when the template is created, so each
+  render() is one value generated per parameter, plus a join of the literal
+  parts with the values. A parameter used in several places gets the same
+  value everywhere in a rendering.
+  """
+
+  def __init__(self, name, sql, params, base_dir=None):
+    """
+    Args:
+      name: identifies the template, and its queries in the reported results
+      sql: the query text, with placeholders like {{ item_id }} or
+        {{ period.start }}
+      params: dict of parameter names to their settings, each with a type
+        (one of PARAMETER_TYPES) and the type's options
+      base_dir: directory that relative values_file paths are resolved against
+    """
+    self.name = name
+    self.params = {}
+    for param_name, options in params.items():
+      options = dict(options)
+      param_type = options.pop('type')
+      assert param_type in PARAMETER_TYPES, \
+          "Invalid type for parameter {0}: {1}".format(param_name, param_type)
+      self.params[param_name] = PARAMETER_TYPES[param_type](
+        param_name, base_dir=base_dir, **options)
+
+    # Alternating literal text and (parameter, attribute) fields
+    self._literals = []
+    self._fields = []
+    position = 0
+    for match in PLACEHOLDER.finditer(sql):
+      assert match.group(1) in self.params, \
+          "Undefined parameter in {0}: {1}".format(name, match.group(1))
+      self._literals.append(sql[position:match.start()])
+      self._fields.append((match.group(1), match.group(2)))
+      position = match.end()
+    self._literals.append(sql[position:])
+    self._used_params = sorted(set(field[0] for field in self._fields))
+
+  @classmethod
+  def from_file(cls, path):
+    """
+    Load a template from a yaml file with 'sql' and 'params' keys. The
+    template is named after the file, without its extension.
+    """
+    with open(path) as fh:
+      config = yaml.safe_load(fh)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return cls(name, config['sql'], config.get('params') or {},
+               base_dir=os.path.dirname(path))
+
+  def render(self, rng=random):
+    """Return the query, with freshly generated values substituted in."""
+    values = dict((name, self.params[name].generate(rng)) for name in self._used_params)
+    parts = [self._literals[0]]
+    for (name, attribute), literal in zip(self._fields, self._literals[1:]):
+      value = values[name]
+      parts.append(value if attribute is None else value[attribute])
+      parts.append(literal)
+    return ''.join(parts)
+
+
+class TemplateCatalog(object):
+  """The query templates in a directory of yaml files, keyed by name."""
+
+  def __init__(self, templates_dir):
+    """
+    Args:
+      templates_dir: full path to a directory of template .yaml files
+    """
+    assert os.path.isdir(templates_dir), "Invalid directory: {}".format(templates_dir)
+    self.templates_dir = templates_dir
+    self.templates = {}
+    for template_file in sorted(os.listdir(templates_dir)):
+      if template_file.endswith('.yaml'):
+        template = QueryTemplate.from_file(os.path.join(templates_dir, template_file))
+        self.templates[template.name] = template
+    self.names = sorted(self.templates)
+
+  def __getitem__(self, name):
+    return self.templates[name]
+
+  def __len__(self):
+    return len(self.templates)
+
+  def render(self, name, rng=random):
+    """Return a fresh rendering of the named template."""
+    return self.templates[name].render(rng)
+
+
+def get_template_catalog(workload_name):
+  """Return the shared TemplateCatalog for a workload, loading it on first use."""
+  if workload_name not in _catalogs:
+    _catalogs[workload_name] = TemplateCatalog(
+      Workloads.get_templates_directory(workload_name))
+  return _catalogs[workload_name]
@@ -0,0 +1,281 @@
+"""
+Windowed time series of request throughput and latency, for long soak runs.
+
+Cumulative stats (e.g., from locust's --csv) average away problems that come
+and go over a long run, like memory leaks, admission control queueing or
+catalog refreshes. A TimeSeriesSampler instead writes one record per window
+of a few seconds, with each request's count, failure count and latency
+histogram, to an append-only file of JSON lines. Only the current window is
+kept in memory, so memory use doesn't grow with the length of the run.
+
+The file can be summarized offline, over coarser periods, with:
+
+  python -m impala_loadtest.timeseries [--period SECONDS] [--by-name] <file>
+"""
+
+from __future__ import print_function
+
+import gevent
+import json
+import locust
+import logging
+import six
+import sys
+import time
+
+from collections import defaultdict
+
+from impala_loadtest import events, messaging
+from impala_loadtest.histogram import LatencyHistogram
+
+logging.basicConfig()
+logger = logging.getLogger('impala_loadtest.timeseries')
+
+# Percentiles included in the summary
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+
+class TimeSeriesSampler(object):
+  """
+  Samples per-request counts and latency histograms into fixed time windows.
+
+  Every interval seconds, the window that just ended is appended to the
+  output file as a single JSON object:
+
+    {"start": <epoch seconds>, "end": <epoch seconds>, "users": <count>,
+     "requests": [[request_type, name, successes, failures, histogram], ...]}
+
+  where histogram is a serialized LatencyHistogram of latencies in
+  microseconds. Windows with no requests are still written, so that stalls
+  show up as gaps in throughput. The harness's own timings, fired on the
+  metric hooks in impala_loadtest.events, are included like requests.
+
+  When running distributed, each slave sends the requests it has seen with
+  its regular stats report (every 3 seconds), and the master counts them in
+  its current window. Windows should therefore be a good deal longer than
+  the report interval; the default is 30 seconds.
+  """
+
+  def __init__(self, output_file, interval=30, significant_figures=2):
+    """
+    Args:
+      output_file: path of the file to append windows to
+      interval: length of each window, in seconds
+      significant_figures: precision of the window histograms
+    """
+    self.output_file = output_file
+    self.interval = interval
+    self.significant_figures = significant_figures
+    self._greenlet = None
+    self._reset()
+
+  def _reset(self):
+    self.window_start = time.time()
+    self.histograms = {}  # (request_type, name) -> LatencyHistogram
+    self.failures = defaultdict(int)  # (request_type, name) -> failure count
+
+  def install(self):
+    """Attach the sampler to the locust events it needs."""
+    locust.events.request_success += self.on_request_success
+    locust.events.request_failure += self.on_request_failure
+    events.metric_success += self.on_request_success
+    events.metric_failure += self.on_request_failure
+    locust.events.report_to_master += self.on_report_to_master
+    locust.events.slave_report += self.on_slave_report
+    locust.events.locust_start_hatching += self.start
+    locust.events.master_start_hatching += self.start
+    locust.events.quitting += self.on_quitting
+    return self
+
+  def start(self, **kwargs):
+    """Start writing windows, unless already started or this is a slave."""
+    if self._greenlet is not None or messaging.is_slave():
+      return
+    self._reset()
+    self._greenlet = gevent.spawn(self._run)
+    logger.info("Writing {0}s windows to {1}".format(self.interval, self.output_file))
+
+  def _run(self):
+    # Window boundaries are fixed up front, so they don't drift over time
+    window_end = self.window_start
+    while True:
+      window_end += self.interval
+      gevent.sleep(max(window_end - time.time(), 0))
+      self.write_window(window_end)
+
+  def _histogram(self, key):
+    if key not in self.histograms:
+      self.histograms[key] = LatencyHistogram(self.significant_figures)
+    return self.histograms[key]
+
+  def on_request_success(self, request_type, name, response_time,
+                         response_time_seconds=None, **kwargs):
+    if response_time_seconds is not None:
+      micros = response_time_seconds * 1000000
+    else:
+      micros = response_time * 1000
+    self._histogram((request_type, name)).record(micros)
+
+  def on_request_failure(self, request_type, name, response_time,
+                         response_time_seconds=None, **kwargs):
+    self.failures[(request_type, name)] += 1
+
+  def on_report_to_master(self, client_id, data):
+    data['timeseries_histograms'] = [
+      [request_type, name, histogram.serialize()]
+      for (request_type, name), histogram in six.iteritems(self.histograms)]
+    data['timeseries_failures'] = [
+      [request_type, name, count]
+      for (request_type, name), count in six.iteritems(self.failures)]
+    self._reset()
+
+  def on_slave_report(self, client_id, data):
+    for request_type, name, histogram in data.get('timeseries_histograms', []):
+      self._histogram((request_type, name)).merge(histogram)
+    for request_type, name, count in data.get('timeseries_failures', []):
+      self.failures[(request_type, name)] += count
+
+  def on_quitting(self, **kwargs):
+    if self._greenlet is None:
+      return
+    self._greenlet.kill()
+    # Write out whatever's in the last, partial window
+    self.write_window(time.time())
+
+  def write_window(self, window_end):
+    """Append the current window to the output file, and start a new one."""
+    requests = []
+    for key in sorted(set(self.histograms) | set(self.failures)):
+      histogram = self.histograms.get(key)
+      requests.append([key[0], key[1],
+                       histogram.total_count if histogram else 0,
+                       self.failures.get(key, 0),
+                       histogram.serialize() if histogram else None])
+
+    runner = messaging.get_runner()
+    record = {
+      'start': self.window_start,
+      'end': window_end,
+      'users': runner.user_count if runner is not None else 0,
+      'requests': requests,
+    }
+    with open(self.output_file, 'a') as outfile:
+      outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+    self.histograms = {}
+    self.failures = defaultdict(int)
+    self.window_start = window_end
+
+
+def read_windows(path):
+  """Generate the windows in a time series file, one at a time."""
+  with open(path) as infile:
+    for line in infile:
+      line = line.strip()
+      if line:
+        yield json.loads(line)
+
+
+def summarize(windows, period=300, by_name=False):
+  """
+  Combine windows into longer periods, for a view of trends over a whole run.
+
+  Windows are merged (not averaged), so the percentiles of each period are
+  exact to within the histograms' precision. Rates are over the time covered
+  by the period's windows, so a short final window isn't diluted. Only one
+  period is held in memory at a time.
+
+  Args:
+    windows: iterable of windows, as written by TimeSeriesSampler
+    period: length of each summary period, in seconds; windows are assigned
+      to the period in which they start
+    by_name: if True, report each request name separately; otherwise,
+      combine all names of each request type
+
+  Returns:
+    a generator of rows: [elapsed seconds, request type, name, requests/s,
+    failures/s, p50, p90, p99, max], with latencies in milliseconds
+  """
+  def ms(micros):
+    return None if micros is None else micros / 1000.0
+
+  def period_rows(period_start, duration, histograms, failures):
+    duration = max(duration, 1e-9)
+    for key in sorted(set(histograms) | set(failures)):
+      histogram = histograms.get(key) or LatencyHistogram()
+      row = [period_start - first_start, key[0], key[1],
+             histogram.total_count / duration, failures.get(key, 0) / duration]
+      row.extend(ms(histogram.percentile(p)) for p in SUMMARY_PERCENTILES)
+      row.append(ms(histogram.max))
+      yield row
+
+  first_start = None
+  period_start = None
+  covered = 0
+  histograms = {}
+  failures = defaultdict(int)
+
+  for window in windows:
+    if first_start is None:
+      first_start = period_start = window['start']
+    if window['start'] >= period_start + period:
+      for row in period_rows(period_start, covered, histograms, failures):
+        yield row
+      histograms = {}
+      failures = defaultdict(int)
+      covered = 0
+      while window['start'] >= period_start + period:
+        period_start += period
+    covered += window['end'] - window['start']
+
+    for request_type, name, successes, failed, histogram in window['requests']:
+      key = (request_type, name if by_name else 'All')
+      if histogram is not None:
+        if key in histograms:
+          histograms[key].merge(histogram)
+        else:
+          histograms[key] = LatencyHistogram.unserialize(histogram)
+      if failed:
+        failures[key] += failed
+
+  if first_start is not None:
+    for row in period_rows(period_start, covered, histograms, failures):
+      yield row
+
+
+def main(argv=None):
+  """
+  Summarize a time series file written by TimeSeriesSampler.
+
+  Usage: python -m impala_loadtest.timeseries [--period SECONDS] [--by-name] <file>
+  """
+  args = list(sys.argv[1:] if argv is None else argv)
+  period = 300
+  by_name = '--by-name' in args
+  if by_name:
+    args.remove('--by-name')
+  if '--period' in args:
+    index = args.index('--period')
+    period = float(args[index + 1])
+    del args[index:index + 2]
+
+  if len(args) != 1:
+    print(main.__doc__.strip())
+    return 1
+
+  def fmt(value):
+    return '' if value is None else '{0:.1f}'.format(value)
+
+  header = (['Elapsed (s)', 'Type', 'Name', 'Req/s', 'Fail/s'] +
+            ['p{0:g} (ms)'.format(p) for p in SUMMARY_PERCENTILES] + ['Max (ms)'])
+  print('\t'.join(header))
+  for row in summarize(read_windows(args[0]), period=period, by_name=by_name):
+    elapsed, request_type, name = row[:3]
+    print('\t'.join(['{0:.0f}'.format(elapsed), request_type, name,
+                     '{0:.2f}'.format(row[3]), '{0:.2f}'.format(row[4])] +
+                    [fmt(value) for value in row[5:]]))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
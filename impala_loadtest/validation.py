@@ -0,0 +1,222 @@
+"""Constant-memory query result validation using streaming result digests."""
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import six
+import sys
+import yaml
+
+from decimal import Decimal
+
+from impala_loadtest.results import load_yaml_results
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+
+# Digests are stored alongside the yaml files they were computed from, with
+# the same base name and this extension.
+DIGEST_EXTENSION = '.digest'
+
+# Number of rows to request from the cursor per fetchmany() call
+DEFAULT_BATCH_SIZE = 1024
+
+# Order-insensitive digests are the sum of the row hashes, modulo 2 ** 128
+_UNORDERED_MODULUS = 2 ** 128
+
+
+def _canonical_value(value):
+  """
+  Return a type-tagged text representation of a single value.
+
+  Values that compare equal in Python (e.g., Decimal('1.50') and
+  Decimal('1.5'), or u'abc' and 'abc' under Python 2) must have the same
+  representation, so that the digest of a result set doesn't depend on how
+  the client library happened to construct it.
+  """
+  if value is None:
+    return u'N'
+  elif isinstance(value, bool):
+    return u'B' + (u'1' if value else u'0')
+  elif isinstance(value, six.integer_types):
+    return u'I' + six.text_type(value)
+  elif isinstance(value, Decimal):
+    if value.is_finite() and value == 0:
+      return u'D0'
+    return u'D' + six.text_type(value.normalize())
+  elif isinstance(value, float):
+    return u'F' + six.text_type(repr(value))
+  elif isinstance(value, six.text_type):
+    return u'S' + value
+  elif isinstance(value, six.binary_type):
+    if six.PY2:
+      return u'S' + value.decode('utf-8', 'replace')
+    return u'Y' + six.text_type(value.hex())
+  return u'O' + six.text_type(value)
+
+
+def _encode_row(row):
+  return u'\x1f'.join([_canonical_value(value) for value in row]).encode('utf-8')
+
+
+class ResultDigest(object):
+  """
+  A fixed-size fingerprint of a result set, built up a batch of rows at a time.
+
+  Two digests are kept in parallel: an ordered digest (a running hash over the
+  rows in sequence), and an unordered digest (the sum of per-row hashes, which
+  is the same for any permutation of the same multiset of rows). Both include
+  the row count. Memory use is constant regardless of the number of rows.
+  """
+
+  def __init__(self):
+    self.row_count = 0
+    self._ordered = hashlib.sha256()
+    self._unordered = 0
+
+  def update(self, rows):
+    """Fold a batch of rows (a sequence of tuples) into the digest."""
+    sha256 = hashlib.sha256
+    ordered_update = self._ordered.update
+    unordered = self._unordered
+
+    for row in rows:
+      encoded = _encode_row(row)
+      ordered_update(encoded)
+      ordered_update(b'\x1e')
+      unordered += int(sha256(encoded).hexdigest()[:32], 16)
+
+    self._unordered = unordered % _UNORDERED_MODULUS
+    self.row_count += len(rows)
+    return self
+
+  @property
+  def ordered(self):
+    return self._ordered.hexdigest()
+
+  @property
+  def unordered(self):
+    return '{0:032x}'.format(self._unordered)
+
+  def to_dict(self):
+    return {
+      'row_count': self.row_count,
+      'ordered': self.ordered,
+      'unordered': self.unordered,
+    }
+
+  def matches(self, expected, ordered=False):
+    """
+    Compare against an expected digest, as returned by to_dict().
+
+    Args:
+      expected: a dict with keys row_count, ordered and unordered
+      ordered: Boolean to determine whether row order must also match
+    """
+    key = 'ordered' if ordered else 'unordered'
+    return (self.row_count == expected['row_count'] and
+            getattr(self, key) == expected[key])
+
+  @classmethod
+  def of(cls, rows):
+    """Compute the digest of a fully materialised result set."""
+    return cls().update(rows)
+
+
+def digest_cursor(cursor, batch_size=DEFAULT_BATCH_SIZE):
+  """
+  Fetch all remaining rows from an executed DBAPI cursor into a ResultDigest.
+
+  At most batch_size rows are held in memory at any one time.
+  """
+  digest = ResultDigest()
+  while True:
+    rows = cursor.fetchmany(batch_size)
+    if not rows:
+      break
+    digest.update(rows)
+  return digest
+
+
+def compute_digest_file(yaml_file, output_file=None):
+  """
+  Compute the digest of a saved yaml result set, and store it.
+
+  Args:
+    yaml_file: full path to a yaml file of expected results
+    output_file: path to write to, by default alongside yaml_file
+  """
+  if output_file is None:
+    output_file = os.path.splitext(yaml_file)[0] + DIGEST_EXTENSION
+
+  digest = ResultDigest.of(load_yaml_results(yaml_file))
+  with open(output_file, 'w') as outfile:
+    yaml.safe_dump(digest.to_dict(), outfile, default_flow_style=False)
+  return output_file
+
+
+def compute_digests_directory(results_dir, force=False):
+  """
+  Compute digests for every yaml result set in a directory that is missing
+  or stale. Returns a list of the digest files that were (re)written.
+  """
+  written = []
+  for filename in sorted(os.listdir(results_dir)):
+    if not filename.endswith('.yaml'):
+      continue
+    yaml_file = os.path.join(results_dir, filename)
+    output_file = os.path.splitext(yaml_file)[0] + DIGEST_EXTENSION
+    if (force or not os.path.exists(output_file) or
+        os.path.getmtime(output_file) < os.path.getmtime(yaml_file)):
+      logger.info('Computing digest for {0}'.format(yaml_file))
+      written.append(compute_digest_file(yaml_file, output_file))
+  return written
+
+
+class ExpectedDigests(object):
+  """
+  Precomputed result digests for a directory of saved result sets.
+
+  Digests are looked up by query name, i.e., the file name without its
+  extension, and each one is read at most once per process.
+  """
+
+  def __init__(self, results_dir):
+    assert os.path.isdir(results_dir), "Invalid directory: {}".format(results_dir)
+    self.results_dir = results_dir
+    self._cache = {}
+
+  def get(self, query_name):
+    if query_name not in self._cache:
+      digest_file = os.path.join(self.results_dir, query_name + DIGEST_EXTENSION)
+      with open(digest_file) as infile:
+        self._cache[query_name] = yaml.safe_load(infile)
+    return self._cache[query_name]
+
+  __getitem__ = get
+
+
+def main(argv=None):
+  """
+  Compute result digests for the yaml result sets in one or more directories.
+
+  Usage: python -m impala_loadtest.validation [--force] <results_dir> ...
+  """
+  args = sys.argv[1:] if argv is None else argv
+  force = '--force' in args
+  directories = [arg for arg in args if arg != '--force']
+
+  if not directories:
+    print(main.__doc__.strip())
+    return 1
+
+  logger.setLevel(logging.INFO)
+  for results_dir in directories:
+    written = compute_digests_directory(results_dir, force=force)
+    logger.info("Wrote {0} digests in {1}".format(len(written), results_dir))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -4,16 +4,18 @@ A simple/sample TPC* stress test.
 Randomly selects from a directory of SQL queries, and runs them concurrently
 using the specified number of workers.
 """
-import csv
+import gevent
 import locust
 import logging
 import os
 import random
 import sys
-import time
 
 from impala_loadtest import DbApiLocust, TestConfig, test_setup
-from impala_loadtest.common import Workloads, parse_sql_file
+from impala_loadtest.common import Workloads
+from impala_loadtest.histogram import get_latency_index
+from impala_loadtest.mix import get_workload_mix
+from impala_loadtest.templates import get_template_catalog, make_rng
 
 logging.basicConfig()
 LOG = logging.getLogger('test_impala_stress')
@@ -25,26 +27,36 @@ DEFAULT_CONFIG_FILE = os.path.join(CURRENT_DIR, 'dc_impala_stress_test.yaml')
 # Config file path can be overridden with a CONFIG environment variable.
 test_setup.fire(config_file=os.getenv('CONFIG', DEFAULT_CONFIG_FILE))
 
-if TestConfig['client_type'] != "ImpylaClient":
-  LOG.error("Stress test requires the Impyla client.")
-  sys.exit(1)
-
-if TestConfig['task_weights']['cancel_query'] and '--csv' not in sys.argv:
-  LOG.error("If task weight cancel_query is > 0, --csv must be specified.")
-  sys.exit(1)
-
 if TestConfig['task_weights']['run_basic_query'] < 1:
   LOG.error("Task weight run_basic_query must be >= 1.")
   sys.exit(1)
 
 
-QUERIES_DIR = Workloads.get_queries_directory(TestConfig['workload'])
+QUERIES = Workloads.get_query_catalog(TestConfig['workload']).load()
+
+# Live latencies of the queries run so far, used to time cancellations
+LATENCIES = get_latency_index()
+
+# Weighted query classes and concurrency caps for run_basic_query, if any
+if TestConfig.get('workload_mix'):
+  MIX = get_workload_mix(TestConfig['workload'], TestConfig['workload_mix'])
+else:
+  MIX = None
+
+# Parameterised queries for run_template_query, from workloads/<workload>/templates
+if TestConfig['task_weights'].get('run_template_query', 0):
+  TEMPLATES = get_template_catalog(TestConfig['workload'])
+else:
+  TEMPLATES = None
 
 
 class ImpalaStress(locust.TaskSet):
   """Workload for running randomly-selected queries from files."""
 
-  queries = os.listdir(QUERIES_DIR)
+  queries = QUERIES
+  latencies = LATENCIES
+  mix = MIX
+  templates = TEMPLATES
 
   def on_start(self):
     """
@@ -63,77 +75,96 @@ class ImpalaStress(locust.TaskSet):
     self.client.hatch(**client_kwargs)  # Instantiate the underlying client
     self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
     self.client_id = id(self.client)
+    # Values for query templates; reproducible across runs if template_seed is set
+    self.rng = make_rng(TestConfig.get('template_seed'))
 
   @locust.task(TestConfig['task_weights']['run_basic_query'])
   def run_basic_query(self):
     """
-    Select a query at random from the specified workload, and run it.
+    Select a query from the specified workload, and run it.
+
+    Queries are chosen uniformly at random, or by weight from the workload
+    mix if one is configured.
     """
-    query_file = random.choice(self.queries)
-    query_str = parse_sql_file(os.path.join(QUERIES_DIR, query_file))
+    if self.mix is not None:
+      self.mix.run(lambda class_name, query_file: self._run_query(query_file))
+    else:
+      self._run_query(random.choice(self.queries.names))
+
+  def _run_query(self, query_file):
+    query_str = self.queries[query_file]
     self.client.logged_query(query_str=query_str,
                              query_name=query_file)
     LOG.info("Locust {i} ran query: {q}".format(i=self.client_id, q=query_file))
 
+  @locust.task(TestConfig['task_weights'].get('run_template_query', 0))
+  def run_template_query(self):
+    """
+    Select a query template, and run it with freshly generated values.
+
+    Every execution gets different predicates, so the results can't be served
+    from a cache. The query is logged to locust under the template's name,
+    rather than its text.
+    """
+    template_name = self.rng.choice(self.templates.names)
+    query_str = self.templates.render(template_name, self.rng)
+    self.client.logged_query(query_str=query_str, query_name=template_name)
+    LOG.info("Locust {i} ran template: {q}".format(i=self.client_id, q=template_name))
+
   @locust.task(TestConfig['task_weights']['cancel_query'])
   def cancel_query(self):
     """
     Select a previously run query, run it asynchronously, then cancel it.
 
-    We pick the query from the previously run queries in the requests CSV file
-    so that we can use the median execution time as a basis for how long to
-    wait before cancelling.
+    We pick the query from the previously run queries in the live latency
+    index so that we can use the median execution time as a basis for how
+    long to wait before cancelling.
     """
-    row = random.choice(self._get_requests_csv_rows())
+    query_names = self.latencies.names()
+    if not query_names:
+      return
+    query_name = random.choice(query_names)
 
-    if row['Method'] != 'query' or 'cancelled' in row['Name']:
-      # We need a valid row from a prior successful query, otherwise do nothing.
+    if query_name not in self.queries:
+      # We need a prior successful (uncancelled) query, otherwise do nothing.
       return
     else:
-      LOG.info("Locust {i} starting query: {q}".format(i=self.client_id, q=row['Name']))
-      query_str = parse_sql_file(os.path.join(QUERIES_DIR, row['Name']))
+      LOG.info("Locust {i} starting query: {q}".format(i=self.client_id, q=query_name))
+      query_str = self.queries[query_name]
 
-    # The timeout is derived from the median time to execute.
-    # Median time is logged in milliseconds.
-    median_execution_time = float(row['Median response time']) / 1000
+    # The timeout is derived from the median time to execute, in seconds.
+    median_execution_time = self.latencies.median(query_name)
     lower_bound = median_execution_time * TestConfig['query_timeout']['lower_bound']
     upper_bound = median_execution_time * TestConfig['query_timeout']['upper_bound']
     timeout = random.uniform(lower_bound, upper_bound)
 
-    start_time = time.time()
-
-    try:
-      self.client._cursor.execute_async(query_str)
-      time.sleep(timeout)
-      self.client._cursor.cancel_operation()
-      total_time = int((time.time() - start_time) * 1000)
-      LOG.info("Locust {i} cancelled {q} after {t} seconds".format(
-        i=self.client_id, q=row['Name'], t=timeout))
-
-      locust.events.request_success.fire(
-        request_type="query", name='{} (cancelled)'.format(row['Name']),
-        response_time=total_time, response_length=0)
-    except Exception as e:
-      total_time = int((time.time() - start_time) * 1000)
-      locust.events.request_failure.fire(
-        request_type="query", name='{} (cancelled)'.format(row['Name']),
-        response_time=total_time, response_length=len(str(e)),
-        exception=e)
-      raise
-
-  def _get_requests_csv_rows(self):
+    # The submit and cancel are logged to locust by the query handle
+    handle = self.client.submit(query_str, query_name=query_name)
+    gevent.sleep(timeout)
+    handle.cancel()
+    LOG.info("Locust {i} cancelled {q} after {t} seconds".format(
+      i=self.client_id, q=query_name, t=timeout))
+
+  @locust.task(TestConfig['task_weights'].get('run_overlapped_queries', 0))
+  def run_overlapped_queries(self):
     """
-    Helper function to parse the requests CSV file, and return its rows as dicts.
+    Run several randomly-selected queries at once, on this worker's session.
+
+    The number of queries in flight is set by queries_in_flight in the config
+    file. Each query is logged to locust separately, timed from submission
+    until its results have been fetched.
     """
-    command_line_args = iter(sys.argv)
-    while True:
-      arg = next(command_line_args)
-      if arg == "--csv":
-        csv_filename = "{}_requests.csv".format(next(command_line_args))
-        break
-
-    with open(os.path.join(CURRENT_DIR, csv_filename), mode='r') as infile:
-      return [row for row in csv.DictReader(infile)]
+    query_files = [random.choice(self.queries.names)
+                   for _ in range(TestConfig.get('queries_in_flight', 2))]
+    handles = [self.client.submit(self.queries[query_file], query_name=query_file)
+               for query_file in query_files]
+    for handle in handles:
+      try:
+        handle.fetch()
+      except Exception as e:
+        # The failure has already been reported to locust
+        LOG.debug("{0} failed: {1}".format(handle.query_name, e))
+    LOG.info("Locust {i} ran queries: {q}".format(i=self.client_id, q=query_files))
 
 
 class ImpalaUser(DbApiLocust):
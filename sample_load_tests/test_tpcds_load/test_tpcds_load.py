@@ -10,10 +10,14 @@ import os
 import random
 import sys
 import time
-import yaml
 
-from impala_loadtest import DbApiLocust, TestConfig, test_setup
-from impala_loadtest.common import DataTypeLoader, parse_sql_file
+from impala_loadtest import DbApiLocust, OpenLoopTaskSet, TestConfig, test_setup
+from impala_loadtest.common import QueryCatalog, load_comparison_rules
+from impala_loadtest.mix import WorkloadMix, load_mix_config
+from impala_loadtest.pool import get_session_pool
+from impala_loadtest.results import ExpectedResults
+from impala_loadtest.sampling import COUNT, FULL, SAMPLED, ValidationSampler
+from impala_loadtest.validation import ExpectedDigests
 
 
 logging.basicConfig()
@@ -29,17 +33,52 @@ test_setup.fire(config_file=os.getenv('CONFIG', DEFAULT_CONFIG_FILE))
 
 QUERIES_DIR = os.path.join(CURRENT_DIR, 'TPCDS', 'queries')
 RESULTS_DIR = os.path.join(CURRENT_DIR, 'TPCDS', TestConfig['expected_results'])
+MIXES_DIR = os.path.join(CURRENT_DIR, 'TPCDS', 'mixes')
+RULES_DIR = os.path.join(CURRENT_DIR, 'TPCDS')
+
+# Suffixes of the reported request names, for each level of validation
+VALIDATION_LABELS = {FULL: 'validated', SAMPLED: 'sampled', COUNT: 'row count'}
 
 
 class RandomizedTpcdsQueries(locust.TaskSet):
   """Workload for running randomly-selected TPCDS queries from files."""
 
-  queries = os.listdir(QUERIES_DIR)
-
-  # Each time we parsed saved results from yaml to validate query
-  # correctness, we cache it here for re-use to avoid having to
-  # re-parse the same yaml file again and again.
-  cached_results = {}
+  # Queries are parsed once, up front, rather than on every task execution
+  queries = QueryCatalog(QUERIES_DIR, preload=True)
+
+  # Saved results used to validate query correctness. Each result set is
+  # opened on first use, and kept for re-use. Compile the yaml files first
+  # with `python -m impala_loadtest.results <results dir>` so that they can
+  # be memory-mapped instead of parsed.
+  expected_results = ExpectedResults(RESULTS_DIR)
+
+  # Precomputed digests of the saved results, for validation_mode: digest
+  expected_digests = ExpectedDigests(RESULTS_DIR)
+
+  # How each query's results are compared to the saved ones, e.g., in any
+  # order, or with a tolerance for rounding. Exact, by default. Queries found
+  # to be non-deterministic by impala_loadtest.determinism get the rules in
+  # its manifest, unless comparison_rules has their own.
+  comparison_rules = load_comparison_rules(
+    TestConfig.get('comparison_rules'), RULES_DIR,
+    manifest=TestConfig.get('determinism_manifest'))
+
+  # How much of each result set to validate: all of it, unless
+  # validation_sampling is configured, in which case most executions only
+  # have their row count and a sample of rows checked, to save client CPU.
+  if TestConfig.get('validation_sampling'):
+    validation_sampler = ValidationSampler(
+      TestConfig['validation_sampling']).install()
+  else:
+    validation_sampler = None
+
+  # Weighted query classes and concurrency caps, shared by all users. When no
+  # workload_mix is configured, queries are chosen uniformly at random.
+  if TestConfig.get('workload_mix'):
+    mix = WorkloadMix(load_mix_config(TestConfig['workload_mix'], MIXES_DIR),
+                      queries.names, namespace='tpcds_load')
+  else:
+    mix = None
 
   def on_start(self):
     """
@@ -55,16 +94,34 @@ class RandomizedTpcdsQueries(locust.TaskSet):
       'user': TestConfig['user'],
       'password': TestConfig['password']
     }
-    self.client.hatch(**client_kwargs)  # Instantiate the underlying client
-    self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
+
+    if TestConfig.get('session_pool_spares'):
+      # Check out a session that's already connected and using target_db
+      self.client.hatch_from_pool(get_session_pool(
+        target_db=TestConfig['target_db'],
+        spares=TestConfig['session_pool_spares'], **client_kwargs))
+    else:
+      self.client.hatch(**client_kwargs)  # Instantiate the underlying client
+      self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
+
+  def run_from_mix(self, run_query):
+    """
+    Select a query file, uniformly or from the workload mix, and run it with
+    run_query(query_file).
+    """
+    if self.mix is None:
+      return run_query(random.choice(self.queries.names))
+    return self.mix.run(lambda class_name, query_file: run_query(query_file))
 
   @locust.task(10)
   def run_random_query(self):
     """
     Select a file at random from the directory of TPC-DS queries, and run it
     """
-    query_file = random.choice(self.queries)
-    query_str = parse_sql_file(os.path.join(QUERIES_DIR, query_file))
+    self.run_from_mix(self._run_query)
+
+  def _run_query(self, query_file):
+    query_str = self.queries[query_file]
     self.client.logged_query(query_str=query_str,
                              query_name=query_file)
 
@@ -77,13 +134,34 @@ class RandomizedTpcdsQueries(locust.TaskSet):
     Registers a locust failure event if results don't match expected values,
     otherwise, register success.
     """
-    query_file = random.choice(self.queries)
-    query_name = query_file.split('.')[0]  # i.e., drop .sql file extension
-    query_str = parse_sql_file(os.path.join(QUERIES_DIR, query_file))
+    self.run_from_mix(self._run_query_and_confirm_results)
 
-    if query_name not in self.cached_results:
-      with open(os.path.join(RESULTS_DIR, '{}.yaml'.format(query_name))) as infile:
-        self.cached_results[query_name] = yaml.load(infile, Loader=DataTypeLoader)
+  def _run_query_and_confirm_results(self, query_file):
+    query_name = query_file.split('.')[0]  # i.e., drop .sql file extension
+    query_str = self.queries[query_file]
+
+    if not self.comparison_rules.validates(query_name):
+      # Not even the row count is stable, so the query is only run
+      self._run_query(query_file)
+      return
+
+    comparator = self.comparison_rules.get(query_name)
+    if self.validation_sampler is not None:
+      level = self.validation_sampler.level(query_name)
+    else:
+      level = FULL
+    request_name = '{0} ({1})'.format(query_file, VALIDATION_LABELS[level])
+
+    if (TestConfig.get('validation_mode') == 'digest' and
+        comparator.digest_compatible):
+      # Stream the results through a digest rather than materialising them.
+      # Without the rows, a sampled check can only count them.
+      self.client.validated_query(query_str, self.expected_digests[query_name],
+                                  query_name=request_name,
+                                  ordered=comparator.ordered, full=level == FULL)
+      return
+
+    expected = self.expected_results[query_name]
 
     start_time = time.time()
 
@@ -94,17 +172,22 @@ class RandomizedTpcdsQueries(locust.TaskSet):
     results = self.client.query(query_str)
 
     try:
-      assert results == self.cached_results[query_name], \
-                        "Results mismatch for {}".format(query_file)  # noqa
+      if level == FULL:
+        mismatch = comparator.compare(expected, results)
+      else:
+        rows = self.validation_sampler.sample(len(results)) if level == SAMPLED else []
+        mismatch = comparator.compare_sample(expected, results, rows)
+      assert mismatch is None, \
+          "Results mismatch for {0}: {1}".format(query_file, mismatch)
       total_time = int((time.time() - start_time) * 1000)
       locust.events.request_success.fire(
-        request_type="query", name='{} (validated)'.format(query_file),
+        request_type="query", name=request_name,
         response_time=total_time, response_length=sys.getsizeof(results)
       )
     except AssertionError as e:
       total_time = int((time.time() - start_time) * 1000)
       locust.events.request_failure.fire(
-        request_type="query", name='{} (validated)'.format(query_file),
+        request_type="query", name=request_name,
         response_time=total_time, response_length=len(str(e)),
         exception=e
       )
@@ -113,14 +196,43 @@ class RandomizedTpcdsQueries(locust.TaskSet):
   @locust.task(1)
   def reestablish_connection(self):
     """
-    Disconnect and reconnect to the server.
+    Disconnect and reconnect to the server, or swap sessions with the pool.
     """
-    self.client.disconnect()
-    self.client.connect()
-    self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
+    self.client.reconnect(target_db=TestConfig['target_db'])
+
+
+class OpenLoopTpcdsQueries(OpenLoopTaskSet):
+  """
+  Workload for running randomly-selected TPCDS queries at a fixed arrival
+  rate, set in the open_loop section of the config file.
+  """
+
+  queries = RandomizedTpcdsQueries.queries
+
+  def on_start(self):
+    client_kwargs = {
+      'host': TestConfig.get('coordinator', self.locust.host),
+      'client_type': TestConfig['client_type'],
+      'auth_type': TestConfig['auth_type'],
+      'ssl': TestConfig['ssl'],
+      'thrift_transport': TestConfig['thrift_transport'],
+      'user': TestConfig['user'],
+      'password': TestConfig['password']
+    }
+    self.session_pool = get_session_pool(
+      target_db=TestConfig['target_db'],
+      spares=TestConfig.get('session_pool_spares') or 1, keep_idle=True,
+      **client_kwargs)
+
+  def next_query(self):
+    query_file = random.choice(self.queries.names)
+    return query_file, self.queries[query_file]
 
 
 class ImpalaUser(DbApiLocust):
   """A worker capable of executing the given task set."""
-  task_set = RandomizedTpcdsQueries
+  if TestConfig.get('open_loop'):
+    task_set = OpenLoopTpcdsQueries
+  else:
+    task_set = RandomizedTpcdsQueries
   wait_time = locust.between(TestConfig['min_wait'], TestConfig['max_wait'])
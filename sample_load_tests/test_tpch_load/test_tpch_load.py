@@ -10,7 +10,8 @@ import os
 import random
 
 from impala_loadtest import DbApiLocust, TestConfig, test_setup
-from impala_loadtest.common import parse_sql_file
+from impala_loadtest.common import QueryCatalog
+from impala_loadtest.pool import get_session_pool
 
 
 logging.basicConfig()
@@ -30,7 +31,8 @@ QUERIES_DIR = os.path.join(CURRENT_DIR, 'TPCH', 'queries')
 class RandomizedTpcdsQueries(locust.TaskSet):
   """Workload for running randomly-selected TPCDS queries from files."""
 
-  queries = os.listdir(QUERIES_DIR)
+  # Queries are parsed once, up front, rather than on every task execution
+  queries = QueryCatalog(QUERIES_DIR, preload=True)
 
   # Each time we parsed saved results from yaml to validate query
   # correctness, we cache it here for re-use to avoid having to
@@ -51,27 +53,32 @@ class RandomizedTpcdsQueries(locust.TaskSet):
       'user': TestConfig['user'],
       'password': TestConfig['password']
     }
-    self.client.hatch(**client_kwargs)  # Instantiate the underlying client
-    self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
+
+    if TestConfig.get('session_pool_spares'):
+      # Check out a session that's already connected and using target_db
+      self.client.hatch_from_pool(get_session_pool(
+        target_db=TestConfig['target_db'],
+        spares=TestConfig['session_pool_spares'], **client_kwargs))
+    else:
+      self.client.hatch(**client_kwargs)  # Instantiate the underlying client
+      self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
 
   @locust.task(10)
   def run_random_query(self):
     """
     Select a file at random from the directory of TPC-DS queries, and run it
     """
-    query_file = random.choice(self.queries)
-    query_str = parse_sql_file(os.path.join(QUERIES_DIR, query_file))
+    query_file = random.choice(self.queries.names)
+    query_str = self.queries[query_file]
     self.client.logged_query(query_str=query_str,
                              query_name=query_file)
 
   @locust.task(2)
   def reestablish_connection(self):
     """
-    Disconnect and reconnect to the server.
+    Disconnect and reconnect to the server, or swap sessions with the pool.
     """
-    self.client.disconnect()
-    self.client.connect()
-    self.client.query('use {target_db}'.format(target_db=TestConfig['target_db']))
+    self.client.reconnect(target_db=TestConfig['target_db'])
 
 
 class ImpalaUser(DbApiLocust):
@@ -0,0 +1,47 @@
+"""
+A sample trace-replay test.
+
+Re-issues the queries in a captured query log, with the log's original
+timing (optionally sped up), keeping each session's queries in order.
+"""
+import locust
+import logging
+import os
+
+from impala_loadtest import DbApiLocust, TestConfig, TraceReplayTaskSet, test_setup
+
+logging.basicConfig()
+LOG = logging.getLogger(__file__)
+LOG.setLevel(getattr(logging, os.getenv('loglevel', 'WARNING')))
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_FILE = os.path.join(CURRENT_DIR, 'dc_trace_replay_test.yaml')
+
+# Parse the config file using the event handler defined in common.py
+# Config file path can be overridden with a CONFIG environment variable.
+test_setup.fire(config_file=os.getenv('CONFIG', DEFAULT_CONFIG_FILE))
+
+# A relative trace file is relative to this directory
+TestConfig['replay']['trace_file'] = os.path.join(
+  CURRENT_DIR, TestConfig['replay']['trace_file'])
+
+
+class ReplayedQueries(TraceReplayTaskSet):
+  """Replays the query log set in the config file."""
+
+  def on_start(self):
+    self.client_kwargs = {
+      'host': TestConfig.get('coordinator', self.locust.host),
+      'client_type': TestConfig['client_type'],
+      'auth_type': TestConfig['auth_type'],
+      'ssl': TestConfig['ssl'],
+      'thrift_transport': TestConfig['thrift_transport'],
+      'user': TestConfig['user'],
+      'password': TestConfig['password']
+    }
+
+
+class ImpalaUser(DbApiLocust):
+  """The single worker that replays the whole log; run with -c 1."""
+  task_set = ReplayedQueries
+  wait_time = locust.constant(0)
@@ -33,4 +33,9 @@ setup(
     author_email='dev@cloudera.com',
     packages=['impala_loadtest'],
     install_requires=parse_requirements(),
+    entry_points={
+        'console_scripts': [
+            'impala-locust=impala_loadtest.launcher:main',
+        ],
+    },
 )